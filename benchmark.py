@@ -0,0 +1,358 @@
+"""Benchmark harness for the search and recommendation system.
+
+Generates synthetic catalogs, builds a ProductSearch over each one and
+replays a skewed query workload against the Python API and every HTTP
+route in-process. Latency percentiles, throughput, index build time and
+peak RSS are written to JSON so runs can be compared:
+
+    python benchmark.py --sizes 10000,100000 --output before.json
+    python benchmark.py --sizes 10000,100000 --output after.json --compare before.json
+
+With --shards N the catalog is also built as N shards and the Python API
+is replayed against a ShardedSearch.
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Word pools per category; names, descriptions and tags are drawn from them
+# with Zipf-like weights so a few terms are common and most are rare.
+CATEGORY_WORDS = {
+    'Electronics': ['wireless', 'bluetooth', 'headphones', 'speaker', 'charger', 'smartphone', 'tablet', 'laptop',
+                    'monitor', 'keyboard', 'mouse', 'camera', 'battery', 'usb', 'hdmi', 'audio', 'noise',
+                    'cancelling', 'portable', 'gaming', 'display', 'processor', 'memory', 'storage', 'smart'],
+    'Clothing': ['cotton', 'shirt', 'jacket', 'jeans', 'denim', 'sweater', 'wool', 'dress', 'casual', 'formal',
+                 'summer', 'winter', 'slim', 'fit', 'sleeve', 'hoodie', 'socks', 'linen', 'organic', 'vintage'],
+    'Home': ['kitchen', 'coffee', 'maker', 'blender', 'knife', 'set', 'pan', 'ceramic', 'lamp', 'pillow',
+             'blanket', 'towel', 'storage', 'organizer', 'wooden', 'table', 'chair', 'rug', 'candle', 'vase'],
+    'Sports': ['running', 'shoes', 'yoga', 'mat', 'fitness', 'tracker', 'bottle', 'water', 'bike', 'helmet',
+               'gloves', 'training', 'outdoor', 'camping', 'tent', 'hiking', 'backpack', 'ball', 'weights', 'band'],
+    'Books': ['novel', 'mystery', 'fantasy', 'history', 'science', 'cookbook', 'guide', 'biography', 'poetry',
+              'children', 'edition', 'hardcover', 'paperback', 'classic', 'thriller', 'romance', 'travel'],
+    'Beauty': ['skin', 'care', 'serum', 'cream', 'moisturizer', 'shampoo', 'conditioner', 'hair', 'natural',
+               'vitamin', 'lotion', 'perfume', 'makeup', 'brush', 'lip', 'balm', 'face', 'mask', 'oil'],
+    'Toys': ['puzzle', 'lego', 'doll', 'car', 'remote', 'control', 'board', 'game', 'plush', 'educational',
+             'building', 'blocks', 'robot', 'kids', 'art', 'craft', 'figure', 'train', 'drone'],
+}
+COMMON_WORDS = ['premium', 'quality', 'durable', 'lightweight', 'new', 'best', 'pro', 'max', 'mini', 'classic',
+                'deluxe', 'compact', 'eco', 'friendly', 'design', 'comfortable', 'easy', 'use', 'gift', 'black',
+                'white', 'blue', 'red', 'green', 'large', 'small', 'pack', 'ultra', 'advanced', 'everyday']
+BRANDS = ['Acme', 'Zenith', 'Nova', 'Apex', 'Lumen', 'Orbit', 'Vertex', 'Pulse', 'Terra', 'Nimbus', 'Cobalt',
+          'Summit', 'Echo', 'Atlas', 'Quartz', 'Ember', 'Harbor', 'Willow', 'Falcon', 'Sierra']
+# Share of the catalog and median price per category
+CATEGORY_SHARE = {'Electronics': 0.25, 'Clothing': 0.2, 'Home': 0.18, 'Sports': 0.12, 'Books': 0.1,
+                  'Beauty': 0.09, 'Toys': 0.06}
+CATEGORY_PRICE = {'Electronics': 150.0, 'Clothing': 40.0, 'Home': 45.0, 'Sports': 60.0, 'Books': 15.0,
+                  'Beauty': 20.0, 'Toys': 25.0}
+
+DEFAULT_SIZES = '10000,100000'
+DEFAULT_QUERIES = 2000
+DEFAULT_OUTPUT = 'benchmark-results.json'
+REGRESSION_THRESHOLD = 1.2
+
+def zipf_weights(n, exponent=1.1):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+def synthetic_products(n, seed=0, chunk_size=10000):
+    """Yield n synthetic products with realistic text, tags and prices.
+
+    Categories follow CATEGORY_SHARE, words within a category are drawn
+    with Zipf weights, prices are log-normal around the category median
+    and ratings skew high like real reviews. Products are generated one
+    chunk at a time, so catalogs far larger than memory can be streamed.
+    """
+    rng = np.random.default_rng(seed)
+    categories = list(CATEGORY_SHARE)
+    shares = np.array([CATEGORY_SHARE[category] for category in categories])
+    pools = {category: CATEGORY_WORDS[category] + COMMON_WORDS for category in categories}
+    weights = {category: zipf_weights(len(pool)) for category, pool in pools.items()}
+
+    for start in range(0, n, chunk_size):
+        size = min(chunk_size, n - start)
+        chunk_categories = rng.choice(len(categories), size=size, p=shares)
+        ratings = np.clip(np.round(5 - rng.gamma(1.5, 0.45, size=size), 1), 1.0, 5.0)
+        for offset in range(size):
+            category = categories[chunk_categories[offset]]
+            pool, p = pools[category], weights[category]
+            name_words = rng.choice(pool, size=rng.integers(2, 4), p=p)
+            description = rng.choice(pool, size=rng.integers(8, 21), p=p)
+            tags = list(dict.fromkeys(rng.choice(pool, size=rng.integers(3, 7), p=p)))
+            yield {
+                'id': start + offset + 1,
+                'name': f"{BRANDS[rng.integers(len(BRANDS))]} {' '.join(name_words).title()} {rng.integers(1, 1000)}",
+                'category': category,
+                'price': round(float(CATEGORY_PRICE[category] * rng.lognormal(0.0, 0.6)), 2),
+                'rating': float(ratings[offset]),
+                'description': ' '.join(description).capitalize() + '.',
+                'tags': [str(tag) for tag in tags],
+                'image': f'https://example.com/images/{start + offset + 1}.jpg',
+            }
+
+def query_workload(n_products, n_queries, seed=0):
+    """Skewed request mix as (query, product_id, filters) tuples.
+
+    Query strings and product ids are drawn with Zipf weights so a few are
+    very popular, which is what makes result caching matter. About one in
+    five searches carries a category, price or rating filter.
+    """
+    rng = np.random.default_rng(seed + 1)
+    words = sorted({word for pool in CATEGORY_WORDS.values() for word in pool} | set(COMMON_WORDS))
+    rng.shuffle(words)
+    word_weights = zipf_weights(len(words))
+    query_pool = [' '.join(rng.choice(words, size=rng.integers(1, 4), p=word_weights)) for _ in range(500)]
+    query_weights = zipf_weights(len(query_pool))
+    id_pool = rng.permutation(np.arange(1, n_products + 1))[:min(n_products, 5000)]
+    id_weights = zipf_weights(len(id_pool))
+
+    workload = []
+    for _ in range(n_queries):
+        filters = {}
+        if rng.random() < 0.2:
+            choice = rng.integers(3)
+            if choice == 0:
+                filters['category'] = str(rng.choice(list(CATEGORY_SHARE)))
+            elif choice == 1:
+                filters['max_price'] = float(rng.choice([25, 50, 100, 250]))
+            else:
+                filters['min_rating'] = float(rng.choice([3.5, 4.0, 4.5]))
+        workload.append((str(rng.choice(query_pool, p=query_weights)), int(rng.choice(id_pool, p=id_weights)),
+                         filters))
+    return workload
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def summarize(latencies, elapsed):
+    latencies = np.array(latencies) * 1000
+    return {
+        'count': len(latencies),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+        'throughput_per_s': len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+def replay(operation, workload):
+    """Run operation once per workload entry and summarize its latency"""
+    latencies = []
+    started = time.perf_counter()
+    for entry in workload:
+        t0 = time.perf_counter()
+        operation(*entry)
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - started)
+
+def _check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f'{response.request.path} returned {response.status_code}')
+
+def operations(search, client):
+    """Name -> callable(query, product_id, filters) for every benchmarked path"""
+    def query_string(query, filters, field):
+        return dict(filters, **{field: query})
+
+    return {
+        'search_products': lambda query, product_id, filters: search.search_products(query, limit=20, **filters),
+        'search_page': lambda query, product_id, filters: search.search_page(query, **filters),
+        'get_recommendations': lambda query, product_id, filters: search.get_recommendations(product_id),
+        'GET /': lambda query, product_id, filters: _check(client.get('/')),
+        'GET /search': lambda query, product_id, filters: _check(
+            client.get('/search', query_string=query_string(query, filters, 'search'))),
+        'GET /product/<id>': lambda query, product_id, filters: _check(client.get(f'/product/{product_id}')),
+        'GET /api/search': lambda query, product_id, filters: _check(
+            client.get('/api/search', query_string=query_string(query, filters, 'q'))),
+        'GET /api/recommend/<id>': lambda query, product_id, filters: _check(
+            client.get(f'/api/recommend/{product_id}')),
+        'POST /api/search/batch': lambda query, product_id, filters: _check(
+            client.post('/api/search/batch', json={'queries': [query, query + ' pro']})),
+        'POST /api/recommend/batch': lambda query, product_id, filters: _check(
+            client.post('/api/recommend/batch', json={'ids': [product_id, product_id + 1]})),
+    }
+
+def sharded_operations(search):
+    """Name -> callable(query, product_id, filters) for the scatter-gather paths"""
+    return {
+        'sharded search_products': lambda query, product_id, filters: search.search_products(query, limit=20,
+                                                                                            **filters),
+        'sharded search_page': lambda query, product_id, filters: search.search_page(query, **filters),
+        'sharded get_recommendations': lambda query, product_id, filters: search.get_recommendations(product_id),
+    }
+
+def run_size(size, options):
+    """Build an index over `size` synthetic products and replay the workload.
+
+    Runs in its own process (see main), so peak RSS belongs to this size.
+    """
+    import ecommerceWeb as web
+
+    cache = web.ResultCache(max_bytes=0) if options['no_cache'] else None
+    dense = {} if options['dense'] else None
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    search = web.ProductSearch(synthetic_products(size, options['seed']), cache=cache, dense=dense,
+                               chunk_size=web.INGEST_CHUNK_SIZE, precision=options['precision'])
+    build_seconds = time.perf_counter() - started
+    rss_after_build = peak_rss_mb()
+
+    # The routes read the module-level search system
+    web.search_system = search
+    client = web.app.test_client()
+    workload = query_workload(size, options['queries'], options['seed'])
+    for operation in operations(search, client).values():
+        operation(*workload[0])
+
+    results = {}
+    for name, operation in operations(search, client).items():
+        if options['only'] and not any(part in name for part in options['only']):
+            continue
+        results[name] = replay(operation, workload)
+    result = {
+        'size': size,
+        'build_seconds': build_seconds,
+        'build_products_per_s': size / build_seconds if build_seconds else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+        'build_rss_mb': rss_after_build - rss_before,
+        'index_bytes': search.index.nbytes,
+        'operations': results,
+    }
+    if options['shards']:
+        del search, client
+        web.search_system = None
+        path = tempfile.mkdtemp(prefix='shards-')
+        try:
+            started = time.perf_counter()
+            web.build_sharded_index(synthetic_products(size, options['seed']), path, options['shards'],
+                                    precision=options['precision'])
+            result['shard_build_seconds'] = time.perf_counter() - started
+            sharded = web.ShardedSearch(path)
+            try:
+                for name, operation in sharded_operations(sharded).items():
+                    if options['only'] and not any(part in name for part in options['only']):
+                        continue
+                    operation(*workload[0])
+                    results[name] = replay(operation, workload)
+            finally:
+                sharded.close()
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+    return result
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': multiprocessing.cpu_count(),
+        'numpy': np.__version__,
+    }
+
+def compare(current, baseline, threshold=REGRESSION_THRESHOLD):
+    """Ratios of current to baseline p50/p95/p99 and build time, per size.
+
+    Returns the list of (size, metric, ratio) entries slower than threshold.
+    """
+    previous = {result['size']: result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = previous.get(result['size'])
+        if before is None:
+            continue
+        print(f"\nsize {result['size']:,} vs baseline {baseline['environment'].get('commit')}")
+        ratio = result['build_seconds'] / before['build_seconds']
+        print(f"  {'build':<28} x{ratio:.2f}")
+        if ratio > threshold:
+            regressions.append((result['size'], 'build_seconds', ratio))
+        for name, stats in result['operations'].items():
+            old = before['operations'].get(name)
+            if old is None:
+                continue
+            ratios = {metric: stats[metric] / old[metric] if old[metric] else 0.0
+                      for metric in ('p50_ms', 'p95_ms', 'p99_ms')}
+            print(f"  {name:<28} " + '  '.join(f"{metric[:3]} x{ratio:.2f}" for metric, ratio in ratios.items()))
+            regressions.extend((result['size'], f'{name} {metric}', ratio)
+                               for metric, ratio in ratios.items() if ratio > threshold)
+    return regressions
+
+def print_result(result):
+    print(f"\n📊 {result['size']:,} products: built in {result['build_seconds']:.1f}s "
+          f"({result['build_products_per_s']:,.0f}/s), peak RSS {result['peak_rss_mb']:.0f} MB")
+    print(f"  {'operation':<28} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>10}")
+    for name, stats in result['operations'].items():
+        print(f"  {name:<28} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} "
+              f"{stats['throughput_per_s']:>10.0f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma-separated catalog sizes, e.g. 10000,100000,1000000,5000000')
+    parser.add_argument('--queries', type=int, default=DEFAULT_QUERIES, help='requests replayed per operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dense', action='store_true', help='build the IVF index for recommendations')
+    parser.add_argument('--no-cache', action='store_true', help='disable the result cache')
+    parser.add_argument('--precision', default='float64', choices=('float64', 'float32', 'uint8'),
+                        help='stored precision of the term weights')
+    parser.add_argument('--shards', type=int, default=0, help='also replay against a ShardedSearch of N shards')
+    parser.add_argument('--only', default='', help='comma-separated substrings of operation names to run')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', help='baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    options = {
+        'seed': args.seed,
+        'queries': args.queries,
+        'dense': args.dense,
+        'no_cache': args.no_cache,
+        'precision': args.precision,
+        'shards': args.shards,
+        'only': [part for part in args.only.split(',') if part],
+    }
+    report = {'environment': environment(), 'options': options, 'results': []}
+    # A fresh process per size keeps peak RSS and allocator state separate. Unlike
+    # a Pool worker it is not a daemon, so it can start the shard processes.
+    context = multiprocessing.get_context('spawn')
+    for size in (int(size) for size in args.sizes.split(',')):
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(run_size, size, options).result()
+        print_result(result)
+        report['results'].append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n💾 Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n⚠️ {len(regressions)} regressions over x{args.threshold:.2f}:")
+            for size, metric, ratio in regressions:
+                print(f"   {size:,} {metric}: x{ratio:.2f}")
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,69 @@
-from flask import Flask, render_template_string, request, jsonify
+from flask import Flask, g, request, jsonify, url_for
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+from werkzeug.serving import BaseWSGIServer
+from flask.json.provider import DefaultJSONProvider
 import json
+import base64
+import hashlib
+import csv
+import os
+import shutil
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import importlib
 import re
+import copy
+import sys
+import time
+import threading
+import asyncio
+import gc
+import io
+import signal
+import socket
+import tracemalloc
+import logging
+import array
+import zlib
+import multiprocessing
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from math import sqrt
 
+class LazyModule:
+    """Stand-in for a module that is imported on first attribute access"""
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        value = getattr(self._module, attribute)
+        # Later lookups find the attribute directly
+        setattr(self, attribute, value)
+        return value
+
+# SciPy and scikit-learn take longer to import than everything else together,
+# so they are imported on first use, off the path to serving the first request
+sp = LazyModule('scipy.sparse')
+
+class CatalogJSONProvider(DefaultJSONProvider):
+    """Serialize catalog views like the product dicts they stand for"""
+    
+    @staticmethod
+    def default(o):
+        if isinstance(o, ProductView):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
 app = Flask(__name__)
+app.json = CatalogJSONProvider(app)
 
 # Sample product database
 products = [
@@ -84,83 +141,3500 @@ products = [
     }
 ]
 
-class ProductSearch:
-    def __init__(self, products):
+# Item-to-item neighbor table: how many neighbors are kept per product, and
+# how much dense similarity scratch space a single build block may use.
+NEIGHBOR_K = 16
+NEIGHBOR_BLOCK_BYTES = 32 * 1024 * 1024
+
+# Optional dense (ANN) mode: LSA embedding size, IVF lists probed per search,
+# and how many dense candidates per wanted neighbor are re-scored exactly.
+DENSE_DIMENSIONS = 128
+DENSE_N_PROBE = 8
+DENSE_RERANK = 10
+
+# Result pages: default and maximum number of products per page
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# `sort` values accepted by search: field and whether it sorts descending.
+# Without a sort, text queries rank by relevance and browsing by id.
+SORT_ORDERS = {
+    'price_asc': ('price', False),
+    'price_desc': ('price', True),
+    'rating_desc': ('rating', True),
+    'rating_asc': ('rating', False),
+}
+
+# Facet buckets: upper bounds of the price buckets and lower bounds of the
+# rating buckets. Hit sets covering less than FACET_SPARSE_FRACTION of the
+# base segment are counted row by row rather than through the bitsets.
+PRICE_FACET_BOUNDS = (25, 50, 100, 250, 500)
+RATING_FACET_BOUNDS = (2.0, 3.0, 4.0, 4.5)
+FACET_SPARSE_FRACTION = 1 / 16
+
+# Batch endpoints: most ids or queries accepted in one request
+MAX_BATCH_SIZE = 100
+
+# Autocomplete: suggestions returned by default and at most, kinds of
+# suggestion, and the number of matching key positions above which a
+# prefix's best suggestions are precomputed rather than ranked per request
+SUGGEST_LIMIT = 8
+MAX_SUGGESTIONS = 20
+SUGGESTION_KINDS = ('category', 'tag', 'product')
+PRODUCT_SUGGESTION = SUGGESTION_KINDS.index('product')
+SUGGEST_SCAN_KEYS = 512
+SUGGEST_TOP = 2 * MAX_SUGGESTIONS
+
+# Typo tolerance: query terms missing from the vocabulary are corrected to
+# a known term within one edit, or two edits from FUZZY_TWO_EDIT_LENGTH
+# characters on. Shorter terms and terms with digits are left alone, and
+# deletions are indexed over the first FUZZY_PREFIX_LENGTH characters only.
+FUZZY_MIN_LENGTH = 4
+FUZZY_TWO_EDIT_LENGTH = 6
+FUZZY_MAX_DISTANCE = 2
+FUZZY_PREFIX_LENGTH = 7
+
+# Session recommendations: share of its weight a view keeps per later view,
+# and the memory bound and idle lifetime in seconds of cached profiles
+SESSION_DECAY = 0.8
+SESSION_CACHE_BYTES = 32 * 1024 * 1024
+SESSION_TTL = 1800
+
+# Query-result cache: approximate memory bound and entry lifetime in seconds
+RESULT_CACHE_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_TTL = 300
+
+# On-disk index layout version, and the environment variable naming a saved
+# index for the server to open instead of indexing the sample catalog.
+INDEX_FORMAT = 9
+INDEX_DIR_ENV = 'SEARCH_INDEX_DIR'
+
+# How the postings store term weights: full precision, float32, or uint8
+# quantized against each product's largest weight. The compact modes also
+# keep the vocabulary as a sorted string blob, keep no per-product term
+# counts (rows are re-analyzed from the catalog text when needed) and store
+# neighbor scores as float16, or uint8 in uint8 mode. At 20k products the
+# index holds about 2.3x (float32) and 3.1x (uint8) fewer bytes than at full
+# precision; the int32 neighbor ids, a fixed NEIGHBOR_K per product, are what
+# keeps the float32 mode short of 3x. The environment variable picks the
+# mode for indexes the server or the CLI builds.
+INDEX_PRECISIONS = ('float64', 'float32', 'uint8')
+INDEX_PRECISION_ENV = 'INDEX_PRECISION'
+
+# Catalog file ingestion: products vectorized per chunk, bad-row messages kept,
+# and the environment variable naming a JSONL/CSV catalog to serve.
+INGEST_CHUNK_SIZE = 10000
+INGEST_MAX_ERRORS = 20
+CATALOG_FILE_ENV = 'CATALOG_FILE'
+
+# Behavior recommendations: weight of each event type, events a session
+# pairs with (and seconds of inactivity that end it), sessions tracked at
+# once, half-life in seconds of co-occurrence scores, partners kept per
+# product, events per ingestion chunk, the share of a blended recommendation
+# score given to co-occurrence, and the environment variables naming an
+# event log to ingest and a saved co-occurrence matrix to serve.
+EVENT_WEIGHTS = {'view': 1.0, 'cart': 3.0, 'purchase': 5.0}
+CO_WINDOW = 20
+CO_SESSION_GAP = 30 * 60
+CO_MAX_SESSIONS = 100000
+CO_HALF_LIFE = 7 * 24 * 3600
+CO_KEEP = 100
+EVENT_CHUNK_SIZE = 200000
+CO_BLEND = 0.5
+EVENT_LOG_ENV = 'EVENT_LOG_FILE'
+CO_INDEX_DIR_ENV = 'CO_INDEX_DIR'
+
+# Incremental updates: compact once the rows appended or retired since the
+# last compaction exceed this share of the base segment.
+COMPACT_FRACTION = 0.1
+COMPACT_MIN_ROWS = 1000
+
+# Catalog layout: core fields get dedicated columns, anything else is kept as
+# JSON, and 'json' holds every product pre-encoded the way the API serves it
+PRODUCT_FIELDS = ('id', 'name', 'category', 'price', 'rating', 'description', 'tags', 'image')
+TEXT_FIELDS = ('name', 'description', 'image', 'tags', 'extra', 'json')
+TAG_SEPARATOR = '\x1f'
+
+# Production serving: pre-forked worker processes, or an asyncio front end
+# that runs requests on a bounded thread pool and sheds load with 503 once
+# ASYNC_MAX_PENDING requests are already waiting for a thread
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = int(os.environ.get('PORT', 5000))
+ASYNC_THREADS = 8
+ASYNC_MAX_PENDING = 64
+WORKER_SHUTDOWN_TIMEOUT = 30
+
+# Seconds clients are told to wait (Retry-After) while the index warms up
+STARTUP_RETRY_AFTER = 1
+
+# Latency histogram buckets (seconds) for /metrics, and the slow-query log
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_MS', 250)) / 1000
+SLOW_QUERY_LOG_SIZE = 100
+
+def top_k_indices(scores, k):
+    """Return the indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+def rank_hits(scores, ids, k):
+    """Indices of the k best hits, by score (highest first) and then by id.
+    
+    With scores None (no text query) hits are ranked by id alone. Only the
+    k best are sorted; everything else is discarded by a partial partition.
+    """
+    k = min(k, len(ids))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if scores is None:
+        candidates = np.argpartition(ids, k - 1)[:k] if k < len(ids) else np.arange(len(ids))
+        return candidates[np.argsort(ids[candidates], kind='stable')]
+    if k < len(scores):
+        # Keep every hit tied with the k-th best score so ties break on id
+        kth_best = -np.partition(-scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(scores >= kth_best)
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((ids[candidates], -scores[candidates]))
+    return candidates[order[:k]]
+
+def top_k_per_row(scores, k, ids, mask=None):
+    """Best k positive entries of every row of a sparse score matrix.
+    
+    Entries are ranked like rank_hits (score, then id) for all rows at once
+    with a single lexsort over the non-zeros, instead of a loop per row.
+    Columns excluded by `mask` are dropped first. Returns a list of
+    (columns, scores) per row and the number of allowed hits per row.
+    """
+    scores = scores.tocsr()
+    n_rows = scores.shape[0]
+    row_of = np.repeat(np.arange(n_rows), np.diff(scores.indptr))
+    cols, data = scores.indices, scores.data
+    keep = data > 0
+    if mask is not None:
+        keep &= mask[cols]
+    row_of, cols, data = row_of[keep], cols[keep], data[keep]
+    
+    order = np.lexsort((ids[cols], -data, row_of))
+    row_of, cols, data = row_of[order], cols[order], data[order]
+    totals = np.bincount(row_of, minlength=n_rows)
+    starts = np.cumsum(totals) - totals
+    top = (np.arange(len(row_of)) - starts[row_of]) < k
+    
+    bounds = np.cumsum(np.minimum(totals, k))[:-1]
+    return list(zip(np.split(cols[top], bounds), np.split(data[top], bounds))), totals
+
+def encode_cursor(score, product_id):
+    """Opaque cursor pointing just past the result with this score and id"""
+    return base64.urlsafe_b64encode(json.dumps([score, product_id]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError for a malformed cursor"""
+    try:
+        score, product_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor')
+    if not isinstance(product_id, int) or not (score is None or isinstance(score, (int, float))):
+        raise ValueError('invalid cursor')
+    return score, product_id
+
+def text_analyzer():
+    """Tokenizer shared by every index: TfidfVectorizer's, with English stop words"""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    return TfidfVectorizer(stop_words='english').build_analyzer()
+
+def shard_of(product_id, n_shards):
+    """Shard owning a product; Fibonacci hashing spreads clustered ids evenly"""
+    return ((int(product_id) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) * n_shards >> 64
+
+def product_text(product):
+    """Text that is indexed for a product"""
+    return f"{product['name']} {product['description']} {product['category']} {' '.join(product['tags'])}"
+
+def suggest_key(text):
+    """Autocomplete key: lowercased, with runs of whitespace collapsed"""
+    return ' '.join(text.lower().split())
+
+def word_starts(key):
+    """Byte offsets at which the words of an encoded key start"""
+    return [0] + [match.end() for match in re.finditer(b' ', key)]
+
+def suggestion_texts(catalog, row):
+    """(kind, text) of every suggestion a product contributes"""
+    return ([(0, catalog.field(row, 'category'))] + [(1, tag) for tag in catalog.field(row, 'tags')] +
+            [(PRODUCT_SUGGESTION, catalog.field(row, 'name'))])
+
+def count_terms(texts, vocabulary, analyzer, n_terms=None):
+    """Turn texts into a CSR matrix of raw term counts.
+    
+    New terms are appended to `vocabulary` unless `n_terms` is given, in
+    which case the vocabulary is treated as read-only and terms with an id of
+    n_terms or above (added after that snapshot was taken) are ignored.
+    """
+    indptr, indices, data = [0], [], []
+    for text in texts:
+        if n_terms is None:
+            term_ids = [vocabulary.setdefault(term, len(vocabulary)) for term in analyzer(text)]
+        else:
+            term_ids = [vocabulary.get(term, n_terms) for term in analyzer(text)]
+            term_ids = [term_id for term_id in term_ids if term_id < n_terms]
+        term_counts = Counter(term_ids)
+        indices.extend(term_counts.keys())
+        data.extend(term_counts.values())
+        indptr.append(len(indices))
+    
+    width = len(vocabulary) if n_terms is None else n_terms
+    counts = sp.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int32), np.array(indptr)),
+                           shape=(len(indptr) - 1, width))
+    counts.sort_indices()
+    return counts
+
+def read_catalog_rows(path):
+    """Stream raw product rows from a .jsonl or .csv file, one at a time.
+    
+    Yields (line number, row). Unparseable JSON lines are yielded as None so
+    they can be counted as bad rows.
+    """
+    if path.endswith('.csv'):
+        with open(path, newline='', encoding='utf-8') as f:
+            for line_no, row in enumerate(csv.DictReader(f), start=2):
+                yield line_no, row
+    else:
+        with open(path, encoding='utf-8') as f:
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_no, json.loads(line)
+                except json.JSONDecodeError:
+                    yield line_no, None
+
+def normalize_product(row):
+    """Validate and coerce a raw row into a product dict; raises ValueError.
+    
+    CSV rows carry tags as one '|'-separated string.
+    """
+    if not isinstance(row, Mapping):
+        raise ValueError('not a JSON object')
+    try:
+        # int() would truncate 1.7 into another product's id, and bools are ints
+        if isinstance(row['id'], bool) or (isinstance(row['id'], float) and not row['id'].is_integer()):
+            raise ValueError(f"id {row['id']!r} is not an integer")
+        product = {
+            'id': int(row['id']),
+            'name': str(row['name']).strip(),
+            'category': str(row['category']).strip(),
+            'price': float(row['price']),
+            'rating': float(row.get('rating') or 0),
+            'description': str(row.get('description') or '').strip(),
+            'tags': row.get('tags') or [],
+            'image': str(row.get('image') or ''),
+        }
+    except KeyError as e:
+        raise ValueError(f'missing field {e}')
+    except (TypeError, ValueError) as e:
+        raise ValueError(str(e))
+    if isinstance(product['tags'], str):
+        product['tags'] = [tag.strip() for tag in product['tags'].split('|') if tag.strip()]
+    if not isinstance(product['tags'], list):
+        raise ValueError('tags must be a list')
+    product['tags'] = [str(tag) for tag in product['tags']]
+    if not product['name'] or not product['category']:
+        raise ValueError('empty name or category')
+    if not (product['price'] >= 0 and 0 <= product['rating'] <= 5):
+        raise ValueError('price or rating out of range')
+    return product
+
+def valid_products(rows, stats):
+    """Normalize streamed rows, skipping (and counting) bad and duplicate ones"""
+    seen = set()
+    for line_no, row in rows:
+        stats['rows'] += 1
+        try:
+            product = normalize_product(row)
+            if product['id'] in seen:
+                raise ValueError(f"duplicate id {product['id']}")
+        except ValueError as e:
+            stats['skipped'] += 1
+            if len(stats['errors']) < INGEST_MAX_ERRORS:
+                stats['errors'].append(f'line {line_no}: {e}')
+            continue
+        seen.add(product['id'])
+        yield product
+
+def parse_event(line):
+    """(timestamp, session, product id, weight) of a JSON event line; raises ValueError"""
+    try:
+        event = json.loads(line)
+        weight = EVENT_WEIGHTS.get(event['event'])
+        if weight is None:
+            raise ValueError(f"unknown event {event['event']!r}")
+        return float(event['ts']), str(event['session']), int(event['product_id']), weight
+    except KeyError as e:
+        raise ValueError(f'missing field {e}')
+    except TypeError as e:
+        raise ValueError(str(e))
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def catalog_record(product):
+    """The product as the catalog stores it.
+    
+    Core fields are coerced to their column types and optional ones
+    defaulted, extra fields are kept as they are, and a `similarity_score`
+    left over from a search result is dropped.
+    """
+    record = {
+        'id': int(product['id']),
+        'name': product['name'],
+        'category': product['category'],
+        'price': float(product['price']),
+        'rating': float(product['rating']),
+        'description': product.get('description') or '',
+        'tags': list(product.get('tags') or []),
+        'image': product.get('image') or '',
+    }
+    record.update((field, value) for field, value in product.items()
+                  if field not in PRODUCT_FIELDS and field != 'similarity_score')
+    return record
+
+def product_json(product):
+    """Compact JSON bytes of a product, keys sorted like jsonify sorts them"""
+    return json.dumps(product, sort_keys=True, separators=(',', ':')).encode()
+
+def encode_json(value):
+    """JSON bytes for an API response, splicing in pre-encoded products.
+    
+    ProductView values contribute their catalog fragment, so only the
+    envelope and per-request fields such as scores are encoded per call.
+    """
+    if isinstance(value, ProductView):
+        return value.json_bytes()
+    if isinstance(value, dict):
+        return b'{' + b','.join(json.dumps(str(key)).encode() + b':' + encode_json(item)
+                                for key, item in value.items()) + b'}'
+    if isinstance(value, (list, tuple)):
+        return b'[' + b','.join(encode_json(item) for item in value) + b']'
+    return json.dumps(value, separators=(',', ':')).encode()
+
+def facet_buckets(bounds, under, between, above):
+    """Label and [min, max) range of every bucket cut by `bounds`"""
+    edges = [None] + list(bounds) + [None]
+    buckets = []
+    for low, high in zip(edges, edges[1:]):
+        if low is None:
+            label = under.format(high)
+        elif high is None:
+            label = above.format(low)
+        else:
+            label = between.format(low, high)
+        buckets.append({'label': label, 'min': low, 'max': high})
+    return buckets
+
+PRICE_FACETS = facet_buckets(PRICE_FACET_BOUNDS, 'Under ${}', '${} - ${}', '${} & above')
+RATING_FACETS = facet_buckets(RATING_FACET_BOUNDS, 'Under {}', '{} - {}', '{} & up')
+
+# Set bits per byte, for NumPy versions without bitwise_count
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(bits):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(bits)
+    return POPCOUNT_TABLE[bits]
+
+def smooth_idf(doc_freq, n_docs):
+    """Inverse document frequency, as TfidfVectorizer computes it with smooth_idf=True"""
+    return np.log((1 + n_docs) / (1 + doc_freq)) + 1
+
+def l2_normalize_rows(matrix):
+    """Scale every row of a sparse matrix to unit length (empty rows stay empty)"""
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return (sp.diags(1 / norms) @ matrix).tocsr()
+
+def quantize_rows(matrix):
+    """uint8 copy of a CSR matrix of non-negative weights, plus one scale per row.
+    
+    Every weight is rounded to a 255th of its row's largest weight, but at
+    least one, so no stored weight becomes zero; the weight is recovered as
+    the stored value times the row's scale.
+    """
+    lengths = np.diff(matrix.indptr)
+    peaks = np.zeros(matrix.shape[0])
+    nonempty = lengths > 0
+    peaks[nonempty] = np.maximum.reduceat(matrix.data, matrix.indptr[:-1][nonempty])
+    levels = np.rint(matrix.data / np.repeat(peaks, lengths) * 255)
+    quantized = sp.csr_matrix((np.clip(levels, 1, 255).astype(np.uint8), matrix.indices, matrix.indptr),
+                              shape=matrix.shape)
+    return quantized, (peaks / 255).astype(np.float32)
+
+def sorted_vocabulary(vocabulary, n_terms):
+    """The first n_terms terms as a FrozenVocabulary, and each term id's new id.
+    
+    Terms are renumbered into UTF-8 byte order, the order a FrozenVocabulary
+    assigns ids in.
+    """
+    terms = sorted((term for term, term_id in vocabulary.items() if term_id < n_terms), key=lambda term: term.encode())
+    remap = np.empty(n_terms, dtype=np.int32)
+    remap[[vocabulary.get(term) for term in terms]] = np.arange(len(terms), dtype=np.int32)
+    return FrozenVocabulary.from_terms(terms), remap
+
+def remap_columns(matrix, remap):
+    """CSR matrix with column j moved to remap[j]"""
+    matrix = sp.csr_matrix((matrix.data, remap[matrix.indices], matrix.indptr), shape=matrix.shape)
+    matrix.sort_indices()
+    return matrix
+
+def prune_rows(matrix, k):
+    """Keep only the k largest entries of every row of a CSR matrix"""
+    lengths = np.diff(matrix.indptr)
+    if len(lengths) == 0 or lengths.max() <= k:
+        return matrix
+    row_of = np.repeat(np.arange(matrix.shape[0]), lengths)
+    order = np.lexsort((-matrix.data, row_of))
+    keep = np.sort(order[np.arange(len(order)) - matrix.indptr[row_of[order]] < k])
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.minimum(lengths, k), out=indptr[1:])
+    return sp.csr_matrix((matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
+
+def write_array_dir(path, arrays, meta):
+    """Write arrays as .npy files plus meta.json, replacing `path` only once complete"""
+    staging = path.rstrip('/') + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for name, values in arrays.items():
+        np.save(os.path.join(staging, name + '.npy'), np.ascontiguousarray(values))
+    with open(os.path.join(staging, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    
+    retired = path.rstrip('/') + '.old'
+    shutil.rmtree(retired, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, retired)
+    os.rename(staging, path)
+    shutil.rmtree(retired, ignore_errors=True)
+
+def _widen(matrix, n_cols):
+    """View a CSR matrix with extra (empty) trailing columns"""
+    if matrix.shape[1] == n_cols:
+        return matrix
+    return sp.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], n_cols))
+
+def deep_sizeof(value, seen=None):
+    """Approximate memory held by a structure of dicts, lists and scalars"""
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_sizeof(item, seen) for item in value)
+    return size
+
+class ResultCache:
+    """Thread-safe LRU cache bounded by approximate size and entry age.
+    
+    Every entry is tagged with the index version it was computed from. A
+    lookup under another version is a miss, and the first store under a newer
+    version drops everything older, so catalog updates invalidate the cache
+    without any explicit call. Cached values are shared and must not be
+    mutated by callers.
+    """
+    
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, ttl=RESULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+    
+    def get(self, key, version):
+        """Cached value for key under this index version, or None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            entry_version, expires_at, size, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key, version, value):
+        size = deep_sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._entries.clear()
+                self._bytes = 0
+                self._version = version
+            elif version < self._version:
+                # Computed from a snapshot that has been replaced meanwhile
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[2]
+            self._entries[key] = (version, time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+                self.evictions += 1
+    
+    def get_or_compute(self, key, version, compute):
+        value = self.get(key, version)
+        if value is None:
+            value = compute()
+            self.put(key, version, value)
+        return value
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'version': self._version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+class Histogram:
+    """Prometheus-style latency histogram, one series per label tuple"""
+    
+    def __init__(self, name, description, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value, *labels):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then the sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bucket] += 1
+            series[-1] += value
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(counts)) for labels, counts in self._series.items())
+        for labels, counts in series:
+            base = _prometheus_labels(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{base},le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{base}}} {counts[-1]!r}')
+            lines.append(f'{self.name}_count{{{base}}} {cumulative}')
+        return lines
+
+def _prometheus_labels(pairs):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in pairs)
+
+class Trace:
+    """Stage timings of one operation or request, collected per thread"""
+    
+    __slots__ = ('operation', 'details', 'stages', 'started')
+    
+    def __init__(self, operation, details):
+        self.operation = operation
+        self.details = details
+        self.stages = {}
+        self.started = time.perf_counter()
+
+_traces = threading.local()
+
+class timed:
+    """Add the time spent in the block to a stage of the current trace.
+    
+    A no-op outside a trace; stages entered repeatedly accumulate.
+    """
+    
+    __slots__ = ('stage', 'started')
+    
+    def __init__(self, stage):
+        self.stage = stage
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+    
+    def __exit__(self, *exc_info):
+        trace = getattr(_traces, 'current', None)
+        if trace is not None:
+            trace.stages[self.stage] = trace.stages.get(self.stage, 0.0) + time.perf_counter() - self.started
+
+class SearchMetrics:
+    """Operation and stage latency histograms plus a slow-query log.
+    
+    An operation (a route or a direct API call) opens a trace, the stages
+    inside it add their time with `timed`, and on completion every stage is
+    observed and the whole trace is logged when it took longer than
+    `slow_seconds`. Nested operations report into the outer trace. Each
+    process keeps its own metrics.
+    """
+    
+    def __init__(self, slow_seconds=SLOW_QUERY_SECONDS, slow_log_size=SLOW_QUERY_LOG_SIZE):
+        self.operations = Histogram('search_operation_seconds', 'Latency of routes and search calls.',
+                                    ('operation',))
+        self.stages = Histogram('search_stage_seconds', 'Time spent in each stage of an operation.',
+                                ('operation', 'stage'))
+        self.slow_seconds = slow_seconds
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self.slow_log = logging.getLogger(__name__ + '.slow_queries')
+    
+    def begin(self, operation, details):
+        """Open a trace unless one is running; returns the trace this call owns"""
+        if getattr(_traces, 'current', None) is not None:
+            return None
+        trace = _traces.current = Trace(operation, details)
+        return trace
+    
+    def end(self, trace):
+        if trace is None:
+            return
+        _traces.current = None
+        total = time.perf_counter() - trace.started
+        self.operations.observe(total, trace.operation)
+        for stage, seconds in trace.stages.items():
+            self.stages.observe(seconds, trace.operation, stage)
+        if total >= self.slow_seconds:
+            entry = {
+                'operation': trace.operation,
+                'ms': round(total * 1000, 3),
+                'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in trace.stages.items()},
+                **trace.details,
+            }
+            self.slow_queries.append(entry)
+            self.slow_log.warning('slow %s: %s', trace.operation, json.dumps(entry, default=str))
+    
+    @contextmanager
+    def traced(self, operation, **details):
+        trace = self.begin(operation, details)
+        try:
+            yield
+        finally:
+            self.end(trace)
+    
+    def render(self, search, caches):
+        """Prometheus text exposition of the histograms, index size and caches"""
+        index = search.index
+        lines = self.operations.render() + self.stages.render()
+        gauges = [
+            ('search_index_version', 'Version of the published index snapshot.', index.version),
+            ('search_index_rows', 'Rows in the snapshot, retired ones included.', index.n_rows),
+            ('search_index_live_products', 'Products that can be returned.', index.n_rows - index.n_dead),
+            ('search_index_delta_rows', 'Rows appended since the last compaction.', index.n_rows - index.n_base),
+            ('search_index_terms', 'Terms in the vocabulary.', index.n_terms),
+            ('search_catalog_bytes', 'Bytes held by the stored catalog columns.', index.products.nbytes),
+            ('search_index_bytes', 'Bytes held by the vocabulary, postings and neighbor tables.', index.nbytes),
+        ]
+        for name, description, value in gauges:
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} gauge', f'{name} {value}']
+        
+        stats = {name: cache.stats() for name, cache in caches.items()}
+        for field, kind in (('entries', 'gauge'), ('bytes', 'gauge'), ('hits', 'counter'), ('misses', 'counter'),
+                            ('evictions', 'counter'), ('expirations', 'counter')):
+            name = f'search_cache_{field}' + ('_total' if kind == 'counter' else '')
+            lines += [f'# HELP {name} Result cache {field}.', f'# TYPE {name} {kind}']
+            lines += [f'{name}{{{_prometheus_labels([("cache", cache)])}}} {values[field]}'
+                      for cache, values in stats.items()]
+        return '\n'.join(lines) + '\n'
+
+metrics = SearchMetrics()
+
+class FrozenVocabulary:
+    """Term -> id mapping over a sorted blob of UTF-8 terms.
+    
+    The term with sorted position i has id i and lookups binary-search the
+    offsets, so a saved vocabulary can be memory-mapped and used without
+    building a dict. Terms added afterwards go to a small overflow dict and
+    take the ids that follow the frozen ones.
+    """
+    
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+        self._size = len(offsets) - 1
+        self._extra = {}
+    
+    @classmethod
+    def from_terms(cls, terms):
+        """Build from terms that are already sorted by their UTF-8 bytes"""
+        encoded = [term.encode() for term in terms]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+    
+    def _term_bytes(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes()
+    
+    def get(self, term, default=None):
+        key = term.encode()
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._size and self._term_bytes(lo) == key:
+            return lo
+        return self._extra.get(term, default)
+    
+    def copy(self):
+        """Copy that shares the frozen terms but not the overflow dict"""
+        vocabulary = copy.copy(self)
+        vocabulary._extra = dict(self._extra)
+        return vocabulary
+    
+    def setdefault(self, term, default):
+        term_id = self.get(term)
+        if term_id is None:
+            term_id = self._extra.setdefault(term, default)
+        return term_id
+    
+    def __contains__(self, term):
+        return self.get(term) is not None
+    
+    def __len__(self):
+        return self._size + len(self._extra)
+    
+    def items(self):
+        for i in range(self._size):
+            yield self._term_bytes(i).decode(), i
+        yield from list(self._extra.items())
+    
+    @property
+    def nbytes(self):
+        return self._blob.nbytes + self._offsets.nbytes + deep_sizeof(self._extra)
+
+class IdIndex:
+    """Open-addressing hash table from product id to row.
+    
+    Slots hold rows (-1 when empty) and keys are checked against the id
+    column itself, so the table costs two int32 slots per product and
+    lookups stay O(1) without a Python dict. It is built with vectorized
+    linear probing and can be saved and memory-mapped like any array.
+    """
+    
+    _MULTIPLIER = 0x9E3779B97F4A7C15
+    
+    def __init__(self, ids, slots=None):
+        self.ids = ids
+        self.slots = self._build(ids) if slots is None else slots
+        self._mask = len(self.slots) - 1
+        self._shift = 65 - len(self.slots).bit_length()
+    
+    @classmethod
+    def _build(cls, ids):
+        size = 8
+        while size < 2 * len(ids):
+            size *= 2
+        slots = np.full(size, -1, dtype=np.int32 if len(ids) < 2 ** 31 else np.int64)
+        shift = np.uint64(65 - size.bit_length())
+        pending = np.arange(len(ids))
+        positions = (np.asarray(ids).astype(np.uint64) * np.uint64(cls._MULTIPLIER)) >> shift
+        positions = positions.astype(np.int64)
+        while len(pending):
+            free = np.flatnonzero(slots[positions] == -1)
+            # Among ids competing for the same free slot, the first one wins
+            taken, first = np.unique(positions[free], return_index=True)
+            slots[taken] = pending[free[first]]
+            placed = np.zeros(len(pending), dtype=bool)
+            placed[free[first]] = True
+            pending = pending[~placed]
+            positions = (positions[~placed] + 1) & (size - 1)
+        return slots
+    
+    def get(self, product_id, default=None):
+        slot = ((int(product_id) * self._MULTIPLIER) & 0xFFFFFFFFFFFFFFFF) >> self._shift
+        while True:
+            row = int(self.slots[slot])
+            if row < 0:
+                return default
+            if self.ids[row] == int(product_id):
+                return row
+            slot = (slot + 1) & self._mask
+
+class TextColumn:
+    """Strings stored back to back in one UTF-8 blob and addressed by offsets"""
+    
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, row):
+        return self.raw(row).decode()
+    
+    def raw(self, row):
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes()
+    
+    @property
+    def nbytes(self):
+        return self.blob.nbytes + self.offsets.nbytes
+    
+    def take(self, rows):
+        """Column holding only the given rows, gathered without a Python loop"""
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return TextColumn(self.blob[gather], offsets)
+    
+    @staticmethod
+    def concat(first, second):
+        offsets = np.concatenate([first.offsets, second.offsets[1:] + first.offsets[-1]])
+        return TextColumn(np.concatenate([first.blob, second.blob]), offsets)
+    
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string if isinstance(string, bytes) else string.encode() for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+class CatalogBuilder:
+    """Accumulates products one at a time into the Catalog layout"""
+    
+    def __init__(self, category_names=()):
+        self.ids = array.array('q')
+        self.prices = array.array('d')
+        self.ratings = array.array('d')
+        self.category_codes = array.array('i')
+        self.category_names = list(category_names)
+        self.category_lookup = {name.lower(): code for code, name in enumerate(self.category_names)}
+        self.blobs = {field: bytearray() for field in TEXT_FIELDS}
+        self.offsets = {field: array.array('q', [0]) for field in TEXT_FIELDS}
+    
+    def add(self, product):
+        record = catalog_record(product)
+        extra = {field: value for field, value in record.items() if field not in PRODUCT_FIELDS}
+        self.ids.append(record['id'])
+        self.prices.append(record['price'])
+        self.ratings.append(record['rating'])
+        code = self.category_code(record['category'])
+        # Spelled the way the category column reads it back
+        record['category'] = self.category_names[code]
+        self.category_codes.append(code)
+        texts = {
+            'name': record['name'].encode(),
+            'description': record['description'].encode(),
+            'image': record['image'].encode(),
+            'tags': TAG_SEPARATOR.join(record['tags']).encode(),
+            'extra': json.dumps(extra).encode() if extra else b'',
+            'json': product_json(record),
+        }
+        for field, text in texts.items():
+            self.blobs[field] += text
+            self.offsets[field].append(len(self.blobs[field]))
+    
+    def category_code(self, category):
+        key = category.lower()
+        if key not in self.category_lookup:
+            self.category_lookup[key] = len(self.category_names)
+            self.category_names.append(category)
+        return self.category_lookup[key]
+    
+    def build(self):
+        texts = {field: TextColumn(np.frombuffer(bytes(self.blobs[field]), dtype=np.uint8),
+                                   np.array(self.offsets[field], dtype=np.int64))
+                 for field in TEXT_FIELDS}
+        return Catalog(np.array(self.ids, dtype=np.int64), np.array(self.prices, dtype=np.float64),
+                       np.array(self.ratings, dtype=np.float64), np.array(self.category_codes, dtype=np.int32),
+                       self.category_names, texts)
+
+class Catalog:
+    """Columnar, read-only product store with an O(1) id -> row index.
+    
+    Numeric fields are NumPy columns, the category is an int code and the
+    text fields are UTF-8 blobs with offsets, so a product costs little more
+    than its bytes instead of a dict plus an object per field. Rows are
+    handed out as ProductView. Products appended later stay plain dicts
+    (plus their encoded JSON) behind the stored rows, with their numeric
+    columns extended, until the catalog is rebuilt by take() at compaction;
+    the id index only covers the stored rows.
+    """
+    
+    def __init__(self, ids, prices, ratings, category_codes, category_names, texts, id_index=None, appended=(),
+                 appended_json=()):
+        self.ids = ids
+        self.prices = prices
+        self.ratings = ratings
+        self.category_codes = category_codes
+        self.category_names = category_names
+        self.category_lookup = {name.lower(): code for code, name in enumerate(category_names)}
+        self.texts = texts
+        self.n_stored = len(texts['name'])
+        self.appended = list(appended)
+        self.appended_json = list(appended_json)
+        self.id_index = IdIndex(ids) if id_index is None else id_index
+    
+    @classmethod
+    def from_products(cls, products):
+        builder = CatalogBuilder()
+        for product in products:
+            builder.add(product)
+        return builder.build()
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __getitem__(self, row):
+        return ProductView(self, row)
+    
+    def __iter__(self):
+        return (ProductView(self, row) for row in range(len(self)))
+    
+    @property
+    def nbytes(self):
+        """Bytes held by the stored rows' arrays, id index included"""
+        arrays = (self.ids, self.prices, self.ratings, self.category_codes, self.id_index.slots)
+        return sum(a.nbytes for a in arrays) + sum(column.nbytes for column in self.texts.values())
+    
+    def field(self, row, name):
+        if row >= self.n_stored:
+            return self.appended[row - self.n_stored][name]
+        if name == 'id':
+            return int(self.ids[row])
+        if name == 'name' or name == 'description' or name == 'image':
+            return self.texts[name][row]
+        if name == 'category':
+            return self.category_names[self.category_codes[row]]
+        if name == 'price':
+            return float(self.prices[row])
+        if name == 'rating':
+            return float(self.ratings[row])
+        if name == 'tags':
+            tags = self.texts['tags'][row]
+            return tags.split(TAG_SEPARATOR) if tags else []
+        extra = self.texts['extra'][row]
+        return (json.loads(extra) if extra else {})[name]
+    
+    def json_bytes(self, row):
+        """The row's product as pre-encoded JSON"""
+        if row >= self.n_stored:
+            return self.appended_json[row - self.n_stored]
+        return self.texts['json'].raw(row)
+    
+    def fields(self, row):
+        if row >= self.n_stored:
+            return list(self.appended[row - self.n_stored])
+        extra = self.texts['extra'][row]
+        return list(PRODUCT_FIELDS) + (list(json.loads(extra)) if extra else [])
+    
+    def append(self, products):
+        """New catalog with products (dicts) added after the existing rows.
+        
+        Products are normalized like CatalogBuilder.add normalizes them, so
+        appended rows read and serialize exactly as they will once compacted.
+        """
+        builder = CatalogBuilder(self.category_names)
+        products = [catalog_record(product) for product in products]
+        codes = [builder.category_code(product['category']) for product in products]
+        for product, code in zip(products, codes):
+            product['category'] = builder.category_names[code]
+        return Catalog(
+            np.concatenate([self.ids, np.array([product['id'] for product in products], dtype=np.int64)]),
+            np.concatenate([self.prices, np.array([product['price'] for product in products], dtype=np.float64)]),
+            np.concatenate([self.ratings, np.array([product['rating'] for product in products], dtype=np.float64)]),
+            np.concatenate([self.category_codes, np.array(codes, dtype=np.int32)]),
+            builder.category_names, self.texts, self.id_index, self.appended + list(products),
+            self.appended_json + [product_json(product) for product in products]
+        )
+    
+    def take(self, rows):
+        """Compact catalog holding the given rows (ascending), appended rows folded in"""
+        rows = np.asarray(rows)
+        stored = rows[rows < self.n_stored]
+        builder = CatalogBuilder(self.category_names)
+        for row in rows[rows >= self.n_stored]:
+            builder.add(self.appended[row - self.n_stored])
+        tail = builder.build()
+        texts = {field: TextColumn.concat(column.take(stored), tail.texts[field])
+                 for field, column in self.texts.items()}
+        return Catalog(
+            np.concatenate([self.ids[stored], tail.ids]),
+            np.concatenate([self.prices[stored], tail.prices]),
+            np.concatenate([self.ratings[stored], tail.ratings]),
+            np.concatenate([self.category_codes[stored], tail.category_codes]),
+            tail.category_names, texts
+        )
+    
+    def arrays(self):
+        """Arrays that save() writes and load() memory-maps"""
+        arrays = {
+            'ids': self.ids,
+            'id_slots': self.id_index.slots,
+            'prices': self.prices,
+            'ratings': self.ratings,
+            'category_codes': self.category_codes,
+        }
+        for field, column in self.texts.items():
+            arrays[f'{field}_blob'] = column.blob
+            arrays[f'{field}_offsets'] = column.offsets
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, mapped, category_names):
+        texts = {field: TextColumn(mapped(f'{field}_blob'), mapped(f'{field}_offsets')) for field in TEXT_FIELDS}
+        ids = mapped('ids')
+        return cls(ids, mapped('prices'), mapped('ratings'), mapped('category_codes'), list(category_names), texts,
+                   IdIndex(ids, mapped('id_slots')))
+
+class ProductView(Mapping):
+    """Read-only view of one catalog row, decoded field by field on access.
+    
+    It behaves like the product dict, plus `similarity_score` for search
+    hits, without copying anything; dict(view) gives a mutable copy.
+    """
+    
+    __slots__ = ('_catalog', '_row', '_score')
+    
+    def __init__(self, catalog, row, score=None):
+        self._catalog = catalog
+        self._row = row
+        self._score = score
+    
+    def __getitem__(self, field):
+        if field == 'similarity_score' and self._score is not None:
+            return self._score
+        return self._catalog.field(self._row, field)
+    
+    def __iter__(self):
+        yield from self._catalog.fields(self._row)
+        if self._score is not None:
+            yield 'similarity_score'
+    
+    def __len__(self):
+        return len(self._catalog.fields(self._row)) + (self._score is not None)
+    
+    def to_dict(self):
+        return dict(self)
+    
+    def json_bytes(self, with_score=True):
+        """JSON of the product with the score spliced into its cached encoding"""
+        encoded = self._catalog.json_bytes(self._row)
+        if self._score is None or not with_score:
+            return encoded
+        return encoded[:-1] + b',"similarity_score":' + json.dumps(self._score).encode() + b'}'
+    
+    copy = to_dict
+    
+    def __repr__(self):
+        return f'ProductView({self.to_dict()!r})'
+
+def measure_catalog_memory(products):
+    """Bytes per product held as a list of dicts versus as a Catalog.
+    
+    Both layouts are built from fresh copies of the products and measured
+    with tracemalloc.
+    """
+    encoded = [json.dumps(product) for product in products]
+    
+    tracemalloc.start()
+    as_dicts = [json.loads(record) for record in encoded]
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    tracemalloc.start()
+    catalog = Catalog.from_products(as_dicts)
+    catalog_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    n = max(1, len(products))
+    return {
+        'products': len(products),
+        'dict_bytes_per_product': dict_bytes / n,
+        'catalog_bytes_per_product': catalog_bytes / n,
+        'catalog_array_bytes_per_product': catalog.nbytes / n,
+        'reduction': dict_bytes / catalog_bytes if catalog_bytes else 0.0,
+    }
+
+class IvfIndex:
+    """Approximate nearest neighbors over dense LSA embeddings of TF-IDF rows.
+    
+    TruncatedSVD projects every row to a few float32 components, and an
+    inverted-file index assigns each row to its closest of `n_lists`
+    spherical k-means centroids. A search only scans the rows of the
+    `n_probe` lists closest to the query, so n_probe trades recall for
+    latency; measure_ann_recall() reports what a setting buys. The best
+    `rerank` x k dense candidates are re-scored with the exact sparse cosine.
+    """
+    
+    def __init__(self, matrix, dimensions=DENSE_DIMENSIONS, n_lists=None, n_probe=DENSE_N_PROBE,
+                 rerank=DENSE_RERANK, iterations=10, seed=0):
+        n = matrix.shape[0]
+        rng = np.random.default_rng(seed)
+        self.matrix = matrix
+        self.n_probe = n_probe
+        self.rerank = rerank
+        
+        dimensions = min(dimensions, matrix.shape[1] - 1, n - 1)
+        if dimensions >= 1:
+            from sklearn.decomposition import TruncatedSVD
+            self.svd = TruncatedSVD(dimensions, random_state=seed)
+            embeddings = self.svd.fit_transform(matrix).astype(np.float32)
+        else:
+            self.svd = None
+            embeddings = np.zeros((n, 1), dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.embeddings = embeddings / np.maximum(norms, 1e-12)
+        
+        # Spherical k-means on a sample is enough to place the centroids
+        n_lists = max(1, min(n, n_lists or int(sqrt(n))))
+        sample = self.embeddings[rng.choice(n, min(n, 256 * n_lists), replace=False)] if n else self.embeddings
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)] if n else np.zeros((1, self.embeddings.shape[1]), dtype=np.float32)
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        self.centroids = centroids.astype(np.float32)
+        
+        assignment = np.empty(n, dtype=np.int32)
+        block_rows = max(1, NEIGHBOR_BLOCK_BYTES // (len(self.centroids) * 4))
+        for start in range(0, n, block_rows):
+            block = self.embeddings[start:start + block_rows]
+            assignment[start:start + block_rows] = np.argmax(block @ self.centroids.T, axis=1)
+        self.list_rows = np.argsort(assignment, kind='stable').astype(np.int32)
+        self.list_offsets = np.searchsorted(assignment[self.list_rows], np.arange(len(self.centroids) + 1))
+    
+    def search(self, rows, k, allowed, n_probe=None, rerank=None):
+        """Approximate top-k neighbors of indexed rows, padded with -1.
+        
+        Only rows where `allowed` is True can be returned, and a row is
+        never its own neighbor. Scores are exact TF-IDF cosines, or cosines
+        between embeddings when rerank is 0.
+        """
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        rerank = self.rerank if rerank is None else rerank
+        neighbor_ids = np.full((len(rows), k), -1, dtype=np.int32)
+        neighbor_scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+        if len(rows) == 0 or k == 0:
+            return neighbor_ids, neighbor_scores
+        
+        queries = self.embeddings[rows]
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        for i, (row, query) in enumerate(zip(rows, queries)):
+            candidates = np.concatenate([self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]]
+                                         for l in probes[i]])
+            candidates = candidates[allowed[candidates] & (candidates != row)]
+            scores = self.embeddings[candidates] @ query
+            if rerank:
+                candidates = candidates[top_k_indices(scores, rerank * k)]
+                scores = self.matrix[candidates] @ self.matrix[row].toarray().ravel()
+            best = top_k_indices(scores, k)
+            neighbor_ids[i, :len(best)] = candidates[best]
+            neighbor_scores[i, :len(best)] = scores[best]
+        return neighbor_ids, neighbor_scores
+
+class PrefixIndex:
+    """Autocomplete over category names, tags and product names.
+    
+    Each suggestion is stored once, as display text and as a normalized key.
+    A sorted table of (suggestion, byte offset) positions points at every
+    word start of every key, so "head" finds "Wireless Headphones" without
+    storing suffixes as strings, and a prefix is two binary searches over
+    that table. Prefixes matching more than SUGGEST_SCAN_KEYS positions have
+    their best SUGGEST_TOP suggestions precomputed; narrower ranges are
+    ranked on the fly. Suggestions rank by the number of products carrying
+    them, then by the best rating among those products.
+    """
+    
+    def __init__(self, texts, keys, kinds, rows, counts, ratings, targets, starts, prefixes, prefix_top):
+        self.texts = texts
+        self.keys = keys
+        self.kinds = kinds
+        # Product row of a product-name suggestion, -1 for tags and categories
+        self.rows = rows
+        self.counts = counts
+        self.ratings = ratings
+        self.targets = targets
+        self.starts = starts
+        self.prefixes = prefixes
+        self.prefix_top = prefix_top
+    
+    @classmethod
+    def build(cls, catalog, rows):
+        suggestions = {}
+        # Categories and tags repeat across products, so normalize each once
+        normalized = {}
+        for row in rows:
+            rating = float(catalog.ratings[row])
+            for kind, text in suggestion_texts(catalog, row):
+                if kind == PRODUCT_SUGGESTION:
+                    key = suggest_key(text)
+                else:
+                    key = normalized.get(text)
+                    if key is None:
+                        key = normalized[text] = suggest_key(text)
+                if not key:
+                    continue
+                product_row = int(row) if kind == PRODUCT_SUGGESTION else -1
+                entry = suggestions.setdefault((kind, key, product_row), [text, 0, rating])
+                entry[1] += 1
+                entry[2] = max(entry[2], rating)
+        
+        # Ids follow (kind, key, row) order, which is how ranking ties break
+        idents = sorted(suggestions)
+        entries = [suggestions[ident] for ident in idents]
+        keys = TextColumn.from_strings([key for _, key, _ in idents])
+        counts = np.array([entry[1] for entry in entries], dtype=np.int64)
+        ratings = np.array([entry[2] for entry in entries], dtype=np.float64)
+        
+        positions = []
+        for i, (_, key, _) in enumerate(idents):
+            encoded = key.encode()
+            first = int(keys.offsets[i])
+            positions.extend((encoded[start:], i, first + start) for start in word_starts(encoded))
+        positions.sort()
+        suffixes = [position[0] for position in positions]
+        targets = np.array([position[1] for position in positions], dtype=np.int32)
+        index = cls(TextColumn.from_strings([entry[0] for entry in entries]), keys,
+                    np.array([kind for kind, _, _ in idents], dtype=np.uint8),
+                    np.array([row for _, _, row in idents], dtype=np.int64), counts, ratings, targets,
+                    np.array([position[2] for position in positions], dtype=np.int64), None, None)
+        
+        # Walk the byte trie of the sorted suffixes, visiting only the
+        # prefixes whose range is too wide to rank per request
+        heavy = []
+        pending = [(b'', 0, len(suffixes))]
+        while pending:
+            prefix, lo, hi = pending.pop()
+            if hi - lo <= SUGGEST_SCAN_KEYS:
+                continue
+            if prefix:
+                heavy.append((prefix, index._best(targets[lo:hi], SUGGEST_TOP)))
+            lo = bisect_left(suffixes, prefix + b'\x00', lo, hi)
+            while lo < hi:
+                child = suffixes[lo][:len(prefix) + 1]
+                end = bisect_left(suffixes, child + b'\xff', lo, hi)
+                pending.append((child, lo, end))
+                lo = end
+        heavy.sort(key=lambda item: item[0])
+        index.prefixes = TextColumn.from_strings([prefix for prefix, _ in heavy])
+        index.prefix_top = np.full((len(heavy), SUGGEST_TOP), -1, dtype=np.int32)
+        for i, (_, best) in enumerate(heavy):
+            index.prefix_top[i, :len(best)] = best
+        return index
+    
+    def _suffix(self, position):
+        end = self.keys.offsets[self.targets[position] + 1]
+        return self.keys.blob[self.starts[position]:end].tobytes()
+    
+    def _best(self, targets, k):
+        targets = np.unique(targets)
+        return targets[rank_hits(self.counts[targets] + self.ratings[targets] / 10, targets, k)]
+    
+    def candidates(self, prefix):
+        """Ids of the best SUGGEST_TOP suggestions with a word starting with `prefix` (bytes)"""
+        n = len(self.targets)
+        lo = bisect_left(range(n), prefix, key=self._suffix)
+        # No UTF-8 byte is 0xff, so this sorts after every key with the prefix
+        hi = bisect_left(range(n), prefix + b'\xff', lo, key=self._suffix)
+        if hi - lo > SUGGEST_SCAN_KEYS:
+            i = bisect_left(range(len(self.prefixes)), prefix, key=self.prefixes.raw)
+            if i < len(self.prefixes) and self.prefixes.raw(i) == prefix:
+                top = self.prefix_top[i]
+                return top[top >= 0]
+        return self._best(self.targets[lo:hi], SUGGEST_TOP)
+    
+    @property
+    def nbytes(self):
+        arrays = (self.kinds, self.rows, self.counts, self.ratings, self.targets, self.starts, self.prefix_top)
+        return (sum(a.nbytes for a in arrays) + self.texts.nbytes + self.keys.nbytes + self.prefixes.nbytes)
+    
+    def arrays(self):
+        """Arrays that save() writes and load() memory-maps"""
+        arrays = {
+            'suggest_kinds': self.kinds,
+            'suggest_rows': self.rows,
+            'suggest_counts': self.counts,
+            'suggest_ratings': self.ratings,
+            'suggest_targets': self.targets,
+            'suggest_starts': self.starts,
+            'suggest_prefix_top': self.prefix_top,
+        }
+        for name in ('texts', 'keys', 'prefixes'):
+            column = getattr(self, name)
+            arrays[f'suggest_{name}_blob'] = column.blob
+            arrays[f'suggest_{name}_offsets'] = column.offsets
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, mapped):
+        def column(name):
+            return TextColumn(mapped(f'suggest_{name}_blob'), mapped(f'suggest_{name}_offsets'))
+        
+        return cls(column('texts'), column('keys'), mapped('suggest_kinds'), mapped('suggest_rows'),
+                   mapped('suggest_counts'), mapped('suggest_ratings'), mapped('suggest_targets'),
+                   mapped('suggest_starts'), column('prefixes'), mapped('suggest_prefix_top'))
+
+def suggestion_positions(catalog, rows):
+    """Sorted (word suffix, kind, key, text, rating, row) entries of rows, one per word start"""
+    positions = []
+    for row in rows:
+        rating = float(catalog.ratings[row])
+        for kind, text in suggestion_texts(catalog, row):
+            key = suggest_key(text)
+            encoded = key.encode()
+            if key:
+                positions.extend((encoded[start:], kind, key, text, rating, int(row)) for start in word_starts(encoded))
+    positions.sort()
+    return positions
+
+def fuzzy_limit(word):
+    """Most edits allowed when correcting a word, 0 if it is not corrected"""
+    if len(word) < FUZZY_MIN_LENGTH or not word.isalpha():
+        return 0
+    return 1 if len(word) < FUZZY_TWO_EDIT_LENGTH else FUZZY_MAX_DISTANCE
+
+def deletions(word, distance, min_length=0):
+    """The word and every string left by deleting up to `distance` of its characters.
+    
+    Strings are not shortened below min_length.
+    """
+    found = frontier = {word}
+    for _ in range(distance):
+        frontier = {part[:i] + part[i + 1:] for part in frontier if len(part) > min_length for i in range(len(part))}
+        found = found | frontier
+    return found
+
+def letter_mask(word):
+    """32-bit set of the characters in a word, hashed by code point.
+    
+    One edit changes at most two bits, so masks differing in more than
+    2 * d bits belong to words more than d edits apart.
+    """
+    mask = 0
+    for char in set(word):
+        mask |= 1 << (ord(char) & 31)
+    return mask
+
+def edit_distance(a, b, limit):
+    """Edit distance with adjacent transpositions counted as one edit.
+    
+    Returns limit + 1 once the distance is known to exceed limit. Only
+    cells within `limit` of the diagonal can stay within it, so only those
+    are computed.
+    """
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    a, b = a[start:], b[start:]
+    while a and b and a[-1] == b[-1]:
+        a, b = a[:-1], b[:-1]
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    before, previous = None, [j if j <= limit else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [over] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        best = current[0]
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            distance = previous[j - 1] if a[i - 1] == b[j - 1] else previous[j - 1] + 1
+            if previous[j] + 1 < distance:
+                distance = previous[j] + 1
+            if current[j - 1] + 1 < distance:
+                distance = current[j - 1] + 1
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1] and before[j - 2] + 1 < distance:
+                distance = before[j - 2] + 1
+            current[j] = distance if distance < over else over
+            if distance < best:
+                best = distance
+        if best > limit:
+            return over
+        before, previous = previous, current
+    return previous[-1]
+
+class FuzzyIndex:
+    """Symmetric-delete (SymSpell) index mapping misspelled words to known terms.
+    
+    Every term is filed under each string left by deleting up to
+    FUZZY_MAX_DISTANCE characters from its first FUZZY_PREFIX_LENGTH
+    characters. A word within that many edits of a term leaves one of the
+    same strings, so a misspelling's candidates are the terms filed under
+    its own deletions: one vectorized search of a sorted array of their
+    CRC-32 keys. Hash collisions only add candidates, which the exact edit
+    distance check rejects. Candidates too different in length or in
+    letter_mask are dropped without that check, and the rest are checked
+    best rank first, stopping as soon as no remaining one could win. Arrays
+    only, so it is saved and memory-mapped with the index.
+    """
+    
+    def __init__(self, terms, term_ids, lengths, masks, keys, targets):
+        self.terms = terms
+        self.term_ids = term_ids
+        self.lengths = lengths
+        self.masks = masks
+        # Sorted deletion keys, and the position in `terms` each one came from
+        self.keys = keys
+        self.targets = targets
+    
+    @classmethod
+    def build(cls, vocabulary, n_terms):
+        """Index the first n_terms terms of a vocabulary"""
+        terms = sorted((term for term, term_id in vocabulary.items()
+                        if term_id < n_terms and term.isalpha() and len(term) >= FUZZY_MIN_LENGTH - 1),
+                       key=lambda term: term.encode())
+        keys, targets = array.array('I'), array.array('i')
+        for position, term in enumerate(terms):
+            # Corrected words leave nothing shorter than FUZZY_MIN_LENGTH - 1
+            for deletion in deletions(term[:FUZZY_PREFIX_LENGTH], FUZZY_MAX_DISTANCE, FUZZY_MIN_LENGTH - 1):
+                keys.append(zlib.crc32(deletion.encode()))
+                targets.append(position)
+        keys = np.frombuffer(keys, dtype=np.uint32)
+        targets = np.frombuffer(targets, dtype=np.int32)
+        order = np.lexsort((targets, keys))
+        term_ids = np.array([vocabulary.get(term) for term in terms], dtype=np.int32)
+        lengths = np.array([len(term) for term in terms], dtype=np.int16)
+        masks = np.array([letter_mask(term) for term in terms], dtype=np.uint32)
+        return cls(TextColumn.from_strings(terms), term_ids, lengths, masks, keys[order], targets[order])
+    
+    @property
+    def nbytes(self):
+        arrays = (self.term_ids, self.lengths, self.masks, self.keys, self.targets)
+        return self.terms.nbytes + sum(a.nbytes for a in arrays)
+    
+    def correct(self, word, idf):
+        """The indexed term closest to a word, or None if none is close enough.
+        
+        Among terms at the same distance the most common one (lowest IDF)
+        wins, then the first in byte order.
+        """
+        limit = fuzzy_limit(word)
+        if not limit:
+            return None
+        probes = np.array([zlib.crc32(deletion.encode())
+                           for deletion in deletions(word[:FUZZY_PREFIX_LENGTH], limit, FUZZY_MIN_LENGTH - 1)],
+                          dtype=np.uint32)
+        starts = np.searchsorted(self.keys, probes)
+        stops = np.searchsorted(self.keys, probes, side='right')
+        hits = [self.targets[start:stop] for start, stop in zip(starts, stops) if stop > start]
+        if not hits:
+            return None
+        candidates = np.unique(np.concatenate(hits))
+        # Lower bounds of each candidate's distance
+        gaps = np.abs(self.lengths[candidates].astype(np.int64) - len(word))
+        differing = (self.masks[candidates] ^ np.uint32(letter_mask(word))).view(np.uint8)
+        gaps = np.maximum(gaps, (popcount(differing).reshape(-1, 4).sum(axis=1) + 1) // 2)
+        candidates, gaps = candidates[gaps <= limit], gaps[gaps <= limit]
+        # Positions are in byte order, so this is the tie-breaking order
+        order = np.lexsort((candidates, idf[self.term_ids[candidates]]))
+        
+        best = None
+        for position, gap in zip(candidates[order].tolist(), gaps[order].tolist()):
+            # Later candidates are no more common, so only a closer one wins
+            if gap > limit:
+                continue
+            distance = edit_distance(word, self.terms[position], limit)
+            if distance <= limit:
+                best, limit = self.terms[position], distance - 1
+                # The word is not a term, so no candidate is at distance 0
+                if limit < 1:
+                    break
+        return best
+    
+    def arrays(self, remap):
+        """Arrays that save() writes and load() memory-maps, with term ids renumbered by remap"""
+        return {
+            'fuzzy_terms_blob': self.terms.blob,
+            'fuzzy_terms_offsets': self.terms.offsets,
+            'fuzzy_term_ids': remap[self.term_ids],
+            'fuzzy_lengths': self.lengths,
+            'fuzzy_masks': self.masks,
+            'fuzzy_keys': self.keys,
+            'fuzzy_targets': self.targets,
+        }
+    
+    @classmethod
+    def from_arrays(cls, mapped):
+        return cls(TextColumn(mapped('fuzzy_terms_blob'), mapped('fuzzy_terms_offsets')), mapped('fuzzy_term_ids'),
+                   mapped('fuzzy_lengths'), mapped('fuzzy_masks'), mapped('fuzzy_keys'), mapped('fuzzy_targets'))
+
+class SearchIndex:
+    """Immutable, versioned snapshot of the catalog and its search structures.
+    
+    Rows [0, n_base) form the base segment built at the last compaction; it
+    owns the postings and the precomputed neighbor table. Rows appended since
+    then form the delta segment, which stays small and is scored by brute
+    force. Updated and deleted products keep their row but are masked out
+    through `alive` until the next compaction drops them. Writers never touch
+    a published snapshot, they derive a new one.
+    
+    The base segment keeps its raw term counts and the postings, which hold
+    its TF-IDF weights at the snapshot's `precision`. Full-precision row
+    vectors are rebuilt from the counts when needed.
+    
+    Query terms missing from the vocabulary are corrected through a
+    FuzzyIndex over the terms known at the last compaction; terms first seen
+    in the delta segment only match exactly.
+    """
+    
+    def __init__(self, version, products, vocabulary, analyzer, neighbor_k, dense=None, precision='float64'):
+        self.version = version
         self.products = products
-        self.vectorizer = TfidfVectorizer(stop_words='english')
-        self._build_search_index()
-    
-    def _build_search_index(self):
-        """Build TF-IDF vectors for product search"""
-        product_texts = []
-        for product in self.products:
-            text = f"{product['name']} {product['description']} {product['category']} {' '.join(product['tags'])}"
-            product_texts.append(text)
-        
-        if product_texts:
-            self.tfidf_matrix = self.vectorizer.fit_transform(product_texts)
+        self.vocabulary = vocabulary
+        self.analyzer = analyzer
+        self.neighbor_k = neighbor_k
+        # IvfIndex keyword arguments when the base segment gets an ANN index
+        self.dense = dense
+        self.ann = None
+        self.precision = precision
+        self.created_at = time.time()
+    
+    @classmethod
+    def build(cls, products, analyzer, neighbor_k=NEIGHBOR_K, version=1, dense=None, precision='float64'):
+        """Build a compacted index from scratch"""
+        return cls.build_streaming(products, analyzer, neighbor_k, version, dense, precision=precision)
+    
+    @classmethod
+    def build_streaming(cls, products, analyzer, neighbor_k=NEIGHBOR_K, version=1, dense=None,
+                        chunk_size=INGEST_CHUNK_SIZE, precision='float64'):
+        """Build from an iterable of products without holding all their texts.
+        
+        Products are analyzed one chunk at a time and only the chunk's term
+        counts and its Catalog columns are kept, so indexing memory grows
+        with the counts and the compact catalog rather than with the raw
+        product dicts.
+        """
+        vocabulary = {}
+        catalog = CatalogBuilder()
+        data, indices, row_lengths = [], [], []
+        for chunk in chunked(products, chunk_size):
+            counts = count_terms((product_text(product) for product in chunk), vocabulary, analyzer)
+            for product in chunk:
+                catalog.add(product)
+            data.append(counts.data)
+            indices.append(counts.indices)
+            row_lengths.append(np.diff(counts.indptr))
+        
+        catalog = catalog.build()
+        indptr = np.zeros(len(catalog) + 1, dtype=np.int64)
+        if row_lengths:
+            np.cumsum(np.concatenate(row_lengths), out=indptr[1:])
+        counts = sp.csr_matrix((np.concatenate(data) if data else np.empty(0),
+                                np.concatenate(indices) if indices else np.empty(0, dtype=np.int32), indptr),
+                               shape=(len(catalog), len(vocabulary)))
+        return cls._from_counts(catalog, counts, vocabulary, analyzer, neighbor_k, version, dense,
+                                precision=precision)
+    
+    @classmethod
+    def _from_counts(cls, products, counts, vocabulary, analyzer, neighbor_k, version, dense=None, idf=None,
+                     precision='float64'):
+        if precision not in INDEX_PRECISIONS:
+            raise ValueError(f'unknown index precision {precision!r}')
+        n, n_terms = counts.shape
+        if precision != 'float64':
+            # Term counts are small integers
+            counts = counts.astype(np.uint16 if counts.nnz == 0 or counts.data.max() < 2 ** 16 else np.float32)
+            if not isinstance(vocabulary, FrozenVocabulary):
+                vocabulary, remap = sorted_vocabulary(vocabulary, n_terms)
+                counts = remap_columns(counts, remap)
+                if idf is not None:
+                    inverse = np.empty_like(remap)
+                    inverse[remap] = np.arange(n_terms, dtype=np.int32)
+                    idf = idf[inverse]
+        index = cls(version, products, vocabulary, analyzer, neighbor_k, dense, precision)
+        index.n_base = n
+        index.n_terms = n_terms
+        index.alive = np.ones(n, dtype=bool)
+        index.n_dead = 0
+        index.base_ids = products.id_index
+        index.delta_ids = {}
+        
+        index.doc_freq = np.bincount(counts.indices, minlength=n_terms)
+        # A shard is weighted with the IDF of the whole catalog instead
+        index.idf = smooth_idf(index.doc_freq, n) if idf is None else idf
+        # Base rows keep the weights of the last compaction until the next one
+        index.base_idf = index.idf
+        index.base_counts = counts
+        matrix = index._weigh(counts)
+        if dense is not None:
+            index.ann = IvfIndex(matrix, **dense)
+        index.row_scales = None
+        if precision == 'uint8':
+            matrix, index.row_scales = quantize_rows(matrix)
+        elif precision == 'float32':
+            matrix = matrix.astype(np.float32)
+        # Inverted index: column j lists the products containing term j
+        index.postings = matrix.tocsc()
+        index.postings.sort_indices()
+        index.delta_counts = sp.csr_matrix((0, n_terms))
+        index.delta_matrix = sp.csr_matrix((0, n_terms))
+        index._build_secondary_indexes()
+        index._build_facet_bitsets()
+        index.prefix_index = PrefixIndex.build(products, range(n))
+        index.delta_suggestions = []
+        index.fuzzy = FuzzyIndex.build(vocabulary, n_terms)
+        index.delta_terms = []
+        index.delta_fuzzy = None
+        index.neighbor_ids, index.neighbor_scores = index._top_neighbors(np.arange(n))
+        index.delta_neighbor_ids, index.delta_neighbor_scores = index._top_neighbors(np.arange(0))
+        if precision != 'float64':
+            # Compact modes rebuild counts from the catalog text instead
+            index.base_counts = None
+        return index
+    
+    def save(self, path):
+        """Write the index to a directory of .npy files that load() memory-maps.
+        
+        The snapshot is compacted first if it has pending changes. Term ids
+        are renumbered into sorted term order so the vocabulary can be stored
+        as a sorted blob, and the directory is replaced only once complete.
+        """
+        index = self
+        if self.n_rows != self.n_base or self.n_dead:
+            index = self.compact(self.version)
+        
+        vocabulary, remap = sorted_vocabulary(index.vocabulary, index.n_terms)
+        inverse = np.empty_like(remap)
+        inverse[remap] = np.arange(len(remap), dtype=np.int32)
+        postings = index.postings[:, inverse]
+        postings.sort_indices()
+        
+        arrays = {
+            'terms_blob': vocabulary._blob,
+            'terms_offsets': vocabulary._offsets,
+            'doc_freq': index.doc_freq[inverse],
+            'idf': index.idf[inverse],
+            'postings_data': postings.data,
+            'postings_indices': postings.indices,
+            'postings_indptr': postings.indptr,
+            'neighbor_ids': index.neighbor_ids,
+            'price_order': index.price_order,
+            'rating_order': index.rating_order,
+            'category_rows': index.category_rows,
+            'category_offsets': index.category_offsets,
+            'facet_bits': index.facet_bits,
+            'neighbor_scores': index.neighbor_scores,
+            **index.products.arrays(),
+            **index.prefix_index.arrays(),
+            **index.fuzzy.arrays(remap),
+        }
+        if index.base_counts is not None:
+            counts = remap_columns(index.base_counts, remap)
+            arrays.update(counts_data=counts.data, counts_indices=counts.indices, counts_indptr=counts.indptr)
+        if index.row_scales is not None:
+            arrays['row_scales'] = index.row_scales
+        meta = {
+            'format': INDEX_FORMAT,
+            'version': index.version,
+            'n_rows': index.n_base,
+            'n_terms': index.n_terms,
+            'neighbor_k': index.neighbor_k,
+            'precision': index.precision,
+            'category_names': index.category_names,
+        }
+        write_array_dir(path, arrays, meta)
+    
+    @classmethod
+    def load(cls, path, analyzer):
+        """Open an index written by save(), memory-mapping every array.
+        
+        Nothing is rebuilt or copied, so opening is cheap and every process
+        that opens the same directory shares one page-cached copy.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['format'] != INDEX_FORMAT:
+            raise ValueError(f"unsupported index format {meta['format']} in {path}")
+        
+        def mapped(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        
+        n, n_terms = meta['n_rows'], meta['n_terms']
+        catalog = Catalog.from_arrays(mapped, meta['category_names'])
+        index = cls(meta['version'], catalog, FrozenVocabulary(mapped('terms_blob'), mapped('terms_offsets')),
+                    analyzer, meta['neighbor_k'], precision=meta['precision'])
+        index.n_base = n
+        index.n_terms = n_terms
+        index.alive = np.ones(n, dtype=bool)
+        index.n_dead = 0
+        index.base_ids = catalog.id_index
+        index.delta_ids = {}
+        
+        index.doc_freq = mapped('doc_freq')
+        index.idf = mapped('idf')
+        index.base_idf = index.idf
+        index.base_counts = None
+        if meta['precision'] == 'float64':
+            index.base_counts = sp.csr_matrix((mapped('counts_data'), mapped('counts_indices'),
+                                               mapped('counts_indptr')), shape=(n, n_terms))
+        index.row_scales = mapped('row_scales') if meta['precision'] == 'uint8' else None
+        index.postings = sp.csc_matrix((mapped('postings_data'), mapped('postings_indices'), mapped('postings_indptr')),
+                                       shape=(n, n_terms))
+        index.delta_counts = sp.csr_matrix((0, n_terms))
+        index.delta_matrix = sp.csr_matrix((0, n_terms))
+        
+        index.neighbor_ids = mapped('neighbor_ids')
+        index.price_order = mapped('price_order')
+        index.rating_order = mapped('rating_order')
+        index.category_rows = mapped('category_rows')
+        index.category_offsets = mapped('category_offsets')
+        index.facet_bits = mapped('facet_bits')
+        index.prefix_index = PrefixIndex.from_arrays(mapped)
+        index.delta_suggestions = []
+        index.fuzzy = FuzzyIndex.from_arrays(mapped)
+        index.delta_terms = []
+        index.delta_fuzzy = None
+        index.neighbor_scores = mapped('neighbor_scores')
+        index.delta_neighbor_ids, index.delta_neighbor_scores = index._top_neighbors(np.arange(0))
+        return index
+    
+    @property
+    def n_rows(self):
+        return self.n_base + self.delta_matrix.shape[0]
+    
+    # The filterable fields are the catalog's own columns
+    @property
+    def ids(self):
+        return self.products.ids
+    
+    @property
+    def prices(self):
+        return self.products.prices
+    
+    @property
+    def ratings(self):
+        return self.products.ratings
+    
+    @property
+    def category_codes(self):
+        return self.products.category_codes
+    
+    @property
+    def category_names(self):
+        return self.products.category_names
+    
+    @property
+    def category_lookup(self):
+        return self.products.category_lookup
+    
+    @property
+    def nbytes(self):
+        """Bytes held by the vocabulary, fuzzy index, term statistics, counts, postings and neighbor tables"""
+        matrices = [self.postings, self.delta_counts, self.delta_matrix]
+        if self.base_counts is not None:
+            matrices.append(self.base_counts)
+        arrays = [self.doc_freq, self.idf, self.neighbor_ids, self.neighbor_scores, self.delta_neighbor_ids,
+                  self.delta_neighbor_scores]
+        arrays += [part for matrix in matrices for part in (matrix.data, matrix.indices, matrix.indptr)]
+        if self.base_idf is not self.idf:
+            arrays.append(self.base_idf)
+        if self.row_scales is not None:
+            arrays.append(self.row_scales)
+        vocabulary = (self.vocabulary.nbytes if isinstance(self.vocabulary, FrozenVocabulary)
+                      else deep_sizeof(self.vocabulary))
+        fuzzy = self.fuzzy.nbytes + (self.delta_fuzzy.nbytes if self.delta_fuzzy is not None else 0)
+        return vocabulary + fuzzy + sum(a.nbytes for a in arrays)
+    
+    def _weigh(self, counts):
+        """Apply the snapshot's IDF weights and L2-normalize every row"""
+        counts = _widen(counts, self.n_terms)
+        return l2_normalize_rows(counts @ sp.diags(self.idf))
+    
+    def row_of(self, product_id):
+        """Row of a live product, or None"""
+        if product_id in self.delta_ids:
+            return self.delta_ids[product_id]
+        row = self.base_ids.get(product_id)
+        if row is None or not self.alive[row]:
+            return None
+        return row
+    
+    def _base_counts(self, rows):
+        """Term counts of base rows, re-analyzed from the catalog text in the compact modes"""
+        if self.base_counts is not None:
+            return self.base_counts[rows]
+        # Base rows only use terms from before the last compaction
+        return count_terms((product_text(self.products[row]) for row in rows), self.vocabulary, self.analyzer,
+                           len(self.base_idf))
+    
+    def _base_vectors(self, rows):
+        """Full-precision TF-IDF vectors of base rows, rebuilt from their counts"""
+        return _widen(l2_normalize_rows(self._base_counts(rows) @ sp.diags(self.base_idf)), self.n_terms)
+    
+    def row_vectors(self, rows):
+        """TF-IDF vectors of the given rows, as a CSR matrix over all terms"""
+        rows = np.asarray(rows)
+        base_rows = rows[rows < self.n_base]
+        delta_rows = rows[rows >= self.n_base] - self.n_base
+        if len(delta_rows) == 0:
+            return self._base_vectors(base_rows)
+        if len(base_rows) == 0:
+            return self.delta_matrix[delta_rows]
+        stacked = sp.vstack([self._base_vectors(base_rows), self.delta_matrix[delta_rows]]).tocsr()
+        # Put the rows back in the order they were asked for
+        order = np.concatenate([np.flatnonzero(rows < self.n_base), np.flatnonzero(rows >= self.n_base)])
+        return stacked[np.argsort(order)]
+    
+    def _row_counts(self, rows):
+        rows = np.asarray(rows)
+        base = _widen(self._base_counts(rows[rows < self.n_base]), self.n_terms)
+        delta = self.delta_counts[rows[rows >= self.n_base] - self.n_base]
+        return sp.vstack([base, delta]).tocsr()
+    
+    def vectorize(self, texts):
+        """TF-IDF vectors for arbitrary texts, e.g. queries"""
+        return self._weigh(count_terms(texts, self.vocabulary, self.analyzer, self.n_terms))
+    
+    def correct(self, query):
+        """The query's terms, with each one the vocabulary lacks replaced by its closest known term.
+        
+        Known terms are looked up only, so queries without typos skip the
+        FuzzyIndex entirely. Terms that cannot be corrected are dropped, as
+        vectorizing would drop them anyway.
+        """
+        terms = []
+        for term in self.analyzer(query):
+            term_id = self.vocabulary.get(term)
+            if term_id is None or term_id >= self.n_terms:
+                term = self._closest_term(term)
+            if term is not None:
+                terms.append(term)
+        return ' '.join(terms)
+    
+    def _closest_term(self, word):
+        """Closest known term to a word, from the base FuzzyIndex or the one over terms added since"""
+        found = [self.fuzzy.correct(word, self.idf)]
+        if self.delta_fuzzy is not None:
+            found.append(self.delta_fuzzy.correct(word, self.idf))
+        # The same order FuzzyIndex.correct picks by: distance, IDF, then bytes
+        return min((term for term in found if term is not None), default=None,
+                   key=lambda term: (edit_distance(word, term, FUZZY_MAX_DISTANCE),
+                                     self.idf[self.vocabulary.get(term)], term.encode()))
+    
+    def similarities(self, vectors):
+        """Sparse (len(vectors) x n_rows) dot products against every row.
+        
+        All vectors are L2-normalized, so these are cosine similarities. Base
+        rows are scored through the transposed postings at their stored
+        precision; uint8 weights are widened to float32 for the product.
+        """
+        base_cols = self.postings.shape[1]
+        vectors_base = vectors[:, :base_cols]
+        if self.precision != 'float64':
+            vectors_base = vectors_base.astype(np.float32)
+        base = vectors_base @ self.postings.T
+        if self.row_scales is not None:
+            base = base @ sp.diags(self.row_scales)
+        if self.delta_matrix.shape[0] == 0:
+            return base.tocsr()
+        delta = _widen(vectors, self.n_terms) @ self.delta_matrix.T
+        return sp.hstack([base, delta], format='csr')
+    
+    def _top_neighbors(self, rows, k=None):
+        """Top-k (neighbor_k by default) neighbor rows and scores for the given rows.
+        
+        Each block of rows is scored with one sparse matrix-matrix product.
+        Blocks are sized so the dense similarity scratch never exceeds
+        NEIGHBOR_BLOCK_BYTES, so the full N x N matrix is never materialized.
+        Only products sharing a term with a row (a positive score) are its
+        neighbors, the rule every recommendation path applies; missing
+        neighbors are padded with -1. Base rows are served by the ANN index
+        instead when dense mode is on.
+        """
+        k = self.neighbor_k if k is None else k
+        if self.ann is not None and (len(rows) == 0 or rows.max() < self.n_base):
+            neighbor_ids, neighbor_scores = self.ann.search(rows, k, self.alive)
+            neighbor_ids[neighbor_scores <= 0] = -1
+        else:
+            neighbor_ids, neighbor_scores = self._exact_top_neighbors(rows, k)
+        return neighbor_ids, self._stored_scores(neighbor_scores)
+    
+    def _stored_scores(self, scores):
+        """Neighbor scores as the snapshot stores them.
+        
+        Only the neighbor ids are served, so the compact modes keep the scores
+        as float16, or in uint8 mode as 255ths with missing neighbors at zero.
+        """
+        if self.precision == 'float32':
+            return scores.astype(np.float16)
+        if self.precision == 'uint8':
+            return np.rint(np.clip(scores, 0, 1) * 255).astype(np.uint8)
+        return scores
+    
+    def _exact_top_neighbors(self, rows, k):
+        neighbor_ids = np.full((len(rows), k), -1, dtype=np.int32)
+        neighbor_scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+        n = self.n_rows
+        if k == 0 or n < 2:
+            return neighbor_ids, neighbor_scores
+        
+        width = min(k, n)
+        block_rows = max(1, NEIGHBOR_BLOCK_BYTES // (n * 8))
+        for start in range(0, len(rows), block_rows):
+            block = rows[start:start + block_rows]
+            sims = self.similarities(self.row_vectors(block)).toarray()
+            # A product is never its own neighbor, and retired rows are never neighbors
+            sims[:, ~self.alive] = -np.inf
+            sims[np.arange(len(block)), block] = -np.inf
+            
+            top = np.argpartition(-sims, width - 1, axis=1)[:, :width]
+            top_scores = np.take_along_axis(sims, top, axis=1)
+            # Ties go to the lower id, as in rank_hits
+            order = np.lexsort((self.ids[top], -top_scores), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            top[top_scores <= 0] = -1
+            neighbor_ids[start:start + len(block), :width] = top
+            neighbor_scores[start:start + len(block), :width] = top_scores
+        return neighbor_ids, neighbor_scores
+    
+    def _neighbor_row(self, row):
+        return self.neighbor_ids[row] if row < self.n_base else self.delta_neighbor_ids[row - self.n_base]
+    
+    def neighbors(self, row):
+        """Precomputed neighbor rows of a row that are still live, best first.
+        
+        Base rows do not see products added after the last compaction.
+        """
+        candidates = self._neighbor_row(row)
+        candidates = candidates[candidates >= 0]
+        return candidates[self.alive[candidates]]
+    
+    def neighbors_cover(self, row, k):
+        """Whether neighbors(row) holds the row's best k neighbors (all of them if fewer).
+        
+        A table entry padded with -1 already lists every product sharing a
+        term with the row, so it is rescored only when it is shallower than
+        k or lost entries to deletions.
+        """
+        table = self._neighbor_row(row)
+        stored = table[table >= 0]
+        live = self.alive[stored]
+        return live.sum() >= k or (live.all() and len(stored) < len(table))
+    
+    def profile_vector(self, product_ids, weights, previous=None):
+        """Weighted sum of the TF-IDF rows of products viewed oldest first.
+        
+        Of n products, the i-th counts weights[i] * SESSION_DECAY ** (n - 1 - i),
+        all in one sparse vector-matrix product. `previous`, the profile of
+        earlier views, is decayed by SESSION_DECAY ** n and added, so a
+        profile can be extended without revisiting older views. Unknown and
+        deleted products are skipped.
+        """
+        n = len(product_ids)
+        rows, row_weights = [], []
+        for position, (product_id, weight) in enumerate(zip(product_ids, weights)):
+            row = self.row_of(product_id)
+            if row is not None:
+                rows.append(row)
+                row_weights.append(weight * SESSION_DECAY ** (n - 1 - position))
+        profile = sp.csr_matrix(np.array(row_weights).reshape(1, -1)) @ self.row_vectors(np.array(rows, dtype=np.int64))
+        if previous is not None:
+            profile = profile + SESSION_DECAY ** n * previous
+        return sp.csr_matrix(profile)
+    
+    def profile_neighbors(self, profile, exclude, k):
+        """Best k live rows by cosine similarity to a profile vector, minus `exclude`,
+        and their similarities"""
+        rows, scores = self._score_postings(l2_normalize_rows(profile), self.alive)
+        keep = scores > 0
+        keep[np.isin(rows, exclude)] = False
+        rows, scores = rows[keep], scores[keep]
+        order = rank_hits(scores, self.ids[rows], k)
+        return rows[order], scores[order]
+    
+    def blend_neighbors(self, row, candidates, co_rows, co_scores, k, weight=CO_BLEND):
+        """Best k rows among text neighbors and co-occurring rows, by blended score.
+        
+        A row scores `weight` times its co-occurrence score (0 when the two
+        products never co-occurred) plus the rest times its cosine similarity
+        to `row`, computed exactly for every candidate in one sparse product.
+        """
+        rows = np.unique(np.concatenate([candidates, co_rows]).astype(np.int64))
+        rows = rows[self.alive[rows] & (rows != row)]
+        text = (self.row_vectors(np.array([row])) @ self.row_vectors(rows).T).toarray().ravel()
+        co = np.zeros(len(rows))
+        kept = np.isin(co_rows, rows)
+        co[np.searchsorted(rows, co_rows[kept])] = co_scores[kept]
+        scores = weight * co + (1 - weight) * text
+        positive = scores > 0
+        rows, scores = rows[positive], scores[positive]
+        return rows[rank_hits(scores, self.ids[rows], k)]
+    
+    def _build_secondary_indexes(self):
+        """Sorted secondary indexes over the base segment.
+        
+        `price_order` and `rating_order` list base rows by (value, id), and
+        `category_rows` groups them by category code (bounded by
+        `category_offsets`), each group again ordered by (price, id), so
+        range filters are binary searches and price-sorted category pages
+        are slices.
+        """
+        n = self.n_base
+        ids, prices, codes = self.ids[:n], self.prices[:n], self.category_codes[:n]
+        self.price_order = np.lexsort((ids, prices)).astype(np.int32)
+        self.rating_order = np.lexsort((ids, self.ratings[:n])).astype(np.int32)
+        self.category_rows = self.price_order[np.argsort(codes[self.price_order], kind='stable')]
+        self.category_offsets = np.zeros(len(self.category_names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(self.category_names)), out=self.category_offsets[1:])
+    
+    def _facet_values(self, rows):
+        """Category code, price bucket and rating bucket of each row"""
+        return (self.category_codes[rows],
+                np.searchsorted(PRICE_FACET_BOUNDS, self.prices[rows], side='right'),
+                np.searchsorted(RATING_FACET_BOUNDS, self.ratings[rows], side='right'))
+    
+    def _build_facet_bitsets(self):
+        """One bitset over the base rows per facet value.
+        
+        Rows of `facet_bits` are the base segment's categories, then the
+        price buckets, then the rating buckets.
+        """
+        sizes = (len(self.category_offsets) - 1, len(PRICE_FACETS), len(RATING_FACETS))
+        self.facet_bits = np.zeros((sum(sizes), (self.n_base + 7) // 8), dtype=np.uint8)
+        first = 0
+        for values, size in zip(self._facet_values(np.arange(self.n_base)), sizes):
+            for value in range(size):
+                self.facet_bits[first + value] = np.packbits(values == value)
+            first += size
+    
+    def facet_counts(self, rows):
+        """Per-category, price-bucket and rating-bucket counts over live rows.
+        
+        A broad hit set is packed into one bitset, ANDed with every facet
+        value's bitset and counted with popcount, so the cost is a few
+        passes over n/8 bytes however many rows match. Small hit sets and
+        delta rows are counted from their column values instead.
+        """
+        n_categories = len(self.category_names)
+        counts = np.zeros(n_categories + len(PRICE_FACETS) + len(RATING_FACETS), dtype=np.int64)
+        rows = np.asarray(rows)
+        base = rows[rows < self.n_base]
+        direct = rows
+        if len(base) >= FACET_SPARSE_FRACTION * self.n_base and len(base):
+            hits = np.zeros(self.facet_bits.shape[1] * 8, dtype=bool)
+            hits[base] = True
+            matched = popcount(self.facet_bits & np.packbits(hits)).sum(axis=1, dtype=np.int64)
+            base_categories = len(self.category_offsets) - 1
+            counts[:base_categories] += matched[:base_categories]
+            counts[n_categories:] += matched[base_categories:]
+            direct = rows[rows >= self.n_base]
+        
+        if len(direct):
+            first = 0
+            for values, size in zip(self._facet_values(direct),
+                                    (n_categories, len(PRICE_FACETS), len(RATING_FACETS))):
+                counts[first:first + size] += np.bincount(values, minlength=size)
+                first += size
+        return (counts[:n_categories], counts[n_categories:n_categories + len(PRICE_FACETS)],
+                counts[n_categories + len(PRICE_FACETS):])
+    
+    @staticmethod
+    def _bisect(segment, column, value, right):
+        """First position in a segment ordered by column that is > (right) or >= value"""
+        lo, hi = 0, len(segment)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = column[segment[mid]]
+            if current < value or (right and current == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    
+    def _category_segment(self, code):
+        if code >= len(self.category_offsets) - 1:
+            # A category first seen after the last compaction has no base rows
+            return self.category_rows[:0]
+        return self.category_rows[self.category_offsets[code]:self.category_offsets[code + 1]]
+    
+    def browse_rows(self, category=None, max_price=None, min_rating=None):
+        """Live rows passing the filters, located through the secondary indexes.
+        
+        Only the most selective of the category group, the price range and
+        the rating range is read, and only its rows are checked against the
+        remaining filters; delta rows are checked directly.
+        """
+        code = None
+        segments = []
+        if category:
+            code = self.category_lookup.get(category.lower())
+            if code is None:
+                return np.empty(0, dtype=np.int64)
+            segments.append(self._category_segment(code))
+        if max_price is not None:
+            segments.append(self.price_order[:self._bisect(self.price_order, self.prices, max_price, True)])
+        if min_rating is not None:
+            segments.append(self.rating_order[self._bisect(self.rating_order, self.ratings, min_rating, False):])
+        base = min(segments, key=len) if segments else np.arange(self.n_base)
+        rows = np.concatenate([base, np.arange(self.n_base, self.n_rows)]).astype(np.int64)
+        return rows[self._passes(rows, code, max_price, min_rating)]
+    
+    def _passes(self, rows, code, max_price, min_rating):
+        keep = self.alive[rows]
+        if code is not None:
+            keep &= self.category_codes[rows] == code
+        if max_price is not None:
+            keep &= self.prices[rows] <= max_price
+        if min_rating is not None:
+            keep &= self.ratings[rows] >= min_rating
+        return keep
+    
+    def sort_scores(self, rows, sort):
+        """Scores that make rank_hits order rows by a SORT_ORDERS key, then id"""
+        field, descending = SORT_ORDERS[sort]
+        values = (self.prices if field == 'price' else self.ratings)[rows]
+        return values if descending else -values
+    
+    def sorted_slice(self, sort, need, category=None, max_price=None, min_rating=None):
+        """Rows that can make the first `need` places of a sorted browse, and the total.
+        
+        Applies when every filter is implied by one ordered segment: the
+        price order (or a category group) for price sorts with a max_price,
+        the rating order for rating sorts with a min_rating. Only the head
+        of that segment is read, the whole tie group at the boundary
+        included, so rank_hits can settle ties by id; the few delta rows
+        are added directly. Returns None when the filters need a scan.
+        """
+        field, descending = SORT_ORDERS[sort]
+        code = None
+        if field == 'price' and min_rating is None:
+            segment = self.price_order
+            if category:
+                code = self.category_lookup.get(category.lower())
+                if code is None:
+                    return np.empty(0, dtype=np.int64), np.empty(0), 0
+                segment = self._category_segment(code)
+            column = self.prices
+            if max_price is not None:
+                segment = segment[:self._bisect(segment, column, max_price, True)]
+        elif field == 'rating' and not category and max_price is None:
+            segment, column = self.rating_order, self.ratings
+            if min_rating is not None:
+                segment = segment[self._bisect(segment, column, min_rating, False):]
+        else:
+            return None
+        
+        if descending:
+            start = len(segment) - self._live_boundary(segment[::-1], need)
+            if start < len(segment):
+                # Take the whole group tied with the last row taken
+                start = self._bisect(segment, column, column[segment[start]], False)
+            head = segment[start:]
+        else:
+            head = segment[:self._live_boundary(segment, need)]
+        
+        delta = np.arange(self.n_base, self.n_rows)
+        delta = delta[self._passes(delta, code, max_price, min_rating)]
+        rows = np.concatenate([head[self.alive[head]], delta]).astype(np.int64)
+        total = (int(self.alive[segment].sum()) if self.n_dead else len(segment)) + len(delta)
+        return rows, self.sort_scores(rows, sort), total
+    
+    def _live_boundary(self, segment, need):
+        """Length of the shortest prefix of segment holding `need` live rows"""
+        if not self.n_dead:
+            return min(need, len(segment))
+        stop, live = 0, 0
+        while stop < len(segment) and live < need:
+            step = max(2 * (need - live), 256)
+            live += int(self.alive[segment[stop:stop + step]].sum())
+            stop += step
+        return min(stop, len(segment))
+    
+    def suggest(self, prefix, limit):
+        """Best completions of `prefix` among the live products.
+        
+        Base suggestions come from the prefix index, skipping deleted
+        products (tag and category counts only drop at the next compaction);
+        matches in the delta segment are merged in with their product counts.
+        A trailing space in the prefix asks for the next word.
+        """
+        key = suggest_key(prefix)
+        if not key:
+            return []
+        if prefix[-1].isspace():
+            key += ' '
+        encoded = key.encode()
+        
+        matched = {}
+        lo = bisect_left(self.delta_suggestions, (encoded,))
+        hi = bisect_left(self.delta_suggestions, (encoded + b'\xff',), lo)
+        for _, kind, key, text, rating, row in self.delta_suggestions[lo:hi]:
+            if self.alive[row]:
+                ident = (kind, key, row if kind == PRODUCT_SUGGESTION else -1)
+                matched.setdefault(ident, (text, {}))[1][row] = rating
+        
+        prefixes = self.prefix_index
+        candidates = prefixes.candidates(encoded)
+        rows = prefixes.rows[candidates]
+        candidates = candidates[(rows < 0) | self.alive[np.maximum(rows, 0)]]
+        if not matched:
+            # Candidates come best first, so nothing past the limit can rank
+            candidates = candidates[:limit]
+        found = {}
+        for i in candidates.tolist():
+            ident = (int(prefixes.kinds[i]), prefixes.keys[i], int(prefixes.rows[i]))
+            found[ident] = [prefixes.texts[i], int(prefixes.counts[i]), float(prefixes.ratings[i])]
+        for ident, (text, ratings) in matched.items():
+            entry = found.setdefault(ident, [text, 0, 0.0])
+            entry[1] += len(ratings)
+            entry[2] = max(entry[2], max(ratings.values()))
+        
+        ranked = sorted(found.items(), key=lambda item: (-(item[1][1] + item[1][2] / 10), item[0]))
+        suggestions = []
+        for (kind, _, row), (text, count, rating) in ranked[:limit]:
+            suggestion = {'text': text, 'type': SUGGESTION_KINDS[kind]}
+            if row >= 0:
+                suggestion.update(id=int(self.ids[row]), rating=rating)
+            else:
+                suggestion['count'] = count
+            suggestions.append(suggestion)
+        return suggestions
+    
+    def filter_mask(self, category=None, max_price=None, min_rating=None):
+        """Compile the filters into a boolean mask over live rows"""
+        mask = self.alive
+        if category:
+            code = self.category_lookup.get(category.lower())
+            if code is None:
+                return np.zeros(self.n_rows, dtype=bool)
+            mask = mask & (self.category_codes == code)
+        if max_price is not None:
+            mask = mask & (self.prices <= max_price)
+        if min_rating is not None:
+            mask = mask & (self.ratings >= min_rating)
+        return mask
+    
+    def score_query(self, query, mask):
+        """Score only the products that share at least one term with the query.
+        
+        Walks the postings list of every query term and accumulates
+        query-weight x document-weight per product; the delta segment is
+        scored directly. Both sides are L2-normalized, so the accumulated dot
+        product is the cosine similarity and the cost follows the postings
+        lengths. Postings of rows excluded by `mask` are dropped before scoring.
+        Misspelled terms are corrected first.
+        """
+        with timed('correct'):
+            query = self.correct(query)
+        with timed('vectorize'):
+            query_vec = self.vectorize([query])
+        with timed('score'):
+            return self._score_postings(query_vec, mask)
+    
+    def _score_postings(self, query_vec, mask):
+        rows, weights = [], []
+        for term, query_weight in zip(query_vec.indices, query_vec.data):
+            if term >= self.postings.shape[1]:
+                continue
+            start, stop = self.postings.indptr[term], self.postings.indptr[term + 1]
+            rows.append(self.postings.indices[start:stop])
+            weights.append(self.postings.data[start:stop] * query_weight)
+        
+        if self.delta_matrix.shape[0] and query_vec.nnz:
+            delta_scores = (self.delta_matrix @ query_vec.T).toarray().ravel()
+            hits = np.flatnonzero(delta_scores)
+            rows.append(hits + self.n_base)
+            weights.append(delta_scores[hits])
+        
+        if not rows:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        
+        rows = np.concatenate(rows)
+        weights = np.concatenate(weights)
+        allowed = mask[rows]
+        rows, weights = rows[allowed], weights[allowed]
+        
+        candidates, inverse = np.unique(rows, return_inverse=True)
+        # bincount returns integers when no row passes the mask
+        scores = np.bincount(inverse, weights=weights, minlength=len(candidates)).astype(np.float64, copy=False)
+        if self.row_scales is not None:
+            # Every row's quantized weights share one scale, applied once per row
+            base = candidates < self.n_base
+            scores[base] *= self.row_scales[candidates[base]]
+        return candidates, scores
+    
+    def with_changes(self, upserts, deletes, version):
+        """Derive the next snapshot with products upserted and deleted.
+        
+        Retired rows are tombstoned and their document frequencies withdrawn;
+        upserted products are appended to the delta segment, weighted with the
+        refreshed IDF, and get their own neighbor lists. Other rows keep their
+        weights and neighbors until the next compaction. Every upsert is
+        validated with normalize_product first, so an invalid one raises
+        ValueError before anything is derived.
+        """
+        normalized = []
+        for product in upserts:
+            try:
+                # Extra fields are kept; the core ones are replaced by their normalized values
+                normalized.append(dict(product, **normalize_product(product)))
+            except ValueError as error:
+                product_id = product.get('id') if isinstance(product, Mapping) else None
+                raise ValueError(f'invalid product {product_id!r}: {error}') from None
+        upserts = list({product['id']: product for product in normalized}.values())
+        index = copy.copy(self)
+        index.version = version
+        index.created_at = time.time()
+        index.alive = self.alive.copy()
+        index.delta_ids = dict(self.delta_ids)
+        
+        retired = []
+        for product_id in list(deletes) + [product['id'] for product in upserts]:
+            row = self.row_of(product_id)
+            if row is not None and index.alive[row]:
+                index.alive[row] = False
+                retired.append(row)
+            index.delta_ids[product_id] = None
+        
+        # The vocabulary only grows between compactions, so it is shared with
+        # older snapshots, which ignore term ids past their own n_terms.
+        counts = count_terms((product_text(product) for product in upserts), self.vocabulary, self.analyzer)
+        index.n_terms = len(self.vocabulary)
+        if index.n_terms > self.n_terms:
+            # Terms first seen since the last compaction get a small FuzzyIndex of their own
+            new_terms = {term for product in upserts for term in self.analyzer(product_text(product))
+                         if self.vocabulary.get(term) >= self.n_terms}
+            index.delta_terms = self.delta_terms + sorted(new_terms)
+            index.delta_fuzzy = FuzzyIndex.build({term: self.vocabulary.get(term) for term in index.delta_terms},
+                                                 index.n_terms)
+        doc_freq = np.zeros(index.n_terms, dtype=self.doc_freq.dtype)
+        doc_freq[:self.n_terms] = self.doc_freq
+        if retired:
+            doc_freq -= np.bincount(self._row_counts(retired).indices, minlength=index.n_terms)
+        doc_freq += np.bincount(counts.indices, minlength=index.n_terms)
+        index.doc_freq = doc_freq
+        index.n_dead = self.n_dead + len(retired)
+        index.idf = smooth_idf(doc_freq, int(index.alive.sum()) + len(upserts))
+        
+        first_row = self.n_rows
+        index.products = self.products.append(upserts)
+        index.alive = np.concatenate([index.alive, np.ones(len(upserts), dtype=bool)])
+        for offset, product in enumerate(upserts):
+            index.delta_ids[product['id']] = first_row + offset
+        
+        index.delta_counts = sp.vstack([_widen(self.delta_counts, index.n_terms), counts]).tocsr()
+        index.delta_matrix = sp.vstack([_widen(self.delta_matrix, index.n_terms), index._weigh(counts)]).tocsr()
+        # Sorting the concatenation merges two sorted runs in linear time
+        index.delta_suggestions = sorted(self.delta_suggestions +
+                                         suggestion_positions(index.products, range(first_row, index.n_rows)))
+        
+        new_ids, new_scores = index._top_neighbors(np.arange(first_row, index.n_rows))
+        index.delta_neighbor_ids = np.concatenate([self.delta_neighbor_ids, new_ids])
+        index.delta_neighbor_scores = np.concatenate([self.delta_neighbor_scores, new_scores])
+        return index
+    
+    def needs_compaction(self):
+        pending = self.n_rows - self.n_base + self.n_dead
+        return pending > max(COMPACT_MIN_ROWS, COMPACT_FRACTION * self.n_base)
+    
+    def compact(self, version):
+        """Rebuild as a single base segment from the stored term counts.
+        
+        Drops retired rows and unused terms, recomputes IDF over the live
+        catalog and rebuilds the postings and neighbor table. The text is not
+        re-analyzed, except in the compact modes, which keep no base counts.
+        """
+        live = np.flatnonzero(self.alive)
+        products = self.products.take(live)
+        counts = self._row_counts(live)
+        
+        used = np.flatnonzero(np.bincount(counts.indices, minlength=self.n_terms))
+        remap = np.full(self.n_terms, -1, dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        vocabulary = {term: int(remap[term_id]) for term, term_id in self.vocabulary.items()
+                      if term_id < self.n_terms and remap[term_id] >= 0}
+        counts = sp.csr_matrix((counts.data, remap[counts.indices].astype(np.int32), counts.indptr),
+                               shape=(len(live), len(used)))
+        return SearchIndex._from_counts(products, counts, vocabulary, self.analyzer, self.neighbor_k, version,
+                                        self.dense, precision=self.precision)
+
+class IndexWarming(Exception):
+    """Raised by requests that need the text index before it is available"""
+
+class CatalogSnapshot(SearchIndex):
+    """Catalog-only snapshot served while the full index is built or loaded.
+    
+    It has the catalog, the secondary indexes and the facet bitsets, so
+    product lookups and filter-only browsing (with facets) are answered
+    from the raw catalog columns. Everything that needs term weights or
+    the neighbor table raises IndexWarming instead.
+    """
+    
+    def __init__(self, products, version=0):
+        # Analyzing a query is the first step of every text search
+        super().__init__(version, products, None, self._warming, 0)
+        self.n_base = len(products)
+        self.n_terms = 0
+        self.alive = np.ones(len(products), dtype=bool)
+        self.n_dead = 0
+        self.base_ids = products.id_index
+        self.delta_ids = {}
+    
+    @classmethod
+    def from_catalog(cls, products):
+        index = cls(products)
+        index._build_secondary_indexes()
+        index._build_facet_bitsets()
+        return index
+    
+    @classmethod
+    def from_saved(cls, path):
+        """Memory-map just the catalog and secondary indexes of a saved index"""
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['format'] != INDEX_FORMAT:
+            raise ValueError(f"unsupported index format {meta['format']} in {path}")
+        
+        def mapped(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        
+        index = cls(Catalog.from_arrays(mapped, meta['category_names']))
+        index.price_order = mapped('price_order')
+        index.rating_order = mapped('rating_order')
+        index.category_rows = mapped('category_rows')
+        index.category_offsets = mapped('category_offsets')
+        index.facet_bits = mapped('facet_bits')
+        return index
+    
+    @property
+    def n_rows(self):
+        return self.n_base
+    
+    @property
+    def nbytes(self):
+        return 0
+    
+    def _warming(self, *args, **kwargs):
+        raise IndexWarming('the search index is still warming up')
+    
+    vectorize = correct = score_query = similarities = row_vectors = neighbors = _top_neighbors = _warming
+    neighbors_cover = _neighbor_row = _warming
+    suggest = with_changes = compact = save = _warming
+
+class CoOccurrence:
+    """Item-item co-occurrence of products, learned from a behavior event log.
+    
+    Two products co-occur when a session touches both within CO_WINDOW
+    events of each other, with no CO_SESSION_GAP pause in between; the pair
+    earns the product of the two event weights (view, cart, purchase).
+    Scores fade with a half-life of CO_HALF_LIFE, applied to the whole
+    matrix each time the clock advances rather than per pair. The log is
+    append-only JSON lines, read in chunks from `log_offset` so a later
+    ingest picks up where the last one stopped, and after each chunk every
+    product keeps only its CO_KEEP best partners, so memory is bounded by
+    the number of products and tracked sessions, not by the number of
+    events. Windows of sessions still open are kept in memory only.
+    """
+    
+    def __init__(self, ids=None, id_index=None, matrix=None, totals=None, clock=0.0, log_offset=0):
+        self.ids = np.empty(0, dtype=np.int64) if ids is None else ids
+        self.id_index = IdIndex(self.ids) if id_index is None else id_index
+        self.matrix = sp.csr_matrix((len(self.ids), len(self.ids))) if matrix is None else matrix
+        # Decayed event weight seen per product
+        self.totals = np.zeros(len(self.ids)) if totals is None else totals
+        # Timestamp the scores are decayed to
+        self.clock = clock
+        self.log_offset = log_offset
+        self.sessions = OrderedDict()
+    
+    def ingest(self, path, chunk_size=EVENT_CHUNK_SIZE):
+        """New matrix with the events appended to the log since `log_offset` folded in.
+        
+        A trailing line without a newline is left for the next ingest, as
+        its writer may not be done. Bad lines are skipped and counted in the
+        result's `ingest_stats`. The published matrix is never modified:
+        session windows are copied before they change, so readers of it, and
+        a failed ingest, leave it exactly as it was.
+        """
+        stats = {'events': 0, 'skipped': 0, 'errors': []}
+        started = time.perf_counter()
+        state = copy.copy(self)
+        state.sessions = OrderedDict(self.sessions)
+        offset = self.log_offset
+        chunk = []
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                if not line.strip():
+                    continue
+                stats['events'] += 1
+                try:
+                    chunk.append(parse_event(line))
+                except ValueError as e:
+                    stats['skipped'] += 1
+                    if len(stats['errors']) < INGEST_MAX_ERRORS:
+                        stats['errors'].append(f'byte {offset - len(line)}: {e}')
+                    continue
+                if len(chunk) == chunk_size:
+                    state._add_chunk(chunk)
+                    chunk = []
+        if chunk:
+            state._add_chunk(chunk)
+        state.log_offset = offset
+        stats['seconds'] = time.perf_counter() - started
+        stats['events_per_second'] = stats['events'] / stats['seconds'] if stats['seconds'] else 0.0
+        state.ingest_stats = stats
+        return state
+    
+    def _add_chunk(self, events):
+        n = len(self.ids)
+        new = {}
+        pair_rows, pair_cols, pair_values, pair_times = [], [], [], []
+        touched, touched_weights, touched_times = [], [], []
+        for ts, session, product_id, weight in events:
+            col = self.id_index.get(product_id)
+            if col is None:
+                col = new.setdefault(product_id, n + len(new))
+            recent = self.sessions.pop(session, None)
+            if recent is None or ts - recent[-1][2] > CO_SESSION_GAP:
+                recent = deque(maxlen=CO_WINDOW)
+            else:
+                # The window may still belong to the snapshot this one was derived from
+                recent = deque(recent, maxlen=CO_WINDOW)
+            for other, other_weight, _ in recent:
+                if other != col:
+                    pair_rows.append(col)
+                    pair_cols.append(other)
+                    pair_values.append(weight * other_weight)
+                    pair_times.append(ts)
+            recent.append((col, weight, ts))
+            self.sessions[session] = recent
+            if len(self.sessions) > CO_MAX_SESSIONS:
+                self.sessions.popitem(last=False)
+            touched.append(col)
+            touched_weights.append(weight)
+            touched_times.append(ts)
+        
+        clock = max(self.clock, max(touched_times))
+        fade = 0.5 ** ((clock - self.clock) / CO_HALF_LIFE)
+        size = n + len(new)
+        values = np.array(pair_values) * 0.5 ** ((clock - np.array(pair_times)) / CO_HALF_LIFE)
+        rows, cols = np.array(pair_rows, dtype=np.int64), np.array(pair_cols, dtype=np.int64)
+        pairs = sp.coo_matrix((np.concatenate([values, values]), (np.concatenate([rows, cols]),
+                                                                   np.concatenate([cols, rows]))),
+                              shape=(size, size)).tocsr()
+        indptr = np.concatenate([self.matrix.indptr, np.full(len(new), self.matrix.indptr[-1])])
+        matrix = sp.csr_matrix((self.matrix.data * fade, self.matrix.indices, indptr), shape=(size, size)) + pairs
+        self.matrix = prune_rows(matrix.tocsr(), CO_KEEP)
+        
+        totals = np.bincount(touched, np.array(touched_weights) * 0.5 ** ((clock - np.array(touched_times)) /
+                                                                         CO_HALF_LIFE), minlength=size)
+        totals[:n] += self.totals * fade
+        self.totals = totals
+        if new:
+            self.ids = np.concatenate([self.ids, np.array(list(new), dtype=np.int64)])
+            self.id_index = IdIndex(self.ids)
+        self.clock = clock
+    
+    def neighbors(self, product_id):
+        """Ids of the products that co-occur with a product, and their scores
+        scaled so the strongest partner scores 1"""
+        col = self.id_index.get(product_id)
+        if col is None:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        start, end = self.matrix.indptr[col], self.matrix.indptr[col + 1]
+        scores = np.asarray(self.matrix.data[start:end])
+        if not len(scores) or scores.max() <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return self.ids[self.matrix.indices[start:end]], scores / scores.max()
+    
+    def save(self, path):
+        """Write the matrix to a directory of .npy files that load() memory-maps"""
+        arrays = {
+            'ids': self.ids,
+            'id_slots': self.id_index.slots,
+            'data': self.matrix.data,
+            'indices': self.matrix.indices,
+            'indptr': self.matrix.indptr,
+            'totals': self.totals,
+        }
+        write_array_dir(path, arrays, {'format': INDEX_FORMAT, 'clock': self.clock, 'log_offset': self.log_offset})
+    
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['format'] != INDEX_FORMAT:
+            raise ValueError(f"unsupported co-occurrence format {meta['format']} in {path}")
+        
+        def mapped(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        
+        ids = mapped('ids')
+        matrix = sp.csr_matrix((mapped('data'), mapped('indices'), mapped('indptr')), shape=(len(ids), len(ids)))
+        return cls(ids, IdIndex(ids, mapped('id_slots')), matrix, mapped('totals'), meta['clock'], meta['log_offset'])
+
+class ProductSearch:
+    def __init__(self, products=(), neighbor_k=NEIGHBOR_K, cache=None, index_path=None, dense=None,
+                 chunk_size=None, precision='float64', snapshot=None):
+        # Tokenization is delegated to TfidfVectorizer's analyzer, but term
+        # counts and document frequencies are kept here so the index can be
+        # updated without refitting.
+        self.analyzer = text_analyzer() if snapshot is None else snapshot.analyzer
+        self._write_lock = threading.Lock()
+        self.index_path = index_path
+        if snapshot is not None:
+            # Serve a ready-made snapshot, e.g. a CatalogSnapshot while warming up
+            self._index = snapshot
+        elif index_path is not None:
+            self._index = SearchIndex.load(index_path, self.analyzer)
+        elif chunk_size is not None:
+            self._index = SearchIndex.build_streaming(products, self.analyzer, neighbor_k, dense=dense,
+                                                      chunk_size=chunk_size, precision=precision)
+        else:
+            self._index = SearchIndex.build(products, self.analyzer, neighbor_k, dense=dense, precision=precision)
+        self.cache = ResultCache() if cache is None else cache
+        # Unnormalized profile vectors of recent sessions
+        self.sessions = ResultCache(SESSION_CACHE_BYTES, SESSION_TTL)
+        # Co-occurrence from behavior events, blended into recommendations
+        self.behavior = None
+        self.behavior_path = None
+    
+    @classmethod
+    def from_catalog_file(cls, path, chunk_size=INGEST_CHUNK_SIZE, **kwargs):
+        """Index a JSONL or CSV catalog through a streaming pipeline.
+        
+        Rows are read, validated and normalized lazily and vectorized in
+        chunks; bad rows are skipped. Ingestion statistics, including
+        throughput, are left in `ingest_stats`.
+        """
+        stats = {'rows': 0, 'skipped': 0, 'errors': []}
+        started = time.perf_counter()
+        search = cls(valid_products(read_catalog_rows(path), stats), chunk_size=chunk_size, **kwargs)
+        stats['seconds'] = time.perf_counter() - started
+        stats['indexed'] = search.index.n_rows
+        stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+        search.ingest_stats = stats
+        return search
+    
+    @classmethod
+    def load(cls, path, cache=None):
+        """Serve a saved index; see SearchIndex.load"""
+        return cls(cache=cache, index_path=path)
+    
+    def save(self, path):
+        """Persist the current snapshot; see SearchIndex.save.
+        
+        Updates add terms to the vocabulary the snapshots share, so the
+        snapshot is saved with a copy of it taken under the write lock; the
+        files are written outside the lock.
+        """
+        with self._write_lock:
+            index = copy.copy(self._index)
+            index.vocabulary = index.vocabulary.copy()
+        index.save(path)
+    
+    def reload(self):
+        """Swap in the index saved at index_path, e.g. after `build-index`.
+        
+        The new snapshot is published like any update, so requests already
+        running finish on the old one (its memory-mapped files stay valid
+        after being replaced on disk). It gets the next version number so
+        caches keyed by version never serve older results.
+        """
+        if self.index_path is None:
+            return False
+        index = SearchIndex.load(self.index_path, self.analyzer)
+        with self._write_lock:
+            index.version = self._index.version + 1
+            self._index = index
+        return True
+    
+    def ingest_events(self, path, chunk_size=EVENT_CHUNK_SIZE):
+        """Fold new events of a behavior log into the co-occurrence matrix.
+        
+        Returns the ingestion statistics; see CoOccurrence.ingest.
+        """
+        self.behavior = (self.behavior or CoOccurrence()).ingest(path, chunk_size)
+        return self.behavior.ingest_stats
+    
+    def load_behavior(self, path):
+        """Serve the co-occurrence matrix saved at `path`"""
+        self.behavior = CoOccurrence.load(path)
+        self.behavior_path = path
+    
+    def reload_behavior(self):
+        """Swap in the co-occurrence matrix saved at behavior_path"""
+        if self.behavior_path is None:
+            return False
+        self.behavior = CoOccurrence.load(self.behavior_path)
+        return True
+    
+    @property
+    def index(self):
+        """Current snapshot; keep a reference to it for a consistent view"""
+        return self._index
+    
+    @property
+    def version(self):
+        return self._index.version
+    
+    def add_product(self, product):
+        """Add a product (or replace the one with the same id)"""
+        return self.apply_changes(upserts=[product])
+    
+    def update_product(self, product):
+        """Replace the product with the same id"""
+        return self.apply_changes(upserts=[product])
+    
+    def delete_product(self, product_id):
+        """Remove a product; returns False if it was not in the catalog"""
+        if self._index.row_of(product_id) is None:
+            return False
+        self.apply_changes(deletes=[product_id])
+        return True
+    
+    def apply_changes(self, upserts=(), deletes=()):
+        """Apply a batch of upserts and deletions as one new index version.
+        
+        Writers are serialized; readers keep using the previous snapshot
+        until the new one is published with a single reference swap. Raises
+        ValueError, leaving the catalog unchanged, if any upsert is invalid.
+        """
+        with self._write_lock:
+            index = self._index.with_changes(upserts, deletes, self._index.version + 1)
+            if index.needs_compaction():
+                index = index.compact(index.version)
+            self._index = index
+            return index.version
+    
+    def compact(self):
+        """Force a compaction of the current snapshot"""
+        with self._write_lock:
+            self._index = self._index.compact(self._index.version + 1)
+            return self._index.version
+    
+    def get_product(self, product_id):
+        index = self._index
+        row = index.row_of(product_id)
+        return None if row is None else index.products[row]
+    
+    def _hits(self, index, query, category, max_price, min_rating, sort=None):
+        """Rows matching the query and filters, their ranking keys, and their relevance.
+        
+        Relevance is the similarity to a text query, None when browsing. Rows
+        rank by the sort key (see SearchIndex.sort_scores) when sorting, by
+        relevance otherwise; the keys are None when browsing without a sort.
+        """
+        if not query:
+            # Filter-only browsing reads the secondary indexes
+            with timed('filter'):
+                rows = index.browse_rows(category, max_price, min_rating)
+            return rows, index.sort_scores(rows, sort) if sort else None, None
+        
+        # Text-based search using the TF-IDF postings
+        with timed('filter'):
+            mask = index.filter_mask(category, max_price, min_rating)
+        rows, scores = index.score_query(query, mask)
+        return rows, index.sort_scores(rows, sort) if sort else scores, scores
+    
+    def _materialize(self, index, rows, scores, order):
+        with timed('materialize'):
+            if scores is None:
+                return [ProductView(index.products, rows[i]) for i in order]
+            return [ProductView(index.products, rows[i], float(scores[i])) for i in order]
+    
+    def search_products(self, query, category=None, max_price=None, min_rating=None, limit=None, sort=None):
+        """Search products based on query and filters.
+        
+        Filters are applied as vectorized masks before scoring, only products
+        matching a query term are scored, and only the best `limit` hits (all
+        hits when limit is None) are selected, as views over the catalog.
+        `sort` (a SORT_ORDERS key) orders hits by price or rating instead.
+        """
+        if sort is not None and sort not in SORT_ORDERS:
+            raise ValueError('invalid sort')
+        with metrics.traced('search_products', query=query, category=category, max_price=max_price,
+                            min_rating=min_rating, sort=sort):
+            index = self._index
+            rows, keys, scores = self._hits(index, query, category, max_price, min_rating, sort)
+            with timed('rank'):
+                order = rank_hits(keys, index.ids[rows], len(rows) if limit is None else limit)
+            return self._materialize(index, rows, scores, order)
+    
+    def _query_key(self, query):
+        """Queries that analyze to the same terms get the same results"""
+        return None if not query else tuple(sorted(self.analyzer(query)))
+    
+    def search_page(self, query, category=None, max_price=None, min_rating=None,
+                    limit=DEFAULT_PAGE_SIZE, offset=0, cursor=None, sort=None, facets=False):
+        """One page of search results with the total hit count and a next-page cursor.
+        
+        Only offset + limit hits are ranked and only the page itself is
+        materialized. The cursor records the (ranking key, id) of the last result, so deep
+        pages skip everything already shown instead of ranking it again;
+        `offset` then counts from the cursor. Sorted browsing reads just the
+        head of a sorted secondary index when the filters allow it. With
+        `facets`, the page also counts the whole result set per category,
+        price bucket and rating bucket. Pages are served from the result
+        cache when the same request was answered under this version. Raises
+        ValueError for a bad cursor or sort.
+        """
+        if sort is not None and sort not in SORT_ORDERS:
+            raise ValueError('invalid sort')
+        with metrics.traced('search_page', query=query, category=category, max_price=max_price,
+                            min_rating=min_rating, offset=offset, cursor=cursor, sort=sort):
+            index = self._index
+            key = ('search', self._query_key(query), (category or '').lower(), max_price, min_rating,
+                   limit, offset, cursor, sort, facets)
+            return self.cache.get_or_compute(key, index.version, lambda: self._search_page(
+                index, query, category, max_price, min_rating, limit, offset, cursor, sort, facets))
+    
+    def _search_page(self, index, query, category, max_price, min_rating, limit, offset, cursor, sort=None,
+                     facets=False):
+        sliced = None
+        if sort and not query and not cursor:
+            with timed('filter'):
+                sliced = index.sorted_slice(sort, offset + limit, category, max_price, min_rating)
+        if sliced is not None:
+            rows, keys, total = sliced
+            scores = None
         else:
-            self.tfidf_matrix = None
+            rows, keys, scores = self._hits(index, query, category, max_price, min_rating, sort)
+            total = len(rows)
+        
+        page_facets = None
+        if facets:
+            hits = rows if sliced is None else index.browse_rows(category, max_price, min_rating)
+            page_facets = self._facets(index, hits)
+        ids = index.ids[rows]
+        
+        if cursor:
+            last_key, last_id = decode_cursor(cursor)
+            if keys is None:
+                after = ids > last_id
+            elif last_key is None:
+                raise ValueError('invalid cursor')
+            else:
+                after = (keys < last_key) | ((keys == last_key) & (ids > last_id))
+            rows, ids, keys = rows[after], ids[after], None if keys is None else keys[after]
+            scores = None if scores is None else scores[after]
+        
+        with timed('rank'):
+            order = rank_hits(keys, ids, offset + limit)[offset:]
+        next_cursor = None
+        remaining = total if sliced is not None else len(rows)
+        if len(order) and offset + len(order) < remaining:
+            last = order[-1]
+            next_cursor = encode_cursor(None if keys is None else float(keys[last]), int(ids[last]))
+        
+        page = {
+            'results': self._materialize(index, rows, scores, order),
+            'total': total,
+            'limit': limit,
+            'offset': offset,
+            'next_cursor': next_cursor,
+        }
+        if page_facets is not None:
+            page['facets'] = page_facets
+        return page
+    
+    def _facets(self, index, rows):
+        with timed('facets'):
+            categories, prices, ratings = index.facet_counts(rows)
+        by_count = sorted(zip(index.category_names, categories.tolist()), key=lambda item: (-item[1], item[0]))
+        return {
+            'category': [{'value': name, 'count': count} for name, count in by_count if count],
+            'price': [dict(bucket, count=count) for bucket, count in zip(PRICE_FACETS, prices.tolist())],
+            'rating': [dict(bucket, count=count) for bucket, count in zip(RATING_FACETS, ratings.tolist())],
+        }
+    
+    def category_counts(self):
+        """(name, live product count) of every category that has products, by name"""
+        index = self._index
+        return self.cache.get_or_compute(('categories',), index.version, lambda: sorted(
+            (facet['value'], facet['count'])
+            for facet in self._facets(index, np.flatnonzero(index.alive))['category']))
+    
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        """Type-ahead completions for a partial query.
+        
+        Matches any word of a category name, tag or product name that starts
+        with `prefix`, ranked by how many products carry the suggestion and
+        then by rating. Product suggestions carry the product id.
+        """
+        with metrics.traced('suggest', prefix=prefix):
+            return self._index.suggest(prefix, limit)
+    
+    def get_recommendations(self, product_id, num_recommendations=4):
+        """Get product recommendations based on similarity.
+        
+        With a co-occurrence matrix loaded, text neighbors and products often
+        viewed or bought together are ranked by a blend of both scores.
+        """
+        with metrics.traced('get_recommendations', product_id=product_id):
+            index = self._index
+            behavior = self.behavior
+            key = ('recommend', product_id, num_recommendations, None if behavior is None else behavior.log_offset)
+            return self.cache.get_or_compute(key, index.version, lambda: self._recommendations(
+                index, product_id, num_recommendations, behavior))
+    
+    def _recommendations(self, index, product_id, num_recommendations, behavior=None):
+        with timed('lookup'):
+            target_idx = index.row_of(product_id)
+        if target_idx is None:
+            return []
+        
+        # Served from the precomputed neighbor table when it is deep enough
+        with timed('neighbors'):
+            similar_indices = index.neighbors(target_idx)[:num_recommendations]
+            if not index.neighbors_cover(target_idx, num_recommendations):
+                similar_indices, _ = index._top_neighbors(np.array([target_idx]), num_recommendations)
+                similar_indices = similar_indices[0][similar_indices[0] >= 0]
+        
+        if behavior is not None:
+            with timed('blend'):
+                co_ids, co_scores = behavior.neighbors(product_id)
+                co_rows = [index.row_of(co_id) for co_id in co_ids.tolist()]
+                known = np.array([row is not None for row in co_rows], dtype=bool)
+                similar_indices = index.blend_neighbors(
+                    target_idx, np.concatenate([similar_indices, index.neighbors(target_idx)]),
+                    np.array([row for row in co_rows if row is not None], dtype=np.int64), co_scores[known],
+                    num_recommendations)
+        
+        with timed('materialize'):
+            return [index.products[i] for i in similar_indices]
     
-    def search_products(self, query, category=None, max_price=None, min_rating=None):
-        """Search products based on query and filters"""
-        results = []
+    def recommend_for_session(self, product_ids, weights=None, session_id=None, num_recommendations=4):
+        """Personalized recommendations from the products a session viewed.
         
-        # Text-based search using TF-IDF
-        if query and self.tfidf_matrix is not None:
-            query_vec = self.vectorizer.transform([query])
-            similarities = cosine_similarity(query_vec, self.tfidf_matrix).flatten()
+        `product_ids` are listed oldest first, optionally with a weight each
+        (e.g. higher for carted products), and recency decays them further.
+        Their TF-IDF rows are summed into one profile vector that is scored
+        against the catalog; the products listed are never recommended.
+        With a `session_id` the profile is cached, and a later call whose
+        list extends the cached one only folds in the new views. Raises
+        ValueError when weights and ids differ in length.
+        """
+        if weights is None:
+            weights = [1.0] * len(product_ids)
+        if len(weights) != len(product_ids):
+            raise ValueError('expected one weight per product id')
+        product_ids, weights = list(product_ids), [float(weight) for weight in weights]
+        
+        with metrics.traced('recommend_for_session', session_id=session_id, views=len(product_ids)):
+            index = self._index
+            previous, known = None, 0
+            cached = None if session_id is None else self.sessions.get(('session', session_id), index.version)
+            if cached is not None:
+                seen_ids, seen_weights, indices, data = cached
+                if (tuple(product_ids[:len(seen_ids)]) == seen_ids and
+                        tuple(weights[:len(seen_ids)]) == seen_weights):
+                    previous = sp.csr_matrix((data, indices, [0, len(indices)]), shape=(1, index.n_terms))
+                    known = len(seen_ids)
             
-            for i, similarity in enumerate(similarities):
-                product = self.products[i].copy()
-                product['similarity_score'] = similarity
-                results.append(product)
+            with timed('profile'):
+                profile = index.profile_vector(product_ids[known:], weights[known:], previous)
+            if session_id is not None:
+                self.sessions.put(('session', session_id), index.version,
+                                  (tuple(product_ids), tuple(weights), profile.indices.copy(), profile.data.copy()))
             
-            # Sort by similarity score
-            results.sort(key=lambda x: x['similarity_score'], reverse=True)
-        else:
-            results = [product.copy() for product in self.products]
+            with timed('score'):
+                seen = [index.row_of(product_id) for product_id in product_ids]
+                rows, _ = index.profile_neighbors(profile, [row for row in seen if row is not None],
+                                                  num_recommendations)
+            with timed('materialize'):
+                return [index.products[row] for row in rows]
+    
+    def get_recommendations_batch(self, product_ids, num_recommendations=4):
+        """Recommendations for many products at once, in the order given.
         
-        # Apply filters
-        filtered_results = []
-        for product in results:
-            if category and product['category'].lower() != category.lower():
-                continue
-            if max_price and product['price'] > max_price:
-                continue
-            if min_rating and product['rating'] < min_rating:
+        Neighbor-table hits are gathered directly; products whose table entry
+        is too shallow are scored together, one matrix-matrix product per
+        block, rather than one similarity pass each. Unknown ids get [].
+        """
+        index = self._index
+        if self.behavior is not None:
+            behavior = self.behavior
+            return [self._recommendations(index, product_id, num_recommendations, behavior)
+                    for product_id in product_ids]
+        rows = [index.row_of(product_id) for product_id in product_ids]
+        recommendations = [[] for _ in product_ids]
+        
+        exact = []
+        for position, row in enumerate(rows):
+            if row is None:
                 continue
-            filtered_results.append(product)
+            if not index.neighbors_cover(row, num_recommendations):
+                exact.append(position)
+            else:
+                recommendations[position] = [index.products[i] for i in index.neighbors(row)[:num_recommendations]]
         
-        return filtered_results
+        if exact:
+            neighbor_ids, _ = index._top_neighbors(np.array([rows[position] for position in exact]), num_recommendations)
+            for position, neighbors in zip(exact, neighbor_ids):
+                recommendations[position] = [index.products[i] for i in neighbors[neighbors >= 0]]
+        return recommendations
     
-    def get_recommendations(self, product_id, num_recommendations=4):
-        """Get product recommendations based on similarity"""
-        if self.tfidf_matrix is None:
-            return []
+    def measure_ann_recall(self, k=10, sample=200, n_probes=(1, 2, 4, 8, 16), rerank=None, seed=0):
+        """Recall@k and latency of the dense ANN path against exact TF-IDF neighbors.
         
-        # Find the target product
-        target_idx = None
-        for i, product in enumerate(self.products):
-            if product['id'] == product_id:
-                target_idx = i
-                break
+        Samples live base rows, computes their exact neighbors once and then
+        the ANN neighbors at every n_probe setting, so a setting can be picked
+        from measurements. Only available in dense mode.
+        """
+        index = self._index
+        if index.ann is None:
+            raise ValueError('dense mode is not enabled for this index')
+        live = np.flatnonzero(index.alive[:index.n_base])
+        rows = np.random.default_rng(seed).choice(live, min(sample, len(live)), replace=False)
         
-        if target_idx is None:
-            return []
+        started = time.perf_counter()
+        exact, _ = index._exact_top_neighbors(rows, k)
+        exact_ms = (time.perf_counter() - started) * 1000 / max(1, len(rows))
+        
+        report = {'k': k, 'sample': len(rows), 'rerank': index.ann.rerank if rerank is None else rerank,
+                  'exact_ms_per_query': exact_ms, 'settings': []}
+        for n_probe in n_probes:
+            started = time.perf_counter()
+            approx, _ = index.ann.search(rows, k, index.alive, n_probe=n_probe, rerank=rerank)
+            ann_ms = (time.perf_counter() - started) * 1000 / max(1, len(rows))
+            found = expected = 0
+            for truth, guess in zip(exact, approx):
+                truth = set(truth[truth >= 0].tolist())
+                found += len(truth & set(guess.tolist()))
+                expected += len(truth)
+            report['settings'].append({
+                'n_probe': n_probe,
+                'recall_at_k': found / expected if expected else 1.0,
+                'ann_ms_per_query': ann_ms,
+            })
+        return report
+    
+    def measure_precision(self, k=10, sample=200, queries=None, seed=0):
+        """Top-k overlap of the index's scoring with full-precision scoring.
         
-        # Calculate similarities
-        target_vec = self.tfidf_matrix[target_idx]
-        similarities = cosine_similarity(target_vec, self.tfidf_matrix).flatten()
+        Full-precision weights are rebuilt from the stored counts, so any
+        precision can be measured on its own. Samples live base rows and
+        compares their k nearest neighbors and, for every query (the sampled
+        products' names by default), the k best search hits over the base
+        segment. Also reports the bytes the index holds.
+        """
+        index = self._index
+        base = np.zeros(index.n_rows, dtype=bool)
+        base[:index.n_base] = index.alive[:index.n_base]
+        live = np.flatnonzero(base)
+        rows = np.random.default_rng(seed).choice(live, min(sample, len(live)), replace=False)
+        if queries is None:
+            queries = [index.products.field(row, 'name') for row in rows]
+        full = index._base_vectors(np.arange(index.n_base))
         
-        # Get top similar products (excluding the target itself)
-        similar_indices = similarities.argsort()[::-1][1:num_recommendations+1]
-        recommendations = [self.products[i] for i in similar_indices if i != target_idx]
+        def overlap(truth_rows, truth_scores, guess_rows, guess_scores):
+            truth = set(truth_rows[rank_hits(truth_scores, index.ids[truth_rows], k)].tolist())
+            guess = set(guess_rows[rank_hits(guess_scores, index.ids[guess_rows], k)].tolist())
+            return len(truth & guess) / len(truth) if truth else 1.0
         
-        return recommendations
+        neighbor_overlap = []
+        for row in rows:
+            vector = full[row]
+            exact = (full @ vector.T).toarray().ravel()
+            exact[row] = 0
+            truth = np.flatnonzero((exact > 0) & base[:index.n_base])
+            guess_rows, guess_scores = index._score_postings(vector, base)
+            keep = (guess_rows != row) & (guess_scores > 0)
+            neighbor_overlap.append(overlap(truth, exact[truth], guess_rows[keep], guess_scores[keep]))
+        search_overlap = []
+        for query in queries:
+            vector = index.vectorize([query])
+            exact = (full @ vector.T).toarray().ravel()
+            truth = np.flatnonzero((exact > 0) & base[:index.n_base])
+            search_overlap.append(overlap(truth, exact[truth], *index._score_postings(vector, base)))
+        return {
+            'precision': index.precision,
+            'k': k,
+            'sample': len(rows),
+            'queries': len(search_overlap),
+            'neighbor_overlap_at_k': float(np.mean(neighbor_overlap)) if neighbor_overlap else 1.0,
+            'search_overlap_at_k': float(np.mean(search_overlap)) if search_overlap else 1.0,
+            'index_bytes': index.nbytes,
+            'index_bytes_per_product': index.nbytes / max(1, index.n_rows),
+        }
+    
+    def search_batch(self, queries, category=None, max_price=None, min_rating=None, limit=DEFAULT_PAGE_SIZE):
+        """First page of results for many text queries sharing the same filters.
+        
+        All queries are vectorized together and scored against the catalog
+        with one sparse matrix-matrix product, then the top `limit` of every
+        row is selected in one vectorized pass. Empty queries browse the
+        filtered catalog, as they do in search_page.
+        """
+        index = self._index
+        text = [query for query in queries if query]
+        mask = index.filter_mask(category, max_price, min_rating)
+        scores = index.similarities(index.vectorize([index.correct(query) for query in text]))
+        top, totals = top_k_per_row(scores, limit, index.ids, mask)
+        searched = iter(zip(top, totals))
+        browsed = None
+        
+        pages = []
+        for query in queries:
+            if not query:
+                if browsed is None:
+                    rows, _, _ = self._hits(index, query, category, max_price, min_rating)
+                    browsed = rows, rank_hits(None, index.ids[rows], limit)
+                rows, order = browsed
+                pages.append({'results': self._materialize(index, rows, None, order), 'total': len(rows)})
+                continue
+            (rows, row_scores), total = next(searched)
+            pages.append({
+                'results': self._materialize(index, rows, row_scores, range(len(rows))),
+                'total': int(total),
+            })
+        return pages
+
+def build_sharded_index(products, path, n_shards, chunk_size=INGEST_CHUNK_SIZE, precision='float64'):
+    """Split products across n_shards saved indexes with catalog-wide term statistics.
+    
+    Terms are counted with one vocabulary for the whole catalog and every
+    shard is weighted with the IDF of the whole catalog rather than of its
+    own rows, so a query vectorizes identically in every shard and their
+    cosine scores can be merged directly. Shards skip the neighbor table;
+    ShardedSearch scores recommendations across all shards instead.
+    """
+    analyzer = text_analyzer()
+    vocabulary = {}
+    catalogs = [CatalogBuilder() for _ in range(n_shards)]
+    parts = [[] for _ in range(n_shards)]
+    for chunk in chunked(products, chunk_size):
+        counts = count_terms((product_text(product) for product in chunk), vocabulary, analyzer)
+        owners = np.array([shard_of(product['id'], n_shards) for product in chunk])
+        for product, owner in zip(chunk, owners):
+            catalogs[owner].add(product)
+        for shard in range(n_shards):
+            parts[shard].append(counts[np.flatnonzero(owners == shard)])
+    
+    n_terms = len(vocabulary)
+    counts = [sp.vstack([_widen(part, n_terms) for part in shard_parts]).tocsr() if shard_parts
+              else sp.csr_matrix((0, n_terms)) for shard_parts in parts]
+    idf = smooth_idf(sum(np.bincount(shard_counts.indices, minlength=n_terms) for shard_counts in counts),
+                     sum(shard_counts.shape[0] for shard_counts in counts))
+    os.makedirs(path, exist_ok=True)
+    for shard, (catalog, shard_counts) in enumerate(zip(catalogs, counts)):
+        index = SearchIndex._from_counts(catalog.build(), shard_counts, vocabulary, analyzer, 0, 1, idf=idf,
+                                         precision=precision)
+        index.save(os.path.join(path, f'shard-{shard}'))
+    with open(os.path.join(path, 'shards.json'), 'w') as f:
+        json.dump({'format': INDEX_FORMAT, 'shards': n_shards}, f)
+
+# The shard served by a ShardedSearch worker process
+_shard = None
+
+def _open_shard(path):
+    global _shard
+    _shard = ProductSearch.load(path)
+
+def _shard_size():
+    return _shard.index.n_rows - _shard.index.n_dead
+
+def _shard_page(query, category, max_price, min_rating, k, cursor, sort, facets):
+    """Total, and ranking key, id and JSON of the shard's best k hits, plus facets"""
+    page = _shard.search_page(query, category, max_price, min_rating, limit=k, offset=0, cursor=cursor, sort=sort,
+                              facets=facets)
+    results = page['results']
+    if sort:
+        # The same key SearchIndex.sort_scores ranks by
+        field, descending = SORT_ORDERS[sort]
+        keys = [product[field] if descending else -product[field] for product in results]
+    else:
+        keys = [product.get('similarity_score') for product in results]
+    return (page['total'], keys,
+            [product['id'] for product in results], [product.json_bytes() for product in results],
+            page.get('facets'))
+
+def _shard_vector(product_id):
+    index = _shard.index
+    row = index.row_of(product_id)
+    if row is None:
+        return None
+    vector = index.row_vectors(np.array([row]))
+    return vector.indices, vector.data
+
+def _shard_neighbors(indices, data, product_id, k):
+    """Score, id and JSON of the shard's k rows most similar to a row vector"""
+    index = _shard.index
+    vector = sp.csr_matrix((data, indices, [0, len(indices)]), shape=(1, index.n_terms))
+    row = index.row_of(product_id)
+    rows, scores = index.profile_neighbors(vector, [] if row is None else [row], k)
+    return scores, index.ids[rows], [index.products.json_bytes(row) for row in rows]
+
+def _shard_product(product_id):
+    product = _shard.get_product(product_id)
+    return None if product is None else product.json_bytes()
+
+class ShardedSearch:
+    """Scatter-gather search over an index written by build_sharded_index.
+    
+    Each shard is opened by its own worker process, so one query is scored
+    on as many cores as there are shards. Every shard returns its local
+    best offset + limit hits and they are merged with the same (score, id)
+    ranking ProductSearch uses; since the shards share the catalog's
+    vocabulary and IDF the merged page equals the unsharded one. Results
+    are plain dicts. Shards are read-only: catalog changes go through a
+    rebuild.
+    """
+    
+    def __init__(self, path):
+        with open(os.path.join(path, 'shards.json')) as f:
+            meta = json.load(f)
+        if meta['format'] != INDEX_FORMAT:
+            raise ValueError(f"unsupported index format {meta['format']} in {path}")
+        # Forked workers inherit the loaded module instead of importing it again
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        self.executors = [ProcessPoolExecutor(1, mp_context=context, initializer=_open_shard,
+                                              initargs=(os.path.join(path, f'shard-{shard}'),))
+                          for shard in range(meta['shards'])]
+        # Start every worker now, before the caller starts threads of its own
+        self.sizes = self._scatter(_shard_size)
+    
+    def _scatter(self, function, *args):
+        futures = [executor.submit(function, *args) for executor in self.executors]
+        return [future.result() for future in futures]
+    
+    def _owner(self, product_id):
+        return self.executors[shard_of(product_id, len(self.executors))]
+    
+    def get_product(self, product_id):
+        product = self._owner(product_id).submit(_shard_product, product_id).result()
+        return None if product is None else json.loads(product)
+    
+    def search_products(self, query, category=None, max_price=None, min_rating=None, limit=DEFAULT_PAGE_SIZE,
+                        sort=None):
+        return self.search_page(query, category, max_price, min_rating, limit=limit, sort=sort)['results']
+    
+    def search_page(self, query, category=None, max_price=None, min_rating=None,
+                    limit=DEFAULT_PAGE_SIZE, offset=0, cursor=None, sort=None, facets=False):
+        """One page of results merged from every shard; see ProductSearch.search_page"""
+        if sort is not None and sort not in SORT_ORDERS:
+            raise ValueError('invalid sort')
+        if cursor:
+            decode_cursor(cursor)
+        with metrics.traced('sharded_search_page', query=query, category=category, max_price=max_price,
+                            min_rating=min_rating, offset=offset, cursor=cursor, sort=sort):
+            # One hit past the page tells whether there is a next one
+            with timed('scatter'):
+                parts = self._scatter(_shard_page, query, category, max_price, min_rating, offset + limit + 1,
+                                      cursor, sort, facets)
+            with timed('merge'):
+                ids = np.array([product_id for part in parts for product_id in part[2]], dtype=np.int64)
+                scores = None
+                if query or sort:
+                    scores = np.array([score for part in parts for score in part[1]], dtype=np.float64)
+                bodies = [body for part in parts for body in part[3]]
+                order = rank_hits(scores, ids, offset + limit + 1)
+                page_order = order[offset:offset + limit]
+                next_cursor = None
+                if len(page_order) and len(order) > offset + limit:
+                    last = page_order[-1]
+                    next_cursor = encode_cursor(None if scores is None else float(scores[last]), int(ids[last]))
+                page = {
+                    'results': [json.loads(bodies[i]) for i in page_order],
+                    'total': sum(part[0] for part in parts),
+                    'limit': limit,
+                    'offset': offset,
+                    'next_cursor': next_cursor,
+                }
+                if facets:
+                    page['facets'] = merge_facets([part[4] for part in parts])
+            return page
+    
+    def get_recommendations(self, product_id, num_recommendations=4):
+        """Products most similar to a product across all shards.
+        
+        The owning shard supplies the product's TF-IDF row and every shard
+        scores it against its own rows.
+        """
+        with metrics.traced('sharded_get_recommendations', product_id=product_id):
+            with timed('lookup'):
+                vector = self._owner(product_id).submit(_shard_vector, product_id).result()
+            if vector is None:
+                return []
+            with timed('scatter'):
+                parts = self._scatter(_shard_neighbors, *vector, product_id, num_recommendations)
+            with timed('merge'):
+                scores = np.concatenate([part[0] for part in parts])
+                ids = np.concatenate([part[1] for part in parts])
+                bodies = [body for part in parts for body in part[2]]
+                return [json.loads(bodies[i]) for i in rank_hits(scores, ids, num_recommendations)]
+    
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown()
+
+def merge_facets(parts):
+    """Facet counts of several shards added up, categories matched by name"""
+    categories, names = Counter(), {}
+    for part in parts:
+        for facet in part['category']:
+            names.setdefault(facet['value'].lower(), facet['value'])
+            categories[facet['value'].lower()] += facet['count']
+    by_count = sorted(((names[key], count) for key, count in categories.items()), key=lambda item: (-item[1], item[0]))
+    return {
+        'category': [{'value': name, 'count': count} for name, count in by_count],
+        'price': [dict(bucket, count=sum(part['price'][i]['count'] for part in parts))
+                  for i, bucket in enumerate(PRICE_FACETS)],
+        'rating': [dict(bucket, count=sum(part['rating'][i]['count'] for part in parts))
+                   for i, bucket in enumerate(RATING_FACETS)],
+    }
+
+def load_search_system(publish):
+    """Open the configured catalog, then build or load its full search system.
+    
+    The catalog comes from a prebuilt index when one is configured, else
+    from a catalog file, else from the sample products. As soon as it is
+    available it is published through publish(search, 'warming') behind a
+    CatalogSnapshot; the full search system, behavior data included, is
+    published with publish(search, 'ready').
+    """
+    if os.environ.get(INDEX_DIR_ENV):
+        path = os.environ[INDEX_DIR_ENV]
+        publish(ProductSearch(snapshot=CatalogSnapshot.from_saved(path)), 'warming')
+        search = ProductSearch.load(path)
+    elif os.environ.get(CATALOG_FILE_ENV):
+        stats = {'rows': 0, 'skipped': 0, 'errors': []}
+        catalog = Catalog.from_products(valid_products(read_catalog_rows(os.environ[CATALOG_FILE_ENV]), stats))
+        publish(ProductSearch(snapshot=CatalogSnapshot.from_catalog(catalog)), 'warming')
+        search = ProductSearch(catalog, chunk_size=INGEST_CHUNK_SIZE, precision=index_precision)
+        search.ingest_stats = stats
+    else:
+        publish(ProductSearch(snapshot=CatalogSnapshot.from_catalog(Catalog.from_products(products))), 'warming')
+        search = ProductSearch(products, precision=index_precision)
+    if os.environ.get(CO_INDEX_DIR_ENV):
+        search.load_behavior(os.environ[CO_INDEX_DIR_ENV])
+    elif os.environ.get(EVENT_LOG_ENV):
+        search.ingest_events(os.environ[EVENT_LOG_ENV])
+    publish(search, 'ready')
+
+class Startup:
+    """Loads the search system on a background thread so the app serves at once.
+    
+    The state is 'starting' until the raw catalog is available, 'warming'
+    while a CatalogSnapshot serves product pages and filter-only browsing,
+    then 'ready' once the full index is published, or 'failed'. A search
+    system installed into the module by anyone else in the meantime (a test
+    or the benchmark) is left in place. Nothing is loaded until start() or
+    run() is called, by a serve entry point or the first request.
+    """
+    
+    def __init__(self):
+        self.state = 'starting'
+        self.error = None
+        self.started_at = time.time()
+        self.timings = {}
+        self.thread = None
+        self._published = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+    
+    def start(self):
+        """Load on a background thread, unless a load was already started"""
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='startup', daemon=True)
+                self.thread.start()
+    
+    def run(self):
+        """Load in the calling thread, or wait for a load already started to end.
+        
+        For a process that forks: once this returns no startup thread is left
+        running, so none can hold a lock across the fork.
+        """
+        with self._lock:
+            thread = self.thread
+            if thread is None:
+                # Keeps a later start() from loading a second time
+                self.thread = threading.current_thread()
+        if thread is None:
+            self._run()
+        else:
+            thread.join()
+    
+    def wait(self, timeout=None):
+        """Block until startup has finished; True when the full index is served"""
+        self._done.wait(timeout)
+        return self.state == 'ready'
+    
+    def _publish(self, search, state):
+        global search_system
+        with self._lock:
+            if search_system is self._published:
+                search_system = search
+            self._published = search
+            self.state = state
+            self.timings[state] = time.time() - self.started_at
+    
+    def _run(self):
+        try:
+            load_search_system(self._publish)
+        except Exception as error:
+            logging.getLogger(__name__).exception('Startup failed')
+            self.error = f'{type(error).__name__}: {error}'
+            self.state = 'failed'
+        finally:
+            self._done.set()
+    
+    def status(self):
+        return {
+            'state': self.state,
+            'uptime_seconds': time.time() - self.started_at,
+            # Seconds after startup at which each state was reached
+            'timings': dict(self.timings),
+            'error': self.error,
+        }
 
-# Initialize search system
-search_system = ProductSearch(products)
+# The search system is loaded in the background; requests that arrive before
+# it has a catalog to serve are answered 503. Importing the module loads
+# nothing: the serve commands start the load, and a server that imports the
+# app (e.g. `gunicorn ecommerceWeb:app`) starts it with the first request.
+index_precision = os.environ.get(INDEX_PRECISION_ENV, 'float64')
+search_system = None
+startup = Startup()
 
 # HTML Templates
 HTML_TEMPLATE = '''
@@ -327,6 +3801,41 @@ HTML_TEMPLATE = '''
         .view-details:hover {
             background: #764ba2;
         }
+        .pagination {
+            display: flex;
+            justify-content: center;
+            gap: 15px;
+            margin-top: 30px;
+        }
+        .pagination a {
+            background: white;
+            color: #667eea;
+            padding: 10px 20px;
+            border-radius: 6px;
+            text-decoration: none;
+            font-weight: 600;
+        }
+        .facets {
+            background: white;
+            padding: 15px 20px;
+            border-radius: 10px;
+            margin-bottom: 20px;
+        }
+        .facet-group {
+            display: flex;
+            flex-wrap: wrap;
+            gap: 10px;
+            margin: 5px 0;
+            color: #666;
+        }
+        .facet-name {
+            font-weight: 600;
+            color: #333;
+        }
+        .facet-group a {
+            color: #667eea;
+            text-decoration: none;
+        }
         @media (max-width: 768px) {
             .search-form {
                 grid-template-columns: 1fr;
@@ -348,16 +3857,16 @@ HTML_TEMPLATE = '''
             <form id="searchForm" class="search-form">
                 <div class="form-group">
                     <label for="search">Search Products:</label>
-                    <input type="text" id="search" name="search" placeholder="Enter product name, description, or keywords...">
+                    <input type="text" id="search" name="search" placeholder="Enter product name, description, or keywords..." list="suggestions" autocomplete="off">
+                    <datalist id="suggestions"></datalist>
                 </div>
                 <div class="form-group">
                     <label for="category">Category:</label>
                     <select id="category" name="category">
                         <option value="">All Categories</option>
-                        <option value="Electronics">Electronics</option>
-                        <option value="Sports">Sports</option>
-                        <option value="Home">Home</option>
-                        <option value="Fashion">Fashion</option>
+                        {% for name, count in categories %}
+                        <option value="{{ name }}" {% if category and name|lower == category|lower %}selected{% endif %}>{{ name }} ({{ count }})</option>
+                        {% endfor %}
                     </select>
                 </div>
                 <div class="form-group">
@@ -368,30 +3877,48 @@ HTML_TEMPLATE = '''
                     <label for="min_rating">Min Rating:</label>
                     <input type="number" id="min_rating" name="min_rating" placeholder="Min rating" min="0" max="5" step="0.1">
                 </div>
+                <div class="form-group">
+                    <label for="sort">Sort By:</label>
+                    <select id="sort" name="sort">
+                        <option value="">Relevance</option>
+                        <option value="price_asc" {% if sort == 'price_asc' %}selected{% endif %}>Price: Low to High</option>
+                        <option value="price_desc" {% if sort == 'price_desc' %}selected{% endif %}>Price: High to Low</option>
+                        <option value="rating_desc" {% if sort == 'rating_desc' %}selected{% endif %}>Rating: High to Low</option>
+                        <option value="rating_asc" {% if sort == 'rating_asc' %}selected{% endif %}>Rating: Low to High</option>
+                    </select>
+                </div>
                 <button type="submit" class="search-btn">Search</button>
             </form>
         </div>
         
         <div id="resultsSection">
-            {% if products %}
-                <h2 class="section-title">Search Results ({{ products|length }} products found)</h2>
-                <div class="products-grid">
-                    {% for product in products %}
-                    <div class="product-card">
-                        <div class="product-image">
-                            <img src="{{ product.image }}" alt="{{ product.name }}" style="width: 100%; height: 100%; object-fit: cover;">
-                        </div>
-                        <div class="product-info">
-                            <div class="product-name">{{ product.name }}</div>
-                            <div class="product-category">{{ product.category }}</div>
-                            <div class="product-price">${{ "%.2f"|format(product.price) }}</div>
-                            <div class="product-rating">⭐ {{ product.rating }}/5</div>
-                            <div class="product-description">{{ product.description }}</div>
-                            <button class="view-details" onclick="viewProduct({{ product.id }})">View Details & Recommendations</button>
-                        </div>
+            {% if cards %}
+                <h2 class="section-title">Search Results ({{ total }} products found)</h2>
+                {% if facets %}
+                <div class="facets">
+                    <div class="facet-group">
+                        <span class="facet-name">Category:</span>
+                        {% for facet in facets.category %}<a href="{{ facet.url }}">{{ facet.value }} ({{ facet.count }})</a>{% endfor %}
                     </div>
-                    {% endfor %}
+                    <div class="facet-group">
+                        <span class="facet-name">Price:</span>
+                        {% for facet in facets.price if facet.count %}<span>{{ facet.label }} ({{ facet.count }})</span>{% endfor %}
+                    </div>
+                    <div class="facet-group">
+                        <span class="facet-name">Rating:</span>
+                        {% for facet in facets.rating if facet.count %}<span>⭐ {{ facet.label }} ({{ facet.count }})</span>{% endfor %}
+                    </div>
+                </div>
+                {% endif %}
+                <div class="products-grid">
+                    {% for card in cards %}{{ card }}{% endfor %}
                 </div>
+                {% if prev_url or next_url %}
+                <div class="pagination">
+                    {% if prev_url %}<a href="{{ prev_url }}">← Previous</a>{% endif %}
+                    {% if next_url %}<a href="{{ next_url }}">Next →</a>{% endif %}
+                </div>
+                {% endif %}
             {% else %}
                 <div class="no-results">
                     <p>No products found. Try adjusting your search criteria.</p>
@@ -399,25 +3926,11 @@ HTML_TEMPLATE = '''
             {% endif %}
         </div>
         
-        {% if recommendations %}
+        {% if recommendation_cards %}
         <div class="recommendations-section">
             <h2 class="section-title">Recommended Products</h2>
             <div class="products-grid">
-                {% for product in recommendations %}
-                <div class="product-card">
-                    <div class="product-image">
-                        <img src="{{ product.image }}" alt="{{ product.name }}" style="width: 100%; height: 100%; object-fit: cover;">
-                    </div>
-                    <div class="product-info">
-                        <div class="product-name">{{ product.name }}</div>
-                        <div class="product-category">{{ product.category }}</div>
-                        <div class="product-price">${{ "%.2f"|format(product.price) }}</div>
-                        <div class="product-rating">⭐ {{ product.rating }}/5</div>
-                        <div class="product-description">{{ product.description }}</div>
-                        <button class="view-details" onclick="viewProduct({{ product.id }})">View Details</button>
-                    </div>
-                </div>
-                {% endfor %}
+                {% for card in recommendation_cards %}{{ card }}{% endfor %}
             </div>
         </div>
         {% endif %}
@@ -435,6 +3948,29 @@ HTML_TEMPLATE = '''
             const params = new URLSearchParams(formData);
             window.location.href = '/search?' + params.toString();
         });
+        
+        // Type-ahead suggestions, ignoring answers that arrive out of order
+        let suggestRequest = 0;
+        document.getElementById('search').addEventListener('input', function() {
+            const current = ++suggestRequest;
+            const datalist = document.getElementById('suggestions');
+            if (!this.value.trim()) {
+                datalist.innerHTML = '';
+                return;
+            }
+            fetch('/api/suggest?prefix=' + encodeURIComponent(this.value))
+                .then(response => response.json())
+                .then(data => {
+                    if (current !== suggestRequest) return;
+                    datalist.innerHTML = '';
+                    data.suggestions.forEach(suggestion => {
+                        const option = document.createElement('option');
+                        option.value = suggestion.text;
+                        option.label = suggestion.type;
+                        datalist.appendChild(option);
+                    });
+                });
+        });
     </script>
 </body>
 </html>
@@ -640,24 +4176,11 @@ PRODUCT_TEMPLATE = '''
             </div>
         </div>
         
-        {% if recommendations %}
+        {% if recommendation_cards %}
         <div class="recommendations-section">
             <h2 class="section-title">You Might Also Like</h2>
             <div class="products-grid">
-                {% for rec_product in recommendations %}
-                <div class="product-card">
-                    <div class="product-card-image">
-                        <img src="{{ rec_product.image }}" alt="{{ rec_product.name }}" style="width: 100%; height: 100%; object-fit: cover;">
-                    </div>
-                    <div class="product-card-info">
-                        <div class="product-card-name">{{ rec_product.name }}</div>
-                        <div class="product-category">{{ rec_product.category }}</div>
-                        <div class="product-card-price">${{ "%.2f"|format(rec_product.price) }}</div>
-                        <div class="product-rating">⭐ {{ rec_product.rating }}/5</div>
-                        <button class="view-details" onclick="viewProduct({{ rec_product.id }})">View Details</button>
-                    </div>
-                </div>
-                {% endfor %}
+                {% for card in recommendation_cards %}{{ card }}{% endfor %}
             </div>
         </div>
         {% endif %}
@@ -672,9 +4195,178 @@ PRODUCT_TEMPLATE = '''
 </html>
 '''
 
+# Product cards are rendered once per product content and reused across pages
+SEARCH_CARD_TEMPLATE = '''
+                    <div class="product-card">
+                        <div class="product-image">
+                            <img src="{{ product.image }}" alt="{{ product.name }}" style="width: 100%; height: 100%; object-fit: cover;">
+                        </div>
+                        <div class="product-info">
+                            <div class="product-name">{{ product.name }}</div>
+                            <div class="product-category">{{ product.category }}</div>
+                            <div class="product-price">${{ "%.2f"|format(product.price) }}</div>
+                            <div class="product-rating">⭐ {{ product.rating }}/5</div>
+                            <div class="product-description">{{ product.description }}</div>
+                            <button class="view-details" onclick="viewProduct({{ product.id }})">View Details & Recommendations</button>
+                        </div>
+                    </div>
+'''
+
+RECOMMENDATION_CARD_TEMPLATE = '''
+                <div class="product-card">
+                    <div class="product-image">
+                        <img src="{{ product.image }}" alt="{{ product.name }}" style="width: 100%; height: 100%; object-fit: cover;">
+                    </div>
+                    <div class="product-info">
+                        <div class="product-name">{{ product.name }}</div>
+                        <div class="product-category">{{ product.category }}</div>
+                        <div class="product-price">${{ "%.2f"|format(product.price) }}</div>
+                        <div class="product-rating">⭐ {{ product.rating }}/5</div>
+                        <div class="product-description">{{ product.description }}</div>
+                        <button class="view-details" onclick="viewProduct({{ product.id }})">View Details</button>
+                    </div>
+                </div>
+'''
+
+RELATED_CARD_TEMPLATE = '''
+                <div class="product-card">
+                    <div class="product-card-image">
+                        <img src="{{ product.image }}" alt="{{ product.name }}" style="width: 100%; height: 100%; object-fit: cover;">
+                    </div>
+                    <div class="product-card-info">
+                        <div class="product-card-name">{{ product.name }}</div>
+                        <div class="product-category">{{ product.category }}</div>
+                        <div class="product-card-price">${{ "%.2f"|format(product.price) }}</div>
+                        <div class="product-rating">⭐ {{ product.rating }}/5</div>
+                        <button class="view-details" onclick="viewProduct({{ product.id }})">View Details</button>
+                    </div>
+                </div>
+'''
+
+# Templates are compiled once at startup; the digest ties ETags to their text
+search_page_template = app.jinja_env.from_string(HTML_TEMPLATE)
+product_page_template = app.jinja_env.from_string(PRODUCT_TEMPLATE)
+card_templates = {
+    'search': app.jinja_env.from_string(SEARCH_CARD_TEMPLATE),
+    'recommendation': app.jinja_env.from_string(RECOMMENDATION_CARD_TEMPLATE),
+    'related': app.jinja_env.from_string(RELATED_CARD_TEMPLATE),
+}
+TEMPLATE_DIGEST = hashlib.sha1((HTML_TEMPLATE + PRODUCT_TEMPLATE + SEARCH_CARD_TEMPLATE +
+                                RECOMMENDATION_CARD_TEMPLATE + RELATED_CARD_TEMPLATE).encode()).digest()
+card_cache = ResultCache(ttl=float('inf'))
+
+def _cards(kind, products):
+    """Rendered product cards, cached by the product's encoded JSON.
+    
+    The key is the product's content, so a card is re-rendered exactly
+    when its product changes and never needs explicit invalidation.
+    """
+    template = card_templates[kind]
+    cards = []
+    for product in products:
+        key = (kind, product.json_bytes(with_score=False))
+        card = card_cache.get(key, 0)
+        if card is None:
+            card = Markup(template.render(product=product))
+            card_cache.put(key, 0, card)
+        cards.append(card)
+    return cards
+
+def _etag(*parts):
+    digest = hashlib.sha1(TEMPLATE_DIGEST)
+    for part in parts:
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def _conditional(etag, last_modified, render):
+    """HTML response that is rendered only when the client's copy is stale.
+    
+    Pages carry an ETag and Last-Modified and must be revalidated; a client
+    whose If-None-Match (or If-Modified-Since) still matches gets a 304.
+    """
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        with timed('render'):
+            body = render()
+        response = app.response_class(body, mimetype='text/html')
+    else:
+        response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+def _last_modified(index):
+    return datetime.fromtimestamp(index.created_at, timezone.utc)
+
+def _json_response(value):
+    """Response whose body is assembled by encode_json()"""
+    with timed('serialize'):
+        body = encode_json(value)
+    return app.response_class(body, mimetype='application/json')
+
+def _page_args():
+    """limit/offset/cursor request arguments, with limit clamped to MAX_PAGE_SIZE"""
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE)), max(0, offset), request.args.get('cursor') or None
+
+@app.before_request
+def _begin_request_trace():
+    if request.endpoint != 'metrics_endpoint':
+        g.trace = metrics.begin(request.endpoint or 'not_found', {'path': request.path,
+                                                                         **request.args.to_dict()})
+
+@app.before_request
+def _require_search_system():
+    if search_system is None:
+        startup.start()
+        if request.endpoint not in ('health', 'ready'):
+            return _unavailable('the search system is starting up')
+
+@app.teardown_request
+def _end_request_trace(exc):
+    metrics.end(g.pop('trace', None))
+
+def _unavailable(message):
+    response = jsonify({'error': message, 'state': startup.state})
+    response.status_code = 503
+    response.retry_after = STARTUP_RETRY_AFTER
+    return response
+
+@app.errorhandler(IndexWarming)
+def _index_warming(error):
+    return _unavailable(str(error))
+
+@app.route('/health')
+def health():
+    """Liveness: answers as long as the process does, with the startup state"""
+    return jsonify(startup.status())
+
+@app.route('/ready')
+def ready():
+    """Readiness: 200 once requests can be served, else 503.
+    
+    While warming up only the catalog is served; with full=1 readiness
+    waits for the full index.
+    """
+    full = request.args.get('full', '0').lower() not in ('0', 'false', 'no')
+    serving = search_system is not None and (startup.state == 'ready' or not full)
+    return jsonify(dict(startup.status(), ready=serving)), 200 if serving else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    body = metrics.render(search_system, {'results': search_system.cache, 'cards': card_cache,
+                                          'sessions': search_system.sessions})
+    return app.response_class(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE, products=[], recommendations=[])
+    # The category list follows the catalog
+    index = search_system.index
+    etag = _etag(b'index', str(index.version).encode(), str(index.created_at).encode())
+    return _conditional(etag, _last_modified(index), lambda: search_page_template.render(
+        cards=[], recommendation_cards=[], categories=search_system.category_counts()))
 
 @app.route('/search')
 def search():
@@ -682,25 +4374,57 @@ def search():
     category = request.args.get('category', '')
     max_price = request.args.get('max_price', type=float)
     min_rating = request.args.get('min_rating', type=float)
+    sort = request.args.get('sort') if request.args.get('sort') in SORT_ORDERS else None
+    limit, offset, _ = _page_args()
     
-    results = search_system.search_products(
-        query=query,
-        category=category,
-        max_price=max_price,
-        min_rating=min_rating
-    )
+    # A results page only changes when a new index version is published
+    index = search_system.index
+    etag = _etag(str(index.version).encode(), str(index.created_at).encode(), request.full_path.encode())
+    
+    def render():
+        page = search_system.search_page(
+            query=query,
+            category=category,
+            max_price=max_price,
+            min_rating=min_rating,
+            limit=limit,
+            offset=offset,
+            sort=sort,
+            facets=True
+        )
+        
+        args = request.args.to_dict()
+        next_url = prev_url = None
+        if offset + len(page['results']) < page['total']:
+            next_url = url_for('search', **dict(args, offset=offset + limit))
+        if offset > 0:
+            prev_url = url_for('search', **dict(args, offset=max(0, offset - limit)))
+        category_links = [dict(facet, url=url_for('search', **dict(args, category=facet['value'], offset=0)))
+                          for facet in page['facets']['category']]
+        
+        return search_page_template.render(cards=_cards('search', page['results']), total=page['total'],
+                                           next_url=next_url, prev_url=prev_url, recommendation_cards=[],
+                                           sort=sort or '', category=category,
+                                           categories=search_system.category_counts(),
+                                           facets=dict(page['facets'], category=category_links))
     
-    return render_template_string(HTML_TEMPLATE, products=results, recommendations=[])
+    return _conditional(etag, _last_modified(index), render)
 
 @app.route('/product/<int:product_id>')
 def product_detail(product_id):
-    product = next((p for p in products if p['id'] == product_id), None)
+    product = search_system.get_product(product_id)
     if not product:
         return "Product not found", 404
     
-    recommendations = search_system.get_recommendations(product_id)
+    try:
+        recommendations = search_system.get_recommendations(product_id)
+    except IndexWarming:
+        recommendations = []
     
-    return render_template_string(PRODUCT_TEMPLATE, product=product, recommendations=recommendations)
+    # Cacheable until the product or one of its recommendations changes
+    etag = _etag(product.json_bytes(), *[rec.json_bytes() for rec in recommendations])
+    return _conditional(etag, _last_modified(search_system.index), lambda: product_page_template.render(
+        product=product, recommendation_cards=_cards('related', recommendations)))
 
 @app.route('/api/search')
 def api_search():
@@ -708,24 +4432,374 @@ def api_search():
     category = request.args.get('category', '')
     max_price = request.args.get('max_price', type=float)
     min_rating = request.args.get('min_rating', type=float)
+    limit, offset, cursor = _page_args()
     
-    results = search_system.search_products(
-        query=query,
-        category=category,
-        max_price=max_price,
-        min_rating=min_rating
-    )
+    try:
+        page = search_system.search_page(
+            query=query,
+            category=category,
+            max_price=max_price,
+            min_rating=min_rating,
+            limit=limit,
+            offset=offset,
+            cursor=cursor,
+            sort=request.args.get('sort') or None,
+            facets=request.args.get('facets', '1').lower() not in ('0', 'false', 'no')
+        )
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
     
-    return jsonify(results)
+    return _json_response(page)
+
+@app.route('/api/suggest')
+def api_suggest():
+    prefix = request.args.get('prefix', '')
+    limit = max(1, min(request.args.get('limit', SUGGEST_LIMIT, type=int), MAX_SUGGESTIONS))
+    return _json_response({'prefix': prefix, 'suggestions': search_system.suggest(prefix, limit)})
 
 @app.route('/api/recommend/<int:product_id>')
 def api_recommend(product_id):
     recommendations = search_system.get_recommendations(product_id)
-    return jsonify(recommendations)
+    return _json_response(recommendations)
+
+def _batch_items(field):
+    """List from a JSON request body, or None when it is missing or too long"""
+    items = (request.get_json(silent=True) or {}).get(field)
+    if not isinstance(items, list) or len(items) > MAX_BATCH_SIZE:
+        return None
+    return items
+
+@app.route('/api/recommend/batch', methods=['POST'])
+def api_recommend_batch():
+    product_ids = _batch_items('ids')
+    # JSON true and false arrive as bools, which are ints to isinstance
+    if product_ids is None or not all(type(product_id) is int for product_id in product_ids):
+        return jsonify({'error': f'expected "ids": a list of at most {MAX_BATCH_SIZE} product ids'}), 400
+    limit = max(1, min(request.args.get('limit', 4, type=int), MAX_PAGE_SIZE))
+    
+    recommendations = search_system.get_recommendations_batch(product_ids, limit)
+    return _json_response([{'id': product_id, 'recommendations': recs}
+                           for product_id, recs in zip(product_ids, recommendations)])
+
+@app.route('/api/recommend/session', methods=['POST'])
+def api_recommend_session():
+    body = request.get_json(silent=True) or {}
+    product_ids = _batch_items('ids')
+    if product_ids is None or not all(type(product_id) is int for product_id in product_ids):
+        return jsonify({'error': f'expected "ids": a list of at most {MAX_BATCH_SIZE} product ids'}), 400
+    weights = body.get('weights')
+    if weights is not None and not (isinstance(weights, list) and
+                                    all(type(weight) in (int, float) for weight in weights)):
+        return jsonify({'error': 'expected "weights": a list of numbers'}), 400
+    session_id = body.get('session')
+    limit = max(1, min(request.args.get('limit', 4, type=int), MAX_PAGE_SIZE))
+    
+    try:
+        recommendations = search_system.recommend_for_session(
+            product_ids, weights, None if session_id is None else str(session_id), limit)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    return _json_response(recommendations)
+
+@app.route('/api/search/batch', methods=['POST'])
+def api_search_batch():
+    queries = _batch_items('queries')
+    if queries is None or not all(isinstance(query, str) for query in queries):
+        return jsonify({'error': f'expected "queries": a list of at most {MAX_BATCH_SIZE} strings'}), 400
+    category = request.args.get('category', '')
+    max_price = request.args.get('max_price', type=float)
+    min_rating = request.args.get('min_rating', type=float)
+    limit, _, _ = _page_args()
+    
+    pages = search_system.search_batch(
+        queries,
+        category=category,
+        max_price=max_price,
+        min_rating=min_rating,
+        limit=limit
+    )
+    return _json_response([dict(page, query=query) for query, page in zip(queries, pages)])
+
+class ExecutorASGIApp:
+    """ASGI front end that runs the WSGI app on a bounded thread pool.
+    
+    The event loop only reads requests and writes responses; routing and
+    scoring run on at most `threads` threads, so slow queries cannot stall
+    the loop. At most `max_pending` further requests wait for a thread,
+    beyond that requests are answered 503 right away. On lifespan shutdown
+    the pool is drained before the server exits. The pool is created on
+    first use, so `threads` can still be changed until the app serves.
+    """
+    
+    def __init__(self, wsgi_app, threads=ASYNC_THREADS, max_pending=ASYNC_MAX_PENDING):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self._executor = None
+    
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='request')
+        return self._executor
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        if self.in_flight >= self.threads + self.max_pending:
+            await self._send(send, 503, [('Content-Type', 'text/plain'), ('Retry-After', '1')], b'Server busy')
+            return
+        
+        # Only touched from the event loop thread, so no lock is needed
+        self.in_flight += 1
+        try:
+            body = b''
+            while True:
+                message = await receive()
+                body += message.get('body', b'')
+                if not message.get('more_body'):
+                    break
+            environ = self._environ(scope, body)
+            loop = asyncio.get_running_loop()
+            status, headers, content = await loop.run_in_executor(self.executor, self._call_wsgi, environ)
+        finally:
+            self.in_flight -= 1
+        await self._send(send, status, headers, content)
+    
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    executor, self._executor = self._executor, None
+                    await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    @staticmethod
+    async def _send(send, status, headers, content):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+        await send({'type': 'http.response.body', 'body': content})
+    
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope['http_version'],
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            if name == 'content-length':
+                continue
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+                continue
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+    
+    def _call_wsgi(self, environ):
+        response = {}
+        
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+        
+        result = self.wsgi_app(environ, start_response)
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], content
+
+# The ASGI entry point, e.g. `uvicorn ecommerceWeb:asgi_app`; serve_async serves it too
+asgi_app = ExecutorASGIApp(app)
+
+def _reload_index():
+    if search_system is None:
+        return
+    if search_system.reload():
+        print(f"🔄 Reloaded index version {search_system.version} from {search_system.index_path}")
+    if search_system.reload_behavior():
+        print(f"🔄 Reloaded co-occurrence matrix from {search_system.behavior_path}")
+
+def _run_worker(listener, host, port):
+    """Serve requests one at a time until SIGTERM, then finish the current one"""
+    server = BaseWSGIServer(host, port, app, fd=listener.fileno())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+    server.server_close()
+
+def serve_prefork(workers=None, host=SERVER_HOST, port=SERVER_PORT):
+    """Serve the app from pre-forked worker processes sharing one socket.
+    
+    The index is loaded once in the master, so workers share its pages
+    copy-on-write (gc.freeze() keeps the collector from touching them).
+    It is loaded before the first fork, in the master's own thread: a
+    child forked while the startup thread holds a lock (NumPy's, logging's
+    or the startup lock) could deadlock on it. Dead workers are replaced.
+    SIGHUP reloads the index from SEARCH_INDEX_DIR in the master and rolls
+    the workers: new ones start on the new index while old ones finish
+    their in-flight requests. SIGTERM or SIGINT drains all workers and
+    exits.
+    """
+    workers = workers or os.cpu_count() or 1
+    startup.run()
+    listener = socket.create_server((host, port), backlog=2048)
+    signals = []
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+    
+    def spawn():
+        gc.collect()
+        gc.freeze()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(listener, host, port)
+            finally:
+                os._exit(0)
+        return pid
+    
+    children = {spawn() for _ in range(workers)}
+    retiring = {}
+    print(f"🚀 Serving on http://{host}:{port} with {workers} workers (pid {os.getpid()})")
+    while children or retiring:
+        while signals:
+            signum = signals.pop(0)
+            if signum == signal.SIGHUP and children:
+                _reload_index()
+                old, children = children, {spawn() for _ in range(workers)}
+                retiring.update((pid, time.monotonic() + WORKER_SHUTDOWN_TIMEOUT) for pid in old)
+            elif signum != signal.SIGHUP:
+                retiring.update((pid, time.monotonic() + WORKER_SHUTDOWN_TIMEOUT) for pid in children)
+                children = set()
+            for pid in retiring:
+                _signal_worker(pid, signal.SIGTERM)
+        
+        for pid, deadline in list(retiring.items()):
+            if deadline < time.monotonic():
+                _signal_worker(pid, signal.SIGKILL)
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.2)
+        elif pid in retiring:
+            del retiring[pid]
+        elif pid in children:
+            # A worker died unexpectedly; keep the pool at full strength
+            children.discard(pid)
+            children.add(spawn())
+    listener.close()
+
+def _signal_worker(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+def serve_async(threads=ASYNC_THREADS, host=SERVER_HOST, port=SERVER_PORT):
+    """Serve asgi_app on `threads` threads with uvicorn; SIGHUP reloads the index in place"""
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("asyncio mode needs uvicorn: pip install uvicorn")
+    signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=_reload_index).start())
+    asgi_app.threads = threads
+    uvicorn.run(asgi_app, host=host, port=port, lifespan='on', timeout_graceful_shutdown=WORKER_SHUTDOWN_TIMEOUT)
+
+def build_index(path, catalog_file=None):
+    """Index the catalog (or a JSONL/CSV catalog file) and write it to `path`"""
+    started = time.perf_counter()
+    if catalog_file:
+        search = ProductSearch.from_catalog_file(catalog_file, precision=index_precision)
+        stats = search.ingest_stats
+        print(f"📥 Read {stats['rows']} rows ({stats['rows_per_second']:.0f} rows/s), skipped {stats['skipped']}")
+        for error in stats['errors']:
+            print(f"   ⚠️ {error}")
+    else:
+        search = ProductSearch(products, precision=index_precision)
+    search.save(path)
+    print(f"📦 Indexed {search.index.n_rows} products into {path} in {time.perf_counter() - started:.2f}s")
+
+def build_shards(path, n_shards, catalog_file=None):
+    """Index the catalog (or a JSONL/CSV catalog file) into n_shards shards under `path`"""
+    started = time.perf_counter()
+    stats = {'rows': 0, 'skipped': 0, 'errors': []}
+    rows = valid_products(read_catalog_rows(catalog_file), stats) if catalog_file else products
+    build_sharded_index(rows, path, int(n_shards), precision=index_precision)
+    if catalog_file:
+        print(f"📥 Read {stats['rows']} rows, skipped {stats['skipped']}")
+        for error in stats['errors']:
+            print(f"   ⚠️ {error}")
+    print(f"📦 Indexed the catalog into {n_shards} shards under {path} in {time.perf_counter() - started:.2f}s")
+
+def ingest_events(log_file, path):
+    """Fold a behavior event log into the co-occurrence matrix saved at `path`"""
+    behavior = CoOccurrence.load(path) if os.path.exists(path) else CoOccurrence()
+    behavior = behavior.ingest(log_file)
+    stats = behavior.ingest_stats
+    print(f"📥 Read {stats['events']} events ({stats['events_per_second']:.0f} events/s), skipped {stats['skipped']}")
+    for error in stats['errors']:
+        print(f"   ⚠️ {error}")
+    behavior.save(path)
+    print(f"📦 Saved co-occurrence of {len(behavior.ids)} products ({behavior.matrix.nnz} pairs) into {path}")
 
 if __name__ == '__main__':
+    if len(sys.argv) in (3, 4) and sys.argv[1] == 'build-index':
+        build_index(*sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) in (4, 5) and sys.argv[1] == 'build-shards':
+        build_shards(*sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) == 4 and sys.argv[1] == 'ingest-events':
+        ingest_events(*sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) in (2, 3) and sys.argv[1] == 'serve':
+        serve_prefork(int(sys.argv[2]) if len(sys.argv) == 3 else None)
+        sys.exit(0)
+    startup.start()
+    if len(sys.argv) in (2, 3) and sys.argv[1] == 'serve-async':
+        serve_async(int(sys.argv[2]) if len(sys.argv) == 3 else ASYNC_THREADS)
+        sys.exit(0)
+    
     print("🚀 Starting E-Commerce Search & Recommendation System...")
     print("📍 Website available at: http://localhost:5000")
     print("🔍 Search API available at: http://localhost:5000/api/search?q=your_query")
     print("💡 Recommendations API available at: http://localhost:5000/api/recommend/1")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    print("📈 Metrics available at: http://localhost:5000/metrics")
+    print("🩺 Health and readiness at: http://localhost:5000/health and /ready")
+    # The Werkzeug debugger runs arbitrary code for anyone who can reach it, so
+    # it is off unless FLASK_DEBUG=1 is set (app.run reads it)
+    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
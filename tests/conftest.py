@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ecommerceWeb  # noqa: E402
+from ecommerceWeb import ProductSearch  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Test client serving a fresh index of the sample products"""
+    monkeypatch.setattr(ecommerceWeb, 'search_system', ProductSearch(ecommerceWeb.products))
+    return ecommerceWeb.app.test_client()
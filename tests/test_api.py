@@ -0,0 +1,126 @@
+import asyncio
+import json
+
+import pytest
+
+import ecommerceWeb
+from ecommerceWeb import Catalog, CatalogSnapshot, ProductSearch
+
+
+def test_recommend_batch(client):
+    response = client.post('/api/recommend/batch', json={'ids': [1, 999]})
+    assert response.status_code == 200
+    assert [item['id'] for item in response.get_json()] == [1, 999]
+    assert response.get_json()[1]['recommendations'] == []
+
+
+def test_recommend_batch_rejects_boolean_ids(client):
+    assert client.post('/api/recommend/batch', json={'ids': [True]}).status_code == 400
+    assert client.post('/api/recommend/batch', json={'ids': [1, False]}).status_code == 400
+
+
+def test_recommend_session(client):
+    response = client.post('/api/recommend/session', json={'ids': [1, 6], 'weights': [1, 2.5]})
+    assert response.status_code == 200
+    assert {product['id'] for product in response.get_json()}.isdisjoint({1, 6})
+
+
+def test_recommend_session_rejects_boolean_ids(client):
+    assert client.post('/api/recommend/session', json={'ids': [True]}).status_code == 400
+    assert client.post('/api/recommend/session', json={'ids': [1, False]}).status_code == 400
+
+
+def test_recommend_session_rejects_boolean_weights(client):
+    response = client.post('/api/recommend/session', json={'ids': [1, 6], 'weights': [True, 1]})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('url', ['/', '/search?search=headphones', '/product/1'])
+def test_matching_etag_gets_304_without_a_body(client, url):
+    first = client.get(url)
+    assert first.status_code == 200 and first.data
+    etag = first.headers['ETag']
+    again = client.get(url, headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == etag
+
+
+@pytest.mark.parametrize('url', ['/', '/search?search=headphones', '/product/1'])
+def test_etag_changes_with_the_index_version(client, url):
+    etag = client.get(url).headers['ETag']
+    search = ecommerceWeb.search_system
+    search.update_product(dict(search.get_product(1), price=9.99))
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def metric_samples(client):
+    """{sample name with labels: value} scraped from /metrics"""
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_metrics_count_a_search(client):
+    before = metric_samples(client)
+    assert client.get('/api/search?q=headphones').status_code == 200
+    after = metric_samples(client)
+    
+    prefix = 'search_operation_seconds_bucket{operation="api_search",le="'
+    buckets = [(name[len(prefix):-2], value) for name, value in after.items() if name.startswith(prefix)]
+    assert buckets[-1][0] == '+Inf'
+    counts = [value for _, value in buckets]
+    assert counts == sorted(counts)
+    # The search lands in one bucket and every bucket above it
+    grown = [after[prefix + le + '"}'] - before.get(prefix + le + '"}', 0) for le, _ in buckets]
+    assert set(grown) <= {0, 1} and grown == sorted(grown) and grown[-1] == 1
+    count = 'search_operation_seconds_count{operation="api_search"}'
+    assert after[count] == before.get(count, 0) + 1 == counts[-1]
+    total = 'search_operation_seconds_sum{operation="api_search"}'
+    assert after[total] > before.get(total, 0)
+
+
+def test_asgi_app_serves_the_flask_app(client):
+    sent = []
+    
+    async def exchange(scope, messages):
+        queue = list(messages)
+        
+        async def receive():
+            return queue.pop(0)
+        
+        async def send(message):
+            sent.append(message)
+        
+        await ecommerceWeb.asgi_app(scope, receive, send)
+    
+    async def session():
+        await exchange({'type': 'http', 'method': 'GET', 'path': '/api/search', 'query_string': b'q=headphones',
+                        'http_version': '1.1', 'headers': []}, [{'type': 'http.request', 'body': b''}])
+        await exchange({'type': 'lifespan'}, [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+    
+    asyncio.run(session())
+    assert sent[0]['type'] == 'http.response.start' and sent[0]['status'] == 200
+    assert json.loads(sent[1]['body']) == client.get('/api/search?q=headphones').get_json()
+    assert [message['type'] for message in sent[2:]] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+@pytest.mark.parametrize('method, url, body', [
+    ('get', '/api/recommend/1', None),
+    ('post', '/api/recommend/batch', {'ids': [1]}),
+    ('post', '/api/recommend/session', {'ids': [1, 2]}),
+    ('post', '/api/search/batch', {'queries': ['wireless']}),
+])
+def test_warming_index_answers_503(monkeypatch, method, url, body):
+    snapshot = CatalogSnapshot.from_catalog(Catalog.from_products(ecommerceWeb.products))
+    monkeypatch.setattr(ecommerceWeb, 'search_system', ProductSearch(snapshot=snapshot))
+    response = getattr(ecommerceWeb.app.test_client(), method)(url, json=body)
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from ecommerceWeb import CoOccurrence
+
+
+def write_events(path, events):
+    with open(path, 'a') as f:
+        for ts, session, product_id in events:
+            f.write(json.dumps({'ts': ts, 'session': session, 'product_id': product_id, 'event': 'view'}) + '\n')
+
+
+def window(state, session):
+    return [tuple(event) for event in state.sessions[session]]
+
+
+def test_ingest_leaves_the_previous_snapshot_untouched(tmp_path):
+    log = tmp_path / 'events.jsonl'
+    write_events(log, [(1, 'a', 1), (2, 'a', 2), (3, 'b', 4)])
+    first = CoOccurrence().ingest(str(log))
+    sessions, matrix = window(first, 'a'), first.matrix.toarray()
+    
+    write_events(log, [(4, 'a', 5), (5, 'b', 6), (6, 'c', 7)])
+    second = first.ingest(str(log))
+    assert window(first, 'a') == sessions
+    assert 'c' not in first.sessions
+    assert (first.matrix.toarray() == matrix).all()
+    assert len(window(second, 'a')) == 3
+    assert set(second.neighbors(5)[0]) == {1, 2}
+
+
+def test_failed_ingest_changes_nothing(tmp_path, monkeypatch):
+    log = tmp_path / 'events.jsonl'
+    write_events(log, [(1, 'a', 1), (2, 'a', 2)])
+    first = CoOccurrence().ingest(str(log))
+    sessions, offset = window(first, 'a'), first.log_offset
+    
+    write_events(log, [(3, 'a', 3), (4, 'a', 4), (5, 'a', 5)])
+    add_chunk = CoOccurrence._add_chunk
+    calls = []
+    
+    def failing(self, events):
+        calls.append(events)
+        if len(calls) > 1:
+            raise RuntimeError('disk error')
+        add_chunk(self, events)
+    
+    monkeypatch.setattr(CoOccurrence, '_add_chunk', failing)
+    with pytest.raises(RuntimeError):
+        first.ingest(str(log), chunk_size=1)
+    assert window(first, 'a') == sessions
+    assert first.log_offset == offset
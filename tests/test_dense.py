@@ -0,0 +1,43 @@
+import pytest
+
+import ecommerceWeb
+from benchmark import synthetic_products
+from ecommerceWeb import DENSE_N_PROBE, ProductSearch
+
+ADDED = {'id': 5000, 'name': 'Noise Cancelling Headphones', 'category': 'Electronics', 'price': 199.0,
+         'rating': 4.7, 'description': 'Over-ear wireless headphones', 'tags': ['audio', 'wireless']}
+
+
+def recommended(search, product_id):
+    return [product['id'] for product in search.get_recommendations(product_id)]
+
+
+@pytest.fixture(scope='module')
+def dense_search():
+    return ProductSearch(list(synthetic_products(5000)), dense={})
+
+
+def test_ivf_recall_at_the_default_n_probe(dense_search):
+    report = dense_search.measure_ann_recall(n_probes=(1, DENSE_N_PROBE))
+    narrow, default = report['settings']
+    assert default['n_probe'] == DENSE_N_PROBE
+    assert default['recall_at_k'] >= 0.9
+    assert default['recall_at_k'] >= narrow['recall_at_k']
+
+
+def test_compaction_rebuilds_the_ivf_index():
+    catalog = list(synthetic_products(400)) + [dict(product, id=product['id'] + 1000)
+                                               for product in ecommerceWeb.products]
+    search = ProductSearch(catalog, dense={})
+    search.add_product(ADDED)
+    assert search.delete_product(1001)
+    search.compact()
+    
+    index = search.index
+    assert index.ann is not None
+    assert index.ann.matrix.shape[0] == index.n_base == len(catalog)
+    fresh = ProductSearch([product for product in catalog if product['id'] != 1001] + [ADDED], dense={})
+    for product_id in (5000, 1002, catalog[0]['id']):
+        assert 1001 not in recommended(search, product_id)
+        assert recommended(search, product_id) == recommended(fresh, product_id)
+    assert search.measure_ann_recall(n_probes=(DENSE_N_PROBE,))['settings'][0]['recall_at_k'] >= 0.9
@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from ecommerceWeb import ProductSearch, normalize_product
+
+
+def row(**fields):
+    return dict({'id': 1, 'name': 'Mug', 'category': 'Kitchen', 'price': 9.5, 'rating': 4.0}, **fields)
+
+
+@pytest.mark.parametrize('product_id', [1.7, True, False, '1.7', 'one', None])
+def test_non_integral_ids_are_rejected(product_id):
+    with pytest.raises(ValueError):
+        normalize_product(row(id=product_id))
+
+
+@pytest.mark.parametrize('product_id', [3, 3.0, '3'])
+def test_integral_ids_are_accepted(product_id):
+    assert normalize_product(row(id=product_id))['id'] == 3
+
+
+def test_rejected_ids_are_counted(tmp_path):
+    path = tmp_path / 'catalog.jsonl'
+    rows = [row(id=1), row(id=1.7, name='Cup'), row(id=True, name='Bowl'), row(id=2, name='Plate')]
+    path.write_text(''.join(json.dumps(r) + '\n' for r in rows))
+    search = ProductSearch.from_catalog_file(str(path))
+    assert search.ingest_stats['skipped'] == 2
+    assert len(search.ingest_stats['errors']) == 2
+    assert search.get_product(1)['name'] == 'Mug'
+    assert search.get_product(2)['name'] == 'Plate'
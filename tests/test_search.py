@@ -0,0 +1,227 @@
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+import ecommerceWeb
+from benchmark import synthetic_products
+from ecommerceWeb import FUZZY_MAX_DISTANCE, ProductSearch, edit_distance, product_text
+
+QUERIES = ['wireless headphones', 'coffee', 'running shoes', 'desk lamp', 'laptop gaming']
+FILTERS = [{}, {'category': 'Electronics'}, {'max_price': 100}, {'min_rating': 4.0},
+           {'category': 'Electronics', 'max_price': 500, 'min_rating': 3.5}]
+
+
+@pytest.fixture
+def search():
+    return ProductSearch(ecommerceWeb.products)
+
+
+@pytest.fixture(scope='module')
+def catalog():
+    return list(synthetic_products(400)) + [dict(product, id=product['id'] + 1000)
+                                            for product in ecommerceWeb.products]
+
+
+@pytest.fixture(scope='module')
+def large_search(catalog):
+    return ProductSearch(catalog)
+
+
+def reference_search(catalog, query, category=None, max_price=None, min_rating=None):
+    """(id, score) of every hit, ranked by a dense TF-IDF computation"""
+    vectorizer = TfidfVectorizer(stop_words='english')
+    matrix = vectorizer.fit_transform([product_text(product) for product in catalog])
+    scores = (matrix @ vectorizer.transform([query]).T).toarray().ravel()
+    hits = [(product['id'], score) for product, score in zip(catalog, scores)
+            if score > 0 and (category is None or product['category'].lower() == category.lower())
+            and (max_price is None or product['price'] <= max_price)
+            and (min_rating is None or product['rating'] >= min_rating)]
+    return sorted(hits, key=lambda hit: (-hit[1], hit[0]))
+
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('filters', FILTERS)
+def test_search_matches_reference(catalog, large_search, query, filters):
+    want = reference_search(catalog, query, **filters)
+    got = [(product['id'], product['similarity_score'])
+           for product in large_search.search_products(query, **filters)]
+    assert [product_id for product_id, _ in got] == [product_id for product_id, _ in want]
+    assert [score for _, score in got] == pytest.approx([score for _, score in want])
+    page = large_search.search_page(query, **filters, limit=5)
+    assert page['total'] == len(want)
+    assert [product['id'] for product in page['results']] == [product_id for product_id, _ in want[:5]]
+
+
+def all_pages(search, limit, **kwargs):
+    ids, cursor = [], None
+    while True:
+        page = search.search_page(limit=limit, cursor=cursor, **kwargs)
+        ids += [product['id'] for product in page['results']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.parametrize('query, sort', [('wireless headphones', None), ('', None), ('', 'price_desc'),
+                                         ('coffee', 'rating_asc'), ('', 'rating_desc')])
+def test_cursor_pages_cover_the_ranking_once(large_search, query, sort):
+    full = [product['id'] for product in large_search.search_products(query, sort=sort)]
+    assert all_pages(large_search, 7, query=query, sort=sort) == full
+    offsets = [product['id'] for offset in range(0, len(full), 9)
+               for product in large_search.search_page(query, limit=9, offset=offset, sort=sort)['results']]
+    assert offsets == full
+
+
+def test_sorted_browse_matches_reference(catalog, large_search):
+    want = [product['id'] for product in sorted(catalog, key=lambda product: (-product['price'], product['id']))
+            if product['category'] == 'Electronics']
+    assert all_pages(large_search, 10, query='', sort='price_desc', category='Electronics') == want
+
+
+def test_save_and_load_round_trip(catalog, large_search, tmp_path):
+    large_search.save(str(tmp_path / 'index'))
+    loaded = ProductSearch.load(str(tmp_path / 'index'))
+    assert loaded.index.version == large_search.index.version
+    for query in QUERIES:
+        want = [(product['id'], product['similarity_score']) for product in large_search.search_products(query)]
+        got = [(product['id'], product['similarity_score']) for product in loaded.search_products(query)]
+        assert [product_id for product_id, _ in got] == [product_id for product_id, _ in want]
+        assert [score for _, score in got] == pytest.approx([score for _, score in want])
+    for product in catalog[::7]:
+        assert loaded.get_product(product['id']).json_bytes() == large_search.get_product(product['id']).json_bytes()
+        assert ([p['id'] for p in loaded.get_recommendations(product['id'])] ==
+                [p['id'] for p in large_search.get_recommendations(product['id'])])
+    assert loaded.suggest('wire') == large_search.suggest('wire')
+
+
+def test_sort_orders_hits_without_changing_similarity(search):
+    relevance = {product['id']: product['similarity_score'] for product in search.search_products('work')}
+    assert relevance
+    for sort, field, descending in (('price_asc', 'price', False), ('price_desc', 'price', True),
+                                    ('rating_desc', 'rating', True)):
+        results = search.search_products('work', sort=sort)
+        values = [product[field] for product in results]
+        assert values == sorted(values, reverse=descending)
+        assert {product['id']: product['similarity_score'] for product in results} == relevance
+
+
+def test_sorted_browse_has_no_similarity(search):
+    page = search.search_page('', sort='price_asc', limit=3)
+    prices = [product['price'] for product in page['results']]
+    assert prices == sorted(prices)
+    assert all('similarity_score' not in product for product in page['results'])
+    following = search.search_page('', sort='price_asc', limit=3, cursor=page['next_cursor'])
+    assert min(product['price'] for product in following['results']) >= prices[-1]
+
+
+def ids(results):
+    return [product['id'] for product in results]
+
+
+def test_misspelled_query_is_corrected(search):
+    assert search.index.correct('wireless hedphones') == 'wireless headphones'
+    assert ids(search.search_products('hedphones')) == ids(search.search_products('headphones'))
+
+
+def test_transposition_counts_as_one_edit(search):
+    assert edit_distance('lamp', 'lmap', 1) == 1
+    # Four-letter words get a single edit, which a swap fits in
+    assert search.index.correct('lmap') == 'lamp'
+    assert search.index.correct('headphnoes') == 'headphones'
+
+
+def test_words_beyond_the_edit_limit_are_dropped(search):
+    assert edit_distance('headphones', 'hdphnes', FUZZY_MAX_DISTANCE) == FUZZY_MAX_DISTANCE + 1
+    assert search.index.correct('hdphnes') == ''
+    assert search.search_products('hdphnes') == []
+    # Words shorter than FUZZY_MIN_LENGTH are never corrected
+    assert search.index.correct('lmp') == ''
+
+
+def test_terms_added_by_updates_are_corrected(search):
+    assert search.index.correct('trampolin') == ''
+    search.add_product({'id': 100, 'name': 'Garden Trampoline', 'category': 'Sports', 'price': 250})
+    assert search.index.correct('trampolin') == 'trampoline'
+    assert ids(search.search_products('trampolin')) == [100]
+
+
+@pytest.mark.parametrize('precision, least_overlap', [('float64', 1.0), ('float32', 0.99), ('uint8', 0.95)])
+def test_precision_modes_keep_the_ranking(catalog, tmp_path, precision, least_overlap):
+    search = ProductSearch(catalog, precision=precision)
+    report = search.measure_precision(sample=100)
+    assert report['neighbor_overlap_at_k'] >= least_overlap
+    assert report['search_overlap_at_k'] >= least_overlap
+    
+    search.save(str(tmp_path / 'index'))
+    loaded = ProductSearch.load(str(tmp_path / 'index'))
+    index, saved = search.index, loaded.index
+    assert saved.precision == precision
+    assert saved.postings.dtype == index.postings.dtype
+    assert saved.neighbor_scores.dtype == index.neighbor_scores.dtype
+    assert (saved.base_counts is None) == (index.base_counts is None) == (precision != 'float64')
+    for query in QUERIES:
+        assert ids(loaded.search_products(query)) == ids(search.search_products(query))
+
+
+def texts(suggestions):
+    return [suggestion['text'] for suggestion in suggestions]
+
+
+def test_suggestions_rank_by_count_then_rating(search):
+    assert texts(search.suggest('h')) == ['Home', 'home', 'headphones', 'Wireless Bluetooth Headphones', 'health']
+    assert [suggestion.get('count') for suggestion in search.suggest('h')] == [2, 2, 1, None, 1]
+    # Laptop Pro (4.6) outranks Desk Lamp (4.1)
+    assert texts(search.suggest('la')) == ['laptop', 'Laptop Pro', 'lamp', 'Desk Lamp']
+    assert texts(search.suggest('desk ')) == ['Desk Lamp']
+    assert search.suggest('la', limit=2) == search.suggest('la')[:2]
+
+
+def test_deleted_products_leave_suggestions(search):
+    search.delete_product(4)
+    assert texts(search.suggest('la')) == ['laptop', 'lamp', 'Desk Lamp']
+    # Tag counts only drop at the next compaction
+    search.compact()
+    assert texts(search.suggest('la')) == ['lamp', 'Desk Lamp']
+
+
+def test_added_products_are_suggested(search):
+    search.add_product({'id': 100, 'name': 'Lava Lamp', 'category': 'Home', 'price': 30, 'rating': 4.9,
+                        'tags': ['lamp']})
+    suggestions = search.suggest('la')
+    assert {'text': 'Lava Lamp', 'type': 'product', 'id': 100, 'rating': 4.9} in suggestions
+    assert {'text': 'lamp', 'type': 'tag', 'count': 2} in suggestions
+    search.compact()
+    assert search.suggest('la') == suggestions
+
+
+def test_incremental_profile_matches_a_full_recompute(search):
+    index = search.index
+    product_ids, weights = [1, 6, 999, 4, 8, 2], [1.0, 2.0, 1.0, 1.0, 3.0, 0.5]
+    full = index.profile_vector(product_ids, weights).toarray()
+    for known in range(1, len(product_ids)):
+        previous = index.profile_vector(product_ids[:known], weights[:known])
+        extended = index.profile_vector(product_ids[known:], weights[known:], previous)
+        assert extended.toarray() == pytest.approx(full)
+    
+    fresh = ProductSearch(ecommerceWeb.products)
+    search.recommend_for_session(product_ids[:2], weights[:2], session_id='s')
+    assert (ids(search.recommend_for_session(product_ids, weights, session_id='s')) ==
+            ids(fresh.recommend_for_session(product_ids, weights)))
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_batch_pages_match_single_queries(large_search, filters):
+    queries = QUERIES + ['', 'hedphones', 'xqzw']
+    for query, page in zip(queries, large_search.search_batch(queries, limit=5, **filters)):
+        single = large_search.search_page(query, limit=5, **filters)
+        assert page['total'] == single['total']
+        assert ids(page['results']) == ids(single['results'])
+        assert ([product.get('similarity_score') for product in page['results']] ==
+                pytest.approx([product.get('similarity_score') for product in single['results']]))
+    assert large_search.search_batch([''])[0]['total'] == len(large_search.index.products)
+
+
+@pytest.mark.parametrize('precision', ['float64', 'float32', 'uint8'])
+def test_query_with_no_hit_passing_the_filters(precision):
+    search = ProductSearch(ecommerceWeb.products, precision=precision)
+    assert search.search_products('headphones', category='Home') == []
+    assert search.search_page('headphones', max_price=1)['total'] == 0
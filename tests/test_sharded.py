@@ -0,0 +1,66 @@
+import pytest
+
+import ecommerceWeb
+from benchmark import synthetic_products
+from ecommerceWeb import ProductSearch, ShardedSearch, build_sharded_index
+
+SPARSE = [
+    {'id': 9001, 'name': 'Zebra Quilt', 'category': 'Bedding', 'price': 40.0, 'rating': 4.1,
+     'description': 'Striped quilt', 'tags': ['zebra']},
+    {'id': 9002, 'name': 'Patchwork Quilt', 'category': 'Bedding', 'price': 55.0, 'rating': 3.9,
+     'description': 'Handmade', 'tags': ['patchwork']},
+    {'id': 9003, 'name': 'Theremin', 'category': 'Oddities', 'price': 310.0, 'rating': 4.4,
+     'description': 'Played without contact', 'tags': []},
+]
+
+
+@pytest.fixture(scope='module')
+def catalog():
+    return list(synthetic_products(300)) + [dict(product, id=product['id'] + 1000)
+                                            for product in ecommerceWeb.products] + SPARSE
+
+
+@pytest.fixture(scope='module')
+def sharded(catalog, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('shards') / 'index')
+    build_sharded_index(catalog, path, 3)
+    search = ShardedSearch(path)
+    yield search
+    search.close()
+
+
+def test_sharded_recommendations_match_unsharded(catalog, sharded):
+    single = ProductSearch(catalog)
+    for product in catalog:
+        want = [p['id'] for p in single.get_recommendations(product['id'], 4)]
+        assert [p['id'] for p in sharded.get_recommendations(product['id'], 4)] == want, product['id']
+    # Products sharing a term with few others get only those
+    assert [p['id'] for p in single.get_recommendations(9001, 4)] == [9002]
+    assert single.get_recommendations(9003, 4) == []
+    assert [[p['id'] for p in recommendations] for recommendations in
+            single.get_recommendations_batch([9001, 9003], 4)] == [[9002], []]
+
+
+@pytest.mark.parametrize('query, filters, sort', [
+    ('wireless headphones', {}, None),
+    ('coffee', {'max_price': 100}, None),
+    ('quilt', {}, None),
+    ('', {'category': 'Electronics'}, None),
+    ('', {'min_rating': 4.0}, 'price_asc'),
+    ('laptop', {}, 'rating_desc'),
+])
+def test_sharded_pages_match_unsharded(catalog, sharded, query, filters, sort):
+    single = ProductSearch(catalog)
+    cursors = [None, None]
+    for _ in range(3):
+        want = single.search_page(query, **filters, limit=6, cursor=cursors[0], sort=sort, facets=True)
+        got = sharded.search_page(query, **filters, limit=6, cursor=cursors[1], sort=sort, facets=True)
+        assert [product['id'] for product in got['results']] == [product['id'] for product in want['results']]
+        assert ([product.get('similarity_score') for product in got['results']] ==
+                pytest.approx([product.get('similarity_score') for product in want['results']]))
+        assert got['total'] == want['total']
+        assert got['facets'] == want['facets']
+        assert (got['next_cursor'] is None) == (want['next_cursor'] is None)
+        if want['next_cursor'] is None:
+            break
+        cursors = [want['next_cursor'], got['next_cursor']]
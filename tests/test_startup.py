@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+import threading
+
+import ecommerceWeb
+from ecommerceWeb import Startup
+
+
+def test_run_loads_in_the_calling_thread():
+    startup = Startup()
+    startup.run()
+    assert startup.state == 'ready'
+    startup.start()
+    assert startup.thread is threading.current_thread()
+
+
+def test_run_waits_for_a_background_load():
+    startup = Startup()
+    startup.start()
+    startup.run()
+    assert startup.state == 'ready'
+    assert not startup.thread.is_alive()
+
+
+def test_import_starts_no_load():
+    code = ('import threading, ecommerceWeb; '
+            'assert ecommerceWeb.startup.thread is None and ecommerceWeb.search_system is None; '
+            'assert [thread.name for thread in threading.enumerate()] == ["MainThread"]')
+    subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                   check=True)
+
+
+def test_first_request_starts_the_load(monkeypatch):
+    monkeypatch.setattr(ecommerceWeb, 'startup', Startup())
+    monkeypatch.setattr(ecommerceWeb, 'search_system', None)
+    client = ecommerceWeb.app.test_client()
+    response = client.get('/api/search?q=headphones')
+    assert response.status_code == 503
+    assert ecommerceWeb.startup.wait(timeout=60)
+    assert client.get('/ready?full=1').status_code == 200
+    assert client.get('/api/search?q=headphones').get_json()['results']
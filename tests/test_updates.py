@@ -0,0 +1,139 @@
+import sys
+import threading
+
+import pytest
+
+import ecommerceWeb
+from benchmark import synthetic_products
+from ecommerceWeb import ProductSearch, ResultCache, deep_sizeof
+
+
+def test_updated_rows_serialize_like_compacted_rows():
+    search = ProductSearch(ecommerceWeb.products)
+    hit = dict(search.search_products('headphones')[0])
+    assert 'similarity_score' in hit
+    search.update_product(dict(hit, price='12.5', rating=4, category=hit['category'].upper()))
+    delta = search.get_product(hit['id']).json_bytes()
+    assert b'similarity_score' not in delta
+    assert b'"price":12.5' in delta and b'"rating":4.0' in delta
+    search.compact()
+    assert search.get_product(hit['id']).json_bytes() == delta
+
+
+def test_add_update_delete_then_compact_matches_fresh_build():
+    search = ProductSearch(ecommerceWeb.products)
+    added = {'id': 100, 'name': 'Noise Cancelling Headphones', 'category': 'Electronics', 'price': 199.0,
+             'rating': 4.7, 'description': 'Over-ear wireless headphones', 'tags': ['audio', 'wireless']}
+    search.add_product(added)
+    updated = dict(search.get_product(2), price=19.99, description='Refurbished phone with a wireless charger')
+    search.update_product(updated)
+    assert search.delete_product(5)
+    assert not search.delete_product(5)
+    assert search.get_product(5) is None
+    assert search.get_product(2)['price'] == 19.99
+    assert 100 in [product['id'] for product in search.search_products('headphones')]
+    
+    search.compact()
+    catalog = [dict(product) for product in ecommerceWeb.products if product['id'] not in (2, 5)]
+    catalog += [updated, added]
+    fresh = ProductSearch(catalog)
+    for query in ('headphones', 'wireless', 'phone charger', 'coffee'):
+        got = [(product['id'], product['similarity_score']) for product in search.search_products(query)]
+        want = [(product['id'], product['similarity_score']) for product in fresh.search_products(query)]
+        assert [product_id for product_id, _ in got] == [product_id for product_id, _ in want]
+        assert [score for _, score in got] == pytest.approx([score for _, score in want])
+    for product in catalog:
+        assert ([p['id'] for p in search.get_recommendations(product['id'])] ==
+                [p['id'] for p in fresh.get_recommendations(product['id'])])
+
+
+def test_invalid_upserts_raise_and_change_nothing():
+    search = ProductSearch(ecommerceWeb.products)
+    version = search.version
+    with pytest.raises(ValueError, match='name'):
+        search.add_product({'id': 200, 'category': 'Books', 'price': 5})
+    with pytest.raises(ValueError):
+        search.add_product({'id': 'abc', 'name': 'Book', 'category': 'Books', 'price': 5})
+    assert search.version == version
+    assert search.get_product(200) is None
+    
+    search.add_product({'id': '201', 'name': 'Notebook', 'category': 'Books', 'price': '3.5'})
+    product = search.get_product(201)
+    assert (product['price'], product['description'], product['tags']) == (3.5, '', [])
+
+
+
+@pytest.mark.parametrize('precision', ['float64', 'uint8'])
+def test_save_while_updates_add_terms(tmp_path, precision):
+    search = ProductSearch(list(synthetic_products(3000)), precision=precision)
+    done = threading.Event()
+    
+    def add_products():
+        for i in range(300):
+            search.add_product({'id': 10 ** 6 + i, 'name': f'Gadget term{i} other{i}', 'category': 'Electronics',
+                                'price': 1})
+        done.set()
+    
+    # Switch threads often so the writer runs while the vocabulary is read
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    writer = threading.Thread(target=add_products)
+    writer.start()
+    path = str(tmp_path / 'index')
+    try:
+        saves = 0
+        while not done.is_set() or saves == 0:
+            search.save(path)
+            saves += 1
+    finally:
+        writer.join()
+        sys.setswitchinterval(interval)
+    
+    saved = ProductSearch.load(path)
+    assert sorted(term_id for _, term_id in saved._index.vocabulary.items()) == list(range(saved._index.n_terms))
+    assert saved.get_product(1) is not None
+
+
+def test_result_cache_stays_within_its_byte_bound():
+    value = list(range(100))
+    cache = ResultCache(max_bytes=3 * deep_sizeof(value))
+    for key in range(3):
+        cache.put(key, 1, value)
+    assert cache.get(0, 1) is value
+    cache.put(3, 1, value)
+    stats = cache.stats()
+    assert stats['bytes'] <= stats['max_bytes'] and stats['evictions'] == 1
+    # The least recently used entry goes first
+    assert cache.get(1, 1) is None
+    assert cache.get(0, 1) is value and cache.get(3, 1) is value
+    cache.put('large', 1, list(range(1000)))
+    assert cache.get('large', 1) is None
+
+
+def test_result_cache_entries_expire():
+    cache = ResultCache(ttl=0)
+    cache.put('key', 1, 'value')
+    assert cache.get('key', 1) is None
+    assert cache.stats()['expirations'] == 1 and cache.stats()['entries'] == 0
+    cache = ResultCache(ttl=60)
+    cache.put('key', 1, 'value')
+    assert cache.get('key', 1) == 'value'
+
+
+def test_result_cache_is_invalidated_by_a_new_version():
+    cache = ResultCache()
+    cache.put('old', 1, 'value')
+    assert cache.get('old', 2) is None
+    cache.put('new', 2, 'value')
+    assert cache.stats()['entries'] == 1 and cache.get('old', 1) is None
+    # Results computed from a replaced snapshot are not stored
+    cache.put('late', 1, 'value')
+    assert cache.get('late', 1) is None
+    
+    search = ProductSearch(ecommerceWeb.products)
+    first = search.search_page('headphones')
+    assert search.search_page('headphones') is first
+    assert search.cache.stats()['hits'] == 1
+    search.update_product(dict(search.get_product(1), price=9.99))
+    assert search.search_page('headphones')['results'][0]['price'] == 9.99
+    assert search.cache.stats()['hits'] == 1 and search.cache.stats()['version'] == search.version